@@ -1,15 +1,13 @@
 #!/bin/bash
+data_dir=../../../../dataset/culane/
 echo experiment name: $1
 echo status: $2
 
+# Perform test/validation (test: overall F1 score & per-category performance)
 cd tools/culane_evaluation
 if [ "$2" = "test" ]; then
-    # Perform test with official scripts
-    ./eval.sh $1
-    # Calculate overall F1 score
-    python cal_total.py --exp-name=$1
+    python fast_culane.py ${data_dir} ../../output/ $1 test
 else
-    # Perform validation with official scripts
-    ./eval_validation.sh $1
+    python fast_culane.py ${data_dir} ../../output/ $1 val
 fi
 cd ../../
@@ -0,0 +1,158 @@
+import os
+import time
+import yaml
+import argparse
+import torch
+from torch.cuda.amp import autocast
+from utils.all_utils_semseg import load_checkpoint
+from utils.all_utils_landec import build_lane_detection_model, get_lane_batched, get_curves_batched, \
+    format_lanes_batched, limit_lanes
+from utils.frame_reader import FrameReader
+from utils.lane_writer import LaneWriter
+from utils.inference_pipeline import InferencePipeline
+from utils.key_frames import KeyFrameReuse
+from tools.vis_tools import simple_lane_detection_transform
+
+
+def inference_one_source(net, device, reader, writer, is_mixed_precision, input_sizes, mean, std, gap, ppl, thresh,
+                         dataset, output_dir=None, key_frame_interval=1, key_frame_threshold=0.2, crop_top=0,
+                         method='baseline'):
+    # Predict lanes for every frame of a FrameReader, lanes are in the original frame resolution
+    # Pre-processing (resize & normalize) and lane decoding run on device, writing is done by the LaneWriter
+    # key_frame_interval > 1: the deep stage only runs on key frames, other frames propagate its features
+    # (frames are in order, grouped by video/folder)
+    # crop_top > 0: top rows (at the dataset's original height) are cropped before resizing (ROI)
+    # method == 'lstr': lanes are sampled from the predicted curves
+    net.eval()
+    reuse = KeyFrameReuse(net, max_interval=key_frame_interval, threshold=key_frame_threshold) \
+        if key_frame_interval > 1 else None
+
+    def compute(images, names):
+        # Same row sampling (relative to the frame height) as the training resolution for any frame size
+        resize_shape = list(images.shape[1:3])
+        scaled_gap = gap * resize_shape[0] / input_sizes[1][0]
+        scaled_crop_top = round(crop_top * resize_shape[0] / input_sizes[1][0])
+        with autocast(is_mixed_precision):
+            images = simple_lane_detection_transform(images[:, scaled_crop_top:].permute(0, 3, 1, 2),
+                                                     resize_shape=input_sizes[0], mean=mean, std=std)
+            outputs = net(images) if reuse is None else reuse(images, names)
+            if method != 'lstr':
+                prob_map = torch.nn.functional.interpolate(outputs['out'], size=input_sizes[0], mode='bilinear',
+                                                           align_corners=True).softmax(dim=1)
+                existence = (outputs['lane'].sigmoid() > 0.5)
+                if dataset == 'tusimple':  # At most 5 lanes
+                    existence = limit_lanes(existence, max_lanes=5)
+        if method == 'lstr':
+            coords, keep = get_curves_batched(outputs['logits'], outputs['curves'], gap=scaled_gap, ppl=ppl,
+                                              resize_shape=resize_shape, dataset='culane', crop_top=scaled_crop_top,
+                                              max_lanes=5 if dataset == 'tusimple' else None)
+        else:
+            coords = get_lane_batched(prob_map[:, 1:, :, :], gap=scaled_gap, ppl=ppl, thresh=thresh,
+                                      resize_shape=resize_shape, dataset='culane', crop_top=scaled_crop_top)
+            keep = (existence > 0) & (coords.sum(dim=-1) != 0)
+
+        return coords, keep, names, resize_shape, scaled_gap
+
+    def post(coords, keep, names, resize_shape, scaled_gap):
+        batch_coordinates = format_lanes_batched(coords, keep, resize_shape=resize_shape, gap=scaled_gap,
+                                                 dataset='culane')
+        if output_dir is not None:  # CULane format
+            names = [os.path.join(output_dir, x[:x.rfind('.')] + '.lines.txt') for x in names]
+        writer.put(names, batch_coordinates)
+
+    with torch.no_grad():
+        InferencePipeline(device=device, compute_fn=compute, post_fn=post).run(reader)
+    if reuse is not None:
+        reuse.report()
+
+
+if __name__ == '__main__':
+    # Settings
+    parser = argparse.ArgumentParser(description='PyTorch Auto-drive')
+    parser.add_argument('--input', type=str, required=True,
+                        help='Input image folder (searched recursively) or video file')
+    parser.add_argument('--output', type=str, default='./output/inference.json',
+                        help='Output json lines file, or output directory for the culane format '
+                             '(default: ./output/inference.json)')
+    parser.add_argument('--format', type=str, default='json',
+                        help='Output format, 1 json line per frame or 1 .lines.txt per frame (json/culane) '
+                             '(default: json)')
+    parser.add_argument('--dataset', type=str, default='tusimple',
+                        help='Model trained on TuSimple (tusimple) / CULane (culane) (default: tusimple)')
+    parser.add_argument('--method', type=str, default='baseline',
+                        help='method selection (lstr/scnn/sad/baseline) (default: baseline)')
+    parser.add_argument('--backbone', type=str, default='erfnet',
+                        help='backbone selection (erfnet/enet/vgg16/resnet18s/resnet18/resnet34/resnet50/resnet101)'
+                             '(default: erfnet)')
+    parser.add_argument('--batch-size', type=int, default=8,
+                        help='Number of frames per batch (default: 8)')
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help='Maximum number of decoded batches waiting for inference (default: 4)')
+    parser.add_argument('--mixed-precision', action='store_true', default=False,
+                        help='Enable mixed precision inference (default: False)')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='Use channels_last (NHWC) memory format for weights & inputs (default: False)')
+    parser.add_argument('--continue-from', type=str, required=True,
+                        help='Checkpoint to load')
+    parser.add_argument('--device', type=str, default=None,
+                        help='Inference device (default: cuda if available else cpu)')
+    parser.add_argument('--encoder-only', action='store_true', default=False,
+                        help='Only the ENet encoder (default: False)')
+    parser.add_argument('--scnn-engine', type=str, default='loop',
+                        help='SCNN message passing engine (loop/scan/functional/resa) (default: loop)')
+    parser.add_argument('--roi', action='store_true', default=False,
+                        help='Crop the region of interest (CROP_TOP in configs.yaml, scaled to the frame height) '
+                             'before resizing, for checkpoints trained with --roi (default: False)')
+    parser.add_argument('--key-frame-interval', type=int, default=1,
+                        help='Run the deep encoder stage at most every this many video frames, other frames '
+                             'propagate deep features of their key frame, 1: every frame (default: 1)')
+    parser.add_argument('--key-frame-threshold', type=float, default=0.2,
+                        help='A new key frame is taken when the aligned shallow features differ more than this '
+                             '(relative) (default: 0.2)')
+    args = parser.parse_args()
+    if args.format not in ['json', 'culane'] or args.key_frame_interval < 1:
+        raise ValueError
+    with open('configs.yaml', 'r') as f:  # Safer and cleaner than box/EasyDict
+        configs = yaml.load(f, Loader=yaml.Loader)
+
+    # Basic configurations
+    mean = configs['GENERAL']['MEAN']
+    std = configs['GENERAL']['STD']
+    if args.dataset not in configs['LANE_DATASETS'].keys():
+        raise ValueError
+    num_classes = configs[configs['LANE_DATASETS'][args.dataset]]['NUM_CLASSES']
+    input_sizes = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES_ROI' if args.roi else 'SIZES']
+    crop_top = configs[configs['LANE_DATASETS'][args.dataset]]['CROP_TOP'] if args.roi else 0
+    gap = configs[configs['LANE_DATASETS'][args.dataset]]['GAP']
+    ppl = configs[configs['LANE_DATASETS'][args.dataset]]['PPL']
+    thresh = configs[configs['LANE_DATASETS'][args.dataset]]['THRESHOLD']
+    if args.device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    else:
+        device = torch.device(args.device)
+    print(device)
+    net = build_lane_detection_model(args, num_classes, input_size=input_sizes[0] if args.roi else None)
+    net.to(device)
+    load_checkpoint(net=net, optimizer=None, lr_scheduler=None, filename=args.continue_from)
+
+    reader = FrameReader(args.input, batch_size=args.batch_size, max_queue_size=args.queue_size,
+                         pin_memory=device.type == 'cuda')
+    if args.format == 'json':
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        writer = LaneWriter(dataset='json', output_file=args.output)
+    else:
+        writer = LaneWriter(dataset='culane')
+
+    # Sustained FPS: from the first decoded frame to the last written result
+    time_now = time.perf_counter()
+    with writer:
+        inference_one_source(net=net, device=device, reader=reader, writer=writer,
+                             is_mixed_precision=args.mixed_precision, input_sizes=input_sizes,
+                             mean=mean, std=std, gap=gap, ppl=ppl, thresh=thresh, dataset=args.dataset,
+                             output_dir=args.output if args.format == 'culane' else None,
+                             key_frame_interval=args.key_frame_interval, key_frame_threshold=args.key_frame_threshold,
+                             crop_top=crop_top, method=args.method)
+    time_total = time.perf_counter() - time_now
+    print('{} frames in {:.2f}s, sustained FPS: {:.2f}{}'.format(
+        reader.count, time_total, reader.count / time_total,
+        '' if reader.fps is None else ' (video FPS: {:.2f})'.format(reader.fps)))
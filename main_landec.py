@@ -6,6 +6,10 @@ from torch.utils.tensorboard import SummaryWriter
 from utils.losses import LaneLoss, SADLoss, HungarianLoss
 from utils.all_utils_semseg import load_checkpoint
 from utils.all_utils_landec import init, train_schedule, test_one_set, fast_evaluate, build_lane_detection_model
+from tools.culane_evaluation.fast_culane import evaluate_culane, format_results
+from utils.distributed import init_distributed_mode, get_device, wrap_model, is_main_process
+from utils.quantization import quantize_model
+from utils.inference_optimization import optimize_for_inference
 
 if __name__ == '__main__':
     # Settings
@@ -34,12 +38,49 @@ if __name__ == '__main__':
                         help='input batch size. Recommend 4 times the training batch size in testing (default: 8)')
     parser.add_argument('--mixed-precision', action='store_true', default=False,
                         help='Enable mixed precision training (default: False)')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='Use channels_last (NHWC) memory format for weights & inputs (default: False)')
     parser.add_argument('--continue-from', type=str, default=None,
                         help='Continue training from a previous checkpoint')
     parser.add_argument('--state', type=int, default=0,
                         help='Conduct validation(3)/final test(2)/fast validation(1)/normal training(0) (default: 0)')
     parser.add_argument('--encoder-only', action='store_true', default=False,
                         help='Only train the encoder. ENet trains encoder and decoder separately (default: False)')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Read pre-decoded images from a cache built by tools/build_cache.py (default: None)')
+    parser.add_argument('--batched-augmentation', action='store_true', default=False,
+                        help='Apply training augmentations batch-wise on the training device (default: False)')
+    parser.add_argument('--sync-bn', action='store_true', default=False,
+                        help='Use synchronized BatchNorm in distributed training (CUDA only) (default: False)')
+    parser.add_argument('--scale-lr', action='store_true', default=False,
+                        help='Scale the learning rate linearly by the number of processes in distributed training '
+                             '(default: False)')
+    parser.add_argument('--scnn-engine', type=str, default='loop',
+                        help='SCNN message passing engine, scan/functional give the same results, resa is a '
+                             'parallel variant that needs training (loop/scan/functional/resa) (default: loop)')
+    parser.add_argument('--evaluate', action='store_true', default=False,
+                        help='Evaluate CULane predictions in-process after testing (default: False)')
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help='Also evaluate an int8 post-training quantized model on CPU in fast validation, '
+                             'calibrated on the same images (default: False)')
+    parser.add_argument('--calibration-images', type=int, default=300,
+                        help='Number of images for quantization calibration (default: 300)')
+    parser.add_argument('--optimize', action='store_true', default=False,
+                        help='Fold BatchNorm into convolutions and strip dropout before testing (default: False)')
+    parser.add_argument('--sad-start', type=int, default=0,
+                        help='Training steps before self attention distillation is enabled, '
+                             'SAD is for ERFNet & ENet with --method=sad (default: 0)')
+    parser.add_argument('--sad-weight', type=float, default=0.1,
+                        help='Weight of the self attention distillation loss (default: 0.1)')
+    parser.add_argument('--roi', action='store_true', default=False,
+                        help='Crop the region of interest (CROP_TOP in configs.yaml) before resizing, '
+                             'for both training and testing (default: False)')
+    parser.add_argument('--key-frame-interval', type=int, default=1,
+                        help='Run the deep encoder stage at most every this many video frames, other frames '
+                             'propagate deep features of their key frame, 1: every frame (default: 1)')
+    parser.add_argument('--key-frame-threshold', type=float, default=0.2,
+                        help='A new key frame is taken when the aligned shallow features differ more than this '
+                             '(relative) (default: 0.2)')
     args = parser.parse_args()
     exp_name = str(time.time()) if args.exp_name == '' else args.exp_name
     states = ['train', 'valfast', 'test', 'val']
@@ -54,19 +95,22 @@ if __name__ == '__main__':
     if args.dataset not in configs['LANE_DATASETS'].keys():
         raise ValueError
     num_classes = configs[configs['LANE_DATASETS'][args.dataset]]['NUM_CLASSES']
-    input_sizes = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES']
+    input_sizes = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES_ROI' if args.roi else 'SIZES']
+    crop_top = configs[configs['LANE_DATASETS'][args.dataset]]['CROP_TOP'] if args.roi else 0
     gap = configs[configs['LANE_DATASETS'][args.dataset]]['GAP']
     ppl = configs[configs['LANE_DATASETS'][args.dataset]]['PPL']
     thresh = configs[configs['LANE_DATASETS'][args.dataset]]['THRESHOLD']
     weights = configs[configs['LANE_DATASETS'][args.dataset]]['WEIGHTS']
     base = configs[configs['LANE_DATASETS'][args.dataset]]['BASE_DIR']
-    device = torch.device('cpu')
-    if torch.cuda.is_available():
-        device = torch.device('cuda:0')
-    net = build_lane_detection_model(args, num_classes)
+    # Distributed training if launched by torchrun (1 process per device, --batch-size is per process)
+    _, _, world_size, local_rank = init_distributed_mode() if args.state == 0 else (False, 0, 1, 0)
+    device = get_device(local_rank)
+    net = build_lane_detection_model(args, num_classes, input_size=input_sizes[0] if args.roi else None)
     print(device)
     weights = torch.tensor(weights).to(device)
     net.to(device)
+    net = wrap_model(net, device, sync_bn=args.sync_bn)
+    lr = args.lr * world_size if args.scale_lr else args.lr
     # if args.model == 'scnn':
     #     # Gradient too large after spatial conv
     #     optimizer = torch.optim.SGD([
@@ -76,38 +120,90 @@ if __name__ == '__main__':
     #         {'params': net.aux_head.parameters()},
     #     ], lr=args.lr, momentum=0.9, weight_decay=1e-4)
     # else:
-    optimizer = torch.optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=1e-4)
+    optimizer = torch.optim.SGD(net.parameters(), lr=lr, momentum=0.9, weight_decay=1e-4)
     # optimizer = torch.optim.Adam(net.parameters(), lr=args.lr, betas=(0.9, 0.999),  eps=1e-08, weight_decay=1e-4)
 
     # Testing
     if args.state == 1 or args.state == 2 or args.state == 3:
         data_loader = init(batch_size=args.batch_size, state=args.state, dataset=args.dataset, input_sizes=input_sizes,
-                           mean=mean, std=std, base=base, workers=args.workers)
+                           mean=mean, std=std, base=base, workers=args.workers, cache_dir=args.cache_dir,
+                           crop_top=crop_top)
         load_checkpoint(net=net, optimizer=None, lr_scheduler=None, filename=args.continue_from)
+        if args.optimize:
+            if args.quantize:  # Quantization fuses layers by itself
+                raise ValueError
+            net = optimize_for_inference(net, inplace=True)
         if args.state == 1:  # Validate with mean IoU
+            if args.method == 'lstr':  # No segmentation outputs
+                raise ValueError
             _, x = fast_evaluate(loader=data_loader, device=device, net=net,
                                  num_classes=num_classes, output_size=input_sizes[0],
-                                 is_mixed_precision=args.mixed_precision)
+                                 is_mixed_precision=args.mixed_precision, channels_last=args.channels_last)
             with open('log.txt', 'a') as f:
                 f.write(exp_name + ' validation: ' + str(x) + '\n')
+            if args.quantize:
+                quantize_model(net, loader=data_loader, num_images=args.calibration_images)
+                _, x_int8 = fast_evaluate(loader=data_loader, device=torch.device('cpu'), net=net,
+                                          num_classes=num_classes, output_size=input_sizes[0], is_mixed_precision=False)
+                with open('log.txt', 'a') as f:
+                    f.write(exp_name + ' validation (int8): ' + str(x_int8) + ', delta: ' + str(x_int8 - x) + '\n')
 
         else:  # Test with official scripts later (so just predict lanes here)
-            test_one_set(net=net, device=device, loader=data_loader, is_mixed_precision=args.mixed_precision,
-                         input_sizes=input_sizes, gap=gap, ppl=ppl, thresh=thresh, dataset=args.dataset)
+            if args.key_frame_interval < 1:
+                raise ValueError
+            # With --evaluate on CULane, the key frame pass is compared against a full pass (speed vs F1)
+            compare = args.evaluate and args.dataset == 'culane' and args.key_frame_interval > 1
+            passes = [1, args.key_frame_interval] if compare else [args.key_frame_interval]
+            results = []
+            for interval in passes:
+                time_now = time.time()
+                ratio = test_one_set(net=net, device=device, loader=data_loader,
+                                     is_mixed_precision=args.mixed_precision, input_sizes=input_sizes, gap=gap,
+                                     ppl=ppl, thresh=thresh, dataset=args.dataset,
+                                     channels_last=args.channels_last, key_frame_interval=interval,
+                                     key_frame_threshold=args.key_frame_threshold, crop_top=crop_top,
+                                     method=args.method)
+                seconds = time.time() - time_now
+                print('Testing time: {:.2f}s'.format(seconds))
+                if args.evaluate and args.dataset == 'culane':  # Same as autotest_culane.sh, without the C++ build
+                    res = evaluate_culane(data_dir=base + '/', detect_dir='./output/',
+                                          split='test' if args.state == 2 else 'val', processes=args.workers)
+                    print(format_results(res))
+                    f1 = res['total']['f1'] * 100
+                    results.append((seconds, f1))
+                    with open('log.txt', 'a') as f:
+                        if interval == 1:
+                            f.write(exp_name + ': ' + str(f1) + '\n')
+                        else:
+                            f.write(exp_name + ' (key frames {:.2f}%): '.format(ratio * 100) + str(f1) + '\n')
+            if compare:
+                speedup = results[0][0] / results[1][0]
+                delta = results[1][1] - results[0][1]
+                print('Key frames: {:.2f}x speedup, F1 delta: {:.2f}'.format(speedup, delta))
+                with open('log.txt', 'a') as f:
+                    f.write(exp_name + ' (key frames): speedup: ' + str(speedup) + ', delta: ' + str(delta) + '\n')
     else:
         if args.method == 'scnn' or args.method == 'baseline':
             criterion = LaneLoss(weight=weights, ignore_index=255)
         elif args.method == 'sad':
-            criterion = SADLoss()
-        elif args.method == 'lstr':
-            criterion = HungarianLoss(weight=weights, ignore_index=255)
+            if args.backbone not in ['erfnet', 'enet']:
+                raise ValueError
+            criterion = SADLoss(weight=weights, ignore_index=255, sad_weight=args.sad_weight,
+                                start_step=args.sad_start)
+        elif args.method == 'lstr':  # Online validation is by mean IoU, not available for LSTR
+            if args.val_num_steps > 0:
+                raise ValueError
+            criterion = HungarianLoss()
         else:
             raise ValueError
 
-        writer = SummaryWriter('runs/' + exp_name)
+        writer = SummaryWriter('runs/' + exp_name) if is_main_process() else None
         data_loader, validation_loader = init(batch_size=args.batch_size, state=args.state, dataset=args.dataset,
                                               input_sizes=input_sizes, mean=mean, std=std, base=base,
-                                              workers=args.workers)
+                                              workers=args.workers, cache_dir=args.cache_dir,
+                                              batched_augmentation=args.batched_augmentation, device=device,
+                                              channels_last=args.channels_last, crop_top=crop_top,
+                                              keypoints=args.method == 'lstr')
 
         # Warmup https://github.com/XingangPan/SCNN/issues/82
         # Use it as default also for other methods (for fair comparison)
@@ -127,6 +223,8 @@ if __name__ == '__main__':
                        validation_loader=None if args.val_num_steps == 0 else validation_loader,
                        criterion=criterion, net=net, optimizer=optimizer, lr_scheduler=lr_scheduler, device=device,
                        num_epochs=args.epochs, is_mixed_precision=args.mixed_precision, input_sizes=input_sizes,
-                       exp_name=exp_name, num_classes=num_classes, val_num_steps=args.val_num_steps)
+                       exp_name=exp_name, num_classes=num_classes, val_num_steps=args.val_num_steps,
+                       channels_last=args.channels_last)
 
-        writer.close()
+        if writer is not None:
+            writer.close()
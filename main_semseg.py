@@ -6,6 +6,9 @@ import math
 import yaml
 from torch.utils.tensorboard import SummaryWriter
 from utils.all_utils_semseg import init, train_schedule, test_one_set, load_checkpoint, build_segmentation_model
+from utils.distributed import init_distributed_mode, get_device, wrap_model, is_main_process, synchronize
+from utils.inference_optimization import optimize_for_inference
+from torchvision_models.segmentation import set_activation_checkpointing
 
 if __name__ == '__main__':
     # Settings
@@ -35,12 +38,33 @@ if __name__ == '__main__':
                         help='save model (default: True)')
     parser.add_argument('--mixed-precision', action='store_true', default=False,
                         help='Enable mixed precision training (default: False)')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='Use channels_last (NHWC) memory format for weights & inputs (default: False)')
     parser.add_argument('--continue-from', type=str, default=None,
                         help='Continue training from a previous checkpoint')
     parser.add_argument('--state', type=int, default=0,
                         help='train the whole enet(2)/Conduct final test(1)/normal training(0) (default: 0)')
     parser.add_argument('--encoder-only', action='store_true', default=False,
                         help='Only train the encoder. ENet trains encoder and decoder separately (default: False)')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Read pre-decoded images from a cache built by tools/build_cache.py (default: None)')
+    parser.add_argument('--batched-augmentation', action='store_true', default=False,
+                        help='Apply training augmentations batch-wise on the training device (default: False)')
+    parser.add_argument('--sync-bn', action='store_true', default=False,
+                        help='Use synchronized BatchNorm in distributed training (CUDA only) (default: False)')
+    parser.add_argument('--scale-lr', action='store_true', default=False,
+                        help='Scale the learning rate linearly by the number of processes in distributed training '
+                             '(default: False)')
+    parser.add_argument('--worst-k', type=int, default=0,
+                        help='Print the worst k images by mean IoU when testing (default: 0)')
+    parser.add_argument('--accumulation-steps', type=int, default=1,
+                        help='Number of batches to accumulate gradients for each optimizer step, '
+                             'effective batch size is this x batch size (default: 1)')
+    parser.add_argument('--activation-checkpointing', action='store_true', default=False,
+                        help='Recompute ResNet layer3/layer4 & ASPP activations in backward to save memory '
+                             '(default: False)')
+    parser.add_argument('--optimize', action='store_true', default=False,
+                        help='Fold BatchNorm into convolutions and strip dropout before testing (default: False)')
     args = parser.parse_args()
     exp_name = str(time.time()) if args.exp_name == '' else args.exp_name
     with open(exp_name + '_cfg.txt', 'w') as f:
@@ -76,43 +100,56 @@ if __name__ == '__main__':
         test_label_id_map = configs['CITYSCAPES']['LABEL_ID_MAP']
         classes = 16  # Or 13
         selector = configs['SYNTHIA']['IOU_16']  # Or 13
-    device = torch.device('cpu')
-    if torch.cuda.is_available():
-        device = torch.device('cuda:0')
+    # Distributed training if launched by torchrun (1 process per device, --batch-size is per process)
+    _, _, world_size, local_rank = init_distributed_mode() if args.state != 1 else (False, 0, 1, 0)
+    device = get_device(local_rank)
     net, city_aug, input_sizes, weights = build_segmentation_model(configs, args, num_classes, city_aug, input_sizes)
+    if args.accumulation_steps < 1:
+        raise ValueError
+    if args.activation_checkpointing and set_activation_checkpointing(net) == 0:  # Only ResNet backbones & ASPP
+        raise ValueError
     if weights is not None:
         weights = weights.to(device)
     print(device)
     net.to(device)
+    net = wrap_model(net, device, sync_bn=args.sync_bn)
+    lr = args.lr * world_size if args.scale_lr else args.lr
     if args.model == 'erfnet' or args.model == 'enet':
-        optimizer = torch.optim.Adam(net.parameters(), lr=args.lr, betas=(0.9, 0.999), eps=1e-08,
+        optimizer = torch.optim.Adam(net.parameters(), lr=lr, betas=(0.9, 0.999), eps=1e-08,
                                      weight_decay=args.weight_decay)
     else:
-        optimizer = torch.optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=0.0005)
+        optimizer = torch.optim.SGD(net.parameters(), lr=lr, momentum=0.9, weight_decay=0.0005)
 
     # Testing
     if args.state == 1:
         test_loader = init(batch_size=args.batch_size, state=args.state, dataset=args.dataset, input_sizes=input_sizes,
                            mean=mean, std=std, train_base=train_base, test_base=test_base, city_aug=city_aug,
                            train_label_id_map=train_label_id_map, test_label_id_map=test_label_id_map,
-                           workers=args.workers)
+                           workers=args.workers, cache_dir=args.cache_dir)
         load_checkpoint(net=net, optimizer=None, lr_scheduler=None, filename=args.continue_from)
+        if args.optimize:
+            net = optimize_for_inference(net, inplace=True)
         _, x = test_one_set(loader=test_loader, device=device, net=net, categories=categories, num_classes=num_classes,
                             output_size=input_sizes[2], labels_size=input_sizes[1],
-                            is_mixed_precision=args.mixed_precision, selector=selector, classes=classes)
+                            is_mixed_precision=args.mixed_precision, selector=selector, classes=classes,
+                            worst_k=args.worst_k, channels_last=args.channels_last)
     else:
         criterion = torch.nn.CrossEntropyLoss(ignore_index=255, weight=weights)
-        writer = SummaryWriter('runs/' + exp_name)
+        writer = SummaryWriter('runs/' + exp_name) if is_main_process() else None
         train_loader, val_loader = init(batch_size=args.batch_size, state=args.state, dataset=args.dataset,
                                         input_sizes=input_sizes, mean=mean, std=std, train_base=train_base,
                                         test_base=test_base, city_aug=city_aug, workers=args.workers,
-                                        train_label_id_map=train_label_id_map, test_label_id_map=test_label_id_map)
+                                        train_label_id_map=train_label_id_map, test_label_id_map=test_label_id_map,
+                                        cache_dir=args.cache_dir, batched_augmentation=args.batched_augmentation,
+                                        device=device, channels_last=args.channels_last)
 
         # The "poly" policy, variable names are confusing (May need reimplementation)
+        # Stepped once per optimizer step
+        steps_per_epoch = math.ceil(len(train_loader) / args.accumulation_steps)
         if args.model == 'erfnet':
             # Epoch-wise
             lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer,
-                                                             lambda x: (1 - math.floor(x / len(train_loader))
+                                                             lambda x: (1 - math.floor(x / steps_per_epoch)
                                                                         / args.epochs) ** 0.9)
             # # Original in the paper
             # lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.5)
@@ -121,7 +158,7 @@ if __name__ == '__main__':
         else:
             # Step-wise
             lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer,
-                                                             lambda x: (1 - x / (len(train_loader) * args.epochs))
+                                                             lambda x: (1 - x / (steps_per_epoch * args.epochs))
                                                              ** 0.9)
         # Resume training?
         if args.continue_from is not None and args.state != 2:
@@ -132,22 +169,28 @@ if __name__ == '__main__':
                        num_epochs=args.epochs, is_mixed_precision=args.mixed_precision,
                        validation_loader=val_loader, device=device, criterion=criterion, categories=categories,
                        num_classes=num_classes, input_sizes=input_sizes, val_num_steps=args.val_num_steps,
-                       classes=classes, selector=selector, encoder_only=args.encoder_only)
+                       classes=classes, selector=selector, encoder_only=args.encoder_only,
+                       channels_last=args.channels_last, accumulation_steps=args.accumulation_steps)
 
         # Final evaluations
+        synchronize()  # Wait for the main process to save the best checkpoint
         load_checkpoint(net=net, optimizer=None, lr_scheduler=None, filename='temp.pt')
         _, x = test_one_set(loader=val_loader, device=device, net=net, is_mixed_precision=args.mixed_precision,
                             categories=categories, num_classes=num_classes, labels_size=input_sizes[1],
                             output_size=input_sizes[2], encoder_only=args.encoder_only,
-                            classes=classes, selector=selector)
+                            classes=classes, selector=selector, channels_last=args.channels_last)
 
         # --do-not-save => args.do_not_save = False
-        if args.do_not_save:  # Rename the checkpoint with timestamp
-            os.rename('temp.pt', exp_name + '.pt')
-        else:  # Since the checkpoint is already saved, it should be deleted
-            os.remove('temp.pt')
+        synchronize()
+        if is_main_process():
+            if args.do_not_save:  # Rename the checkpoint with timestamp
+                os.rename('temp.pt', exp_name + '.pt')
+            else:  # Since the checkpoint is already saved, it should be deleted
+                os.remove('temp.pt')
 
-        writer.close()
+        if writer is not None:
+            writer.close()
 
-    with open('log.txt', 'a') as f:
-        f.write(exp_name + ': ' + str(x) + '\n')
+    if is_main_process():
+        with open('log.txt', 'a') as f:
+            f.write(exp_name + ': ' + str(x) + '\n')
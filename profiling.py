@@ -1,8 +1,17 @@
 import yaml
 import argparse
-from utils.all_utils_landec import build_lane_detection_model as build_lane_model
+import json
+from collections import OrderedDict
+from utils.all_utils_landec import build_lane_detection_model as build_lane_model, prob_to_lines_batched, \
+    curves_to_lines_batched
 from utils.all_utils_semseg import build_segmentation_model, load_checkpoint
-from tools.profiling_utils import init_lane, init_seg, speed_evaluate_real, speed_evaluate_simple, model_profile
+from utils.quantization import quantize_model
+from utils.inference_optimization import optimize_for_inference
+from tools.profiling_utils import init_lane, init_seg, speed_evaluate_real, speed_evaluate_simple, model_profile, \
+    spatial_conv_profile, data_pipeline_profile, print_speed_results, optimization_profile, memory_format_profile, \
+    training_profile, matching_profile, lstr_profile
+from tools.export import build_model, get_all_combos
+from torchvision_models.segmentation import set_activation_checkpointing
 import torch
 
 if __name__ == '__main__':
@@ -20,19 +29,60 @@ if __name__ == '__main__':
                         help='backbone selection (erfnet/enet/vgg16/resnet18s/resnet18/resnet34/resnet50/resnet101)'
                              '(default: erfnet)')
     parser.add_argument('--task', type=str, default='lane',
-                        help='task selection (lane/seg)')
+                        help='task selection (lane/seg/scnn/data/memory-format/train/backbones/matching/lstr)')
     parser.add_argument('--mode', type=str, default='simple',
                         help='Profiling mode (simple/real)')
     parser.add_argument('--model', type=str, default='deeplabv3',
                         help='Model selection (fcn/erfnet/deeplabv2/deeplabv3/enet) (default: deeplabv3)')
     parser.add_argument('--times', type=int, default=1,
-                        help='Select test times')
+                        help='Select test times, each time is 300 timed batches (default: 1)')
+    parser.add_argument('--device', type=str, default=None,
+                        help='Profile on cpu/cuda (default: cuda if available)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='Number of intra-op threads on CPU, 0: PyTorch default (default: 0)')
+    parser.add_argument('--interop-threads', type=int, default=0,
+                        help='Number of inter-op threads on CPU, 0: PyTorch default (default: 0)')
     parser.add_argument('--encoder-only', action='store_true', default=False,
                         help='Only train the encoder. ENet trains encoder and decoder separately (default: False)')
     parser.add_argument('--state', type=int, default=1,
                         help='train the whole enet(2)/Conduct final test(1)/normal training(0) (default: 0)')
     parser.add_argument('--continue-from', type=str, default=None,
                         help='Continue training from a previous checkpoint')
+    parser.add_argument('--scnn-engine', type=str, default='loop',
+                        help='SCNN message passing engine (loop/scan/functional/resa) (default: loop)')
+    parser.add_argument('--pipelines', type=str, nargs='+', default=None,
+                        help='Data pipelines to profile, e.g. lane-culane-train city-test (default: all)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4, 8],
+                        help='Numbers of data loader workers to profile (default: 0 2 4 8)')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8],
+                        help='Batch sizes to profile (default: 1 8)')
+    parser.add_argument('--prefetch-factors', type=int, nargs='+', default=[2],
+                        help='Data loader prefetch factors to profile (default: 2)')
+    parser.add_argument('--num-batches', type=int, default=20,
+                        help='Number of timed batches for each data loader setting (default: 20)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Save results as json (default: None)')
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help='Profile the int8 post-training quantized lane detection model (CPU only) '
+                             '(default: False)')
+    parser.add_argument('--calibration-images', type=int, default=300,
+                        help='Number of images for quantization calibration in real mode (default: 300)')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='Use channels_last (NHWC) memory format for weights & inputs (default: False)')
+    parser.add_argument('--mixed-precision', action='store_true', default=False,
+                        help='Enable mixed precision in memory-format/train tasks (CUDA only) (default: False)')
+    parser.add_argument('--accumulation-steps', type=int, nargs='+', default=[1],
+                        help='Gradient accumulation steps to profile in the train task (default: 1)')
+    parser.add_argument('--optimize', action='store_true', default=False,
+                        help='Check parity & latency of the inference-optimized model (BatchNorm folded, no dropout), '
+                             'then profile it (default: False)')
+    parser.add_argument('--backbones', type=str, nargs='+',
+                        default=['enet', 'erfnet', 'resnet18', 'resnet34', 'resnet50', 'resnet101'],
+                        help='Lane detection backbones to compare in the backbones task '
+                             '(default: enet erfnet resnet18 resnet34 resnet50 resnet101)')
+    parser.add_argument('--roi', action='store_true', default=False,
+                        help='Profile the lane model on the region of interest at SIZES_ROI in configs.yaml '
+                             '(overrides --height & --width), FLOPs are compared to the full frame (default: False)')
     args = parser.parse_args()
     lane_need_interpolate = ['vgg16', 'resnet18s', 'resnet18', 'resnet34', 'resnet50', 'resnet101']
     seg_need_interpolate = ['fcn', 'deeplabv2', 'deeplabv3']
@@ -40,64 +90,197 @@ if __name__ == '__main__':
         configs = yaml.load(f, Loader=yaml.Loader)
     mean = configs['GENERAL']['MEAN']
     std = configs['GENERAL']['STD']
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.interop_threads > 0:
+        torch.set_num_interop_threads(args.interop_threads)
+    if args.device is None:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    else:
+        device = torch.device(args.device)
+    results = OrderedDict()
+    optimization = None
+    if args.optimize and args.quantize:  # Quantization fuses layers by itself
+        raise ValueError
     if args.task == 'lane':
         num_classes = configs[configs['LANE_DATASETS'][args.dataset]]['NUM_CLASSES']
+        gap = configs[configs['LANE_DATASETS'][args.dataset]]['GAP']
+        ppl = configs[configs['LANE_DATASETS'][args.dataset]]['PPL']
+        thresh = configs[configs['LANE_DATASETS'][args.dataset]]['THRESHOLD']
+        original_size = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES'][1]
+        crop_top = 0
+        full_macs = None
+        if args.roi:  # Compared with the full frame at the training size
+            full_size = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES'][0]
+            full_macs, _ = model_profile(build_lane_model(args, num_classes).to(device), full_size[0], full_size[1],
+                                         device)
+            args.height, args.width = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES_ROI'][0]
+            crop_top = configs[configs['LANE_DATASETS'][args.dataset]]['CROP_TOP']
         count_interpolate = False
-        if args.backbone in lane_need_interpolate:
+        if args.backbone in lane_need_interpolate and args.method != 'lstr':
             count_interpolate = True
-        if torch.cuda.is_available():
-            device = torch.device('cuda:0')
-        net = build_lane_model(args, num_classes)
+        net = build_lane_model(args, num_classes, input_size=(args.height, args.width) if args.roi else None)
         net.to(device)
         print(device)
         macs, params = model_profile(net, args.height, args.width, device)
         print('FLOPs(G): {: .2f}'.format(2 * macs / 1e9))
+        if full_macs is not None:
+            print('FLOPs(G) of the full frame: {: .2f}, ROI saves {:.2f}%'.format(
+                2 * full_macs / 1e9, (1 - macs / full_macs) * 100))
         print('Number of parameters: {: .2f}'.format(params / 1e6))
         print('Profiling, please clear your GPU memory before doing this.')
+
+        def post(outputs, output):  # Lane decoding (prob_to_lines), timed separately from the network
+            if args.method == 'lstr':  # Sampling points on the curves
+                curves_to_lines_batched(outputs['logits'], outputs['curves'], resize_shape=original_size, gap=gap,
+                                        ppl=ppl, dataset=args.dataset, crop_top=crop_top,
+                                        max_lanes=5 if args.dataset == 'tusimple' else None)
+            else:
+                prob_to_lines_batched(output.softmax(dim=1), outputs['lane'].sigmoid() > 0.5,
+                                      resize_shape=original_size, gap=gap, ppl=ppl, thresh=thresh,
+                                      dataset=args.dataset, crop_top=crop_top)
+
+        if args.quantize and device.type != 'cpu':
+            raise ValueError
         if args.mode == 'simple':
-            dummy = torch.ones((1, 3, args.height, args.width))
-            fps = []
-            for i in range(0, args.inf_times):
-                fps.append(speed_evaluate_simple(net=net, device=device, dummy=dummy, num=300, count_interpolate=True))
-            print('GPU FPS: {: .2f}'.format(max(fps)))
+            if args.quantize:  # Latency only, calibrated on random inputs
+                quantize_model(net, loader=[(torch.randn(1, 3, args.height, args.width), None) for _ in range(4)],
+                               num_images=4)
+            if args.optimize:
+                optimization = optimization_profile(net, device, dummy=torch.randn(1, 3, args.height, args.width),
+                                                    num=100 * args.times)
+                net = optimize_for_inference(net, inplace=True)
+            for batch_size in args.batch_sizes:
+                dummy = torch.ones((batch_size, 3, args.height, args.width))
+                results[batch_size] = speed_evaluate_simple(net=net, device=device, dummy=dummy, num=300 * args.times,
+                                                            count_interpolate=count_interpolate, post_fn=post)
+                print('Batch size {}:'.format(batch_size))
+                print_speed_results(results[batch_size])
         elif args.mode == 'real' and args.dataset in configs['LANE_DATASETS'].keys():
             load_checkpoint(net=net, optimizer=None, lr_scheduler=None, filename=args.continue_from)
             base = configs[configs['LANE_DATASETS'][args.dataset]]['BASE_DIR']
             val_loader = init_lane(dataset=args.dataset, input_sizes=(args.height, args.width), mean=mean, std=std,
-                                   base=base)
-            fps = []
-            gpu_fps = []
-            for i in range(0, args.inf_times):
-                fps_item, gpu_fps_item = speed_evaluate_real(net=net, device=device, loader=val_loader, num=300,
-                                                             count_interpolate=True)
-                fps.append(fps_item)
-                gpu_fps.append(gpu_fps_item)
-            print('Real FPS: {: .2f}'.format(max(fps)))
-            print('GPU FPS: {: .2f}'.format(max(gpu_fps)))
+                                   base=base, crop_top=crop_top)
+            if args.quantize:
+                quantize_model(net, loader=val_loader, num_images=args.calibration_images)
+            if args.optimize:
+                optimization = optimization_profile(net, device, dummy=next(iter(val_loader))[0],
+                                                    num=100 * args.times)
+                net = optimize_for_inference(net, inplace=True)
+            results[1] = speed_evaluate_real(net=net, device=device, loader=val_loader, num=300 * args.times,
+                                             count_interpolate=count_interpolate, post_fn=post)
+            print('Batch size 1:')
+            print_speed_results(results[1])
         else:
             raise ValueError
+    elif args.task == 'scnn':  # SCNN message passing only (equivalence check & latency of each engine)
+        print(device)
+        spatial_conv_profile(device=device, height=args.height, width=args.width, num=300)
+    elif args.task == 'data':  # Data pipelines only, on synthetic data (no dataset or GPU needed)
+        data_pipeline_profile(configs=configs, mean=mean, std=std, pipelines=args.pipelines, workers=args.workers,
+                              batch_sizes=args.batch_sizes, prefetch_factors=args.prefetch_factors,
+                              num_batches=args.num_batches, output_file=args.output)
+    elif args.task == 'memory-format':  # Every model (random weights) in both memory formats, at the dataset sizes
+        print(device)
+        combos = [x for x in get_all_combos(configs) if x['task'] == 'seg' or x['dataset'] == args.dataset]
+        for combo in combos:
+            net, input_size, name = build_model(configs, **combo)
+            results[name] = OrderedDict()
+            for batch_size in args.batch_sizes:
+                print('{}, batch size {}:'.format(name, batch_size))
+                results[name][batch_size] = memory_format_profile(net, device,
+                                                                  dummy=torch.randn(batch_size, 3, *input_size),
+                                                                  num=50 * args.times,
+                                                                  is_mixed_precision=args.mixed_precision)
+            del net
+    elif args.task == 'backbones':  # Lane detection backbones at the dataset's training size (random weights)
+        # SAD only changes training, so ENet-SAD & ERFNet-SAD run at the same speed as ENet & ERFNet
+        num_classes = configs[configs['LANE_DATASETS'][args.dataset]]['NUM_CLASSES']
+        input_size = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES'][0]
+        print(device)
+        for backbone in args.backbones:
+            args.backbone = backbone
+            net = build_lane_model(args, num_classes)
+            net.to(device)
+            macs, params = model_profile(net, input_size[0], input_size[1], device)
+            results[backbone] = OrderedDict([('flops', 2 * macs / 1e9), ('params', params / 1e6)])
+            for batch_size in args.batch_sizes:
+                results[backbone][batch_size] = speed_evaluate_simple(
+                    net=net, device=device, dummy=torch.ones((batch_size, 3, input_size[0], input_size[1])),
+                    num=300 * args.times, count_interpolate=backbone in lane_need_interpolate)
+            del net
+        for batch_size in args.batch_sizes:
+            print('Batch size {}:'.format(batch_size))
+            for backbone in args.backbones:
+                network = results[backbone][batch_size]['network']
+                print('  {}: FLOPs(G) {:.2f}, parameters(M) {:.2f}, p50 {:.2f}ms, {:.2f} samples/s'.format(
+                    backbone, results[backbone]['flops'], results[backbone]['params'], network['p50'],
+                    network['throughput']))
+    elif args.task == 'matching':  # LSTR Hungarian loss at the dataset's input size, max lanes & points per lane
+        input_size = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES'][0]
+        num_points = 56 if args.dataset == 'tusimple' else 31  # Same as the keypoint datasets
+        num_lanes = 5 if args.dataset == 'tusimple' else 4
+        print(device)
+        for batch_size in args.batch_sizes:
+            print('Batch size {}:'.format(batch_size))
+            results[batch_size] = matching_profile(device, batch_size, input_size=input_size, num_lanes=num_lanes,
+                                                   num_points=num_points, num=100 * args.times)
+    elif args.task == 'lstr':  # LSTR eval fast path against the full path (random weights) at the dataset input size
+        args.method = 'lstr'
+        num_classes = configs[configs['LANE_DATASETS'][args.dataset]]['NUM_CLASSES']
+        input_size = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES'][0]
+        net = build_lane_model(args, num_classes)
+        net.to(device)
+        print(device)
+        for batch_size in args.batch_sizes:
+            print('Batch size {}:'.format(batch_size))
+            results[batch_size] = lstr_profile(net, device, dummy=torch.randn(batch_size, 3, *input_size),
+                                               num=100 * args.times)
+    elif args.task == 'train':  # Segmentation training memory & throughput, w/o activation checkpointing
+        num_classes = configs[configs['SEGMENTATION_DATASETS'][args.dataset]]['NUM_CLASSES']
+        print(device)
+        net, _, _, _ = build_segmentation_model(configs, args, num_classes, 0, (args.height, args.width))
+        for checkpointing in [False, True]:
+            if checkpointing and set_activation_checkpointing(net) == 0:  # Only ResNet backbones & ASPP
+                break
+            for accumulation_steps in args.accumulation_steps:
+                for batch_size in args.batch_sizes:  # BatchNorm in training needs batch size > 1
+                    name = 'batch size {} x {}, checkpointing: {}'.format(batch_size, accumulation_steps,
+                                                                          checkpointing)
+                    results[name] = training_profile(net, device, input_size=(args.height, args.width),
+                                                     num_classes=num_classes, batch_size=batch_size,
+                                                     accumulation_steps=accumulation_steps, num=10 * args.times,
+                                                     is_mixed_precision=args.mixed_precision)
+                    if results[name] is None:
+                        print(name + ': out of memory')
+                    else:
+                        print('{}: {:.2f} samples/s, step p50 {:.2f}ms, peak memory: {:.1f}MB'.format(
+                            name, results[name]['throughput'], results[name]['p50'], results[name]['peak_memory']))
     elif args.task == 'seg':
         num_classes = configs[configs['SEGMENTATION_DATASETS'][args.dataset]]['NUM_CLASSES']
         input_sizes = (args.height, args.width)
         city_aug = 0
-        count_interpolate = False
-        if args.backbone in seg_need_interpolate:
-            count_interpolate = True
-        if torch.cuda.is_available():
-            device = torch.device('cuda:0')
         print(device)
         net, city_aug, _, _ = build_segmentation_model(configs, args, num_classes, city_aug, input_sizes)
+        count_interpolate = False
+        if args.model in seg_need_interpolate:
+            count_interpolate = True
         net.to(device)
         macs, params = model_profile(net, args.height, args.width, device)
         print('FLOPs(G): {: .2f}'.format(2 * macs / 1e9))
         print('Number of parameters: {: .2f}'.format(params / 1e6))
         print('Profiling, please clear your GPU memory before doing this.')
         if args.mode == 'simple':
-            dummy = torch.ones((1, 3, args.height, args.width))
-            fps = []
-            for i in range(0, args.inf_times):
-                fps.append(speed_evaluate_simple(net=net, device=device, dummy=dummy, num=300, count_interpolate=True))
-            print('GPU FPS: {: .2f}'.format(max(fps)))
+            if args.optimize:
+                optimization = optimization_profile(net, device, dummy=torch.randn(1, 3, args.height, args.width),
+                                                    num=100 * args.times)
+                net = optimize_for_inference(net, inplace=True)
+            for batch_size in args.batch_sizes:
+                dummy = torch.ones((batch_size, 3, args.height, args.width))
+                results[batch_size] = speed_evaluate_simple(net=net, device=device, dummy=dummy, num=300 * args.times,
+                                                            count_interpolate=count_interpolate)
+                print('Batch size {}:'.format(batch_size))
+                print_speed_results(results[batch_size])
         elif args.mode == 'real' and args.dataset in configs['SEGMENTATION_DATASETS'].keys():
             load_checkpoint(net=net, optimizer=None, lr_scheduler=None, filename=args.continue_from)
             base = configs[configs['SEGMENTATION_DATASETS'][args.dataset]]['BASE_DIR']
@@ -106,14 +289,36 @@ if __name__ == '__main__':
                 configs['CITYSCAPES']['LABEL_ID_MAP']
             val_loader = init_seg(dataset=args.dataset, input_sizes=(args.height, args.width), mean=mean,
                                   std=std, test_base=base, city_aug=city_aug, test_label_id_map=train_label_id_map)
-            fps = []
-            gpu_fps = []
-            for i in range(0, args.inf_times):
-                fps_item, gpu_fps_item = speed_evaluate_real(net=net, device=device, loader=val_loader, num=300,
-                                                             count_interpolate=count_interpolate)
-                fps.append(fps_item)
-                gpu_fps.append(gpu_fps_item)
-            print('Real FPS: {: .2f}'.format(max(fps)))
-            print('GPU FPS: {: .2f}'.format(max(gpu_fps)))
+            if args.optimize:
+                optimization = optimization_profile(net, device, dummy=next(iter(val_loader))[0],
+                                                    num=100 * args.times)
+                net = optimize_for_inference(net, inplace=True)
+            results[1] = speed_evaluate_real(net=net, device=device, loader=val_loader, num=300 * args.times,
+                                             count_interpolate=count_interpolate)
+            print('Batch size 1:')
+            print_speed_results(results[1])
         else:
             raise ValueError
+
+    if args.output is not None and args.task == 'train':
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('device', str(device)), ('model', args.model),
+                                   ('input_size', [args.height, args.width]),
+                                   ('mixed_precision', args.mixed_precision), ('configs', results)]), f, indent=2)
+    elif args.output is not None and args.task == 'backbones':
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('device', str(device)), ('threads', torch.get_num_threads()),
+                                   ('dataset', args.dataset), ('method', args.method), ('backbones', results)]),
+                      f, indent=2)
+    elif args.output is not None and args.task in ['matching', 'lstr']:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('device', str(device)), ('threads', torch.get_num_threads()),
+                                   ('dataset', args.dataset), ('batch_sizes', results)]), f, indent=2)
+    elif args.output is not None and args.task == 'memory-format':
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('device', str(device)), ('threads', torch.get_num_threads()),
+                                   ('mixed_precision', args.mixed_precision), ('models', results)]), f, indent=2)
+    elif args.output is not None and args.task in ['lane', 'seg']:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([('device', str(device)), ('threads', torch.get_num_threads()),
+                                   ('batch_sizes', results), ('optimization', optimization)]), f, indent=2)
@@ -0,0 +1,56 @@
+# Build pre-decoded (and pre-resized) uint8 caches for --cache-dir
+# Run from the project root, e.g.:
+# python -m tools.build_cache --dataset=culane --image-sets train valfast test --cache-dir=data/cache
+import os
+import argparse
+import yaml
+from utils.datasets import StandardLaneDetectionDataset, StandardSegmentationDataset
+from utils.datasets.cache import build_cache
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Auto-drive')
+    parser.add_argument('--dataset', type=str, default='tusimple',
+                        help='tusimple/culane/voc/city/gtav/synthia (default: tusimple)')
+    parser.add_argument('--image-sets', type=str, nargs='+', default=['train'],
+                        help='Image sets to cache (default: train)')
+    parser.add_argument('--cache-dir', type=str, default='data/cache',
+                        help='Cache directory, same as --cache-dir in training/testing (default: data/cache)')
+    parser.add_argument('--size', type=int, nargs=2, default=None,
+                        help='Resize to (h, w) when caching, '
+                             'lane detection defaults to the input size (SIZES[0]), segmentation does not resize')
+    parser.add_argument('--no-resize', action='store_true', default=False,
+                        help='Only pre-decode, keep the original size (default: False)')
+    parser.add_argument('--shard-size', type=float, default=4,
+                        help='Maximum size (GB) of each shard (default: 4)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of decoding processes (default: 8)')
+    args = parser.parse_args()
+    with open('configs.yaml', 'r') as f:  # Safer and cleaner than box/EasyDict
+        configs = yaml.load(f, Loader=yaml.Loader)
+
+    if args.dataset in configs['LANE_DATASETS'].keys():
+        base = configs[configs['LANE_DATASETS'][args.dataset]]['BASE_DIR']
+        size = configs[configs['LANE_DATASETS'][args.dataset]]['SIZES'][0]
+    elif args.dataset in configs['SEGMENTATION_DATASETS'].keys():
+        base = configs[configs['SEGMENTATION_DATASETS'][args.dataset]]['BASE_DIR']
+        size = None
+    else:
+        raise ValueError
+    if args.size is not None:
+        size = args.size
+    if args.no_resize:
+        size = None
+
+    for image_set in args.image_sets:
+        if args.dataset in configs['LANE_DATASETS'].keys():
+            data_set = StandardLaneDetectionDataset(root=base, image_set=image_set, data_set=args.dataset)
+            masks = data_set.masks if data_set.test < 2 else None  # Test sets only have output filenames
+        else:
+            data_set = StandardSegmentationDataset(root=base, image_set=image_set, data_set=args.dataset)
+            masks = data_set.masks if data_set.mask_type == '.png' else None  # .npy masks are not cached
+        cache_dir = os.path.join(args.cache_dir, args.dataset, image_set)
+        build_cache(filenames=data_set.images, root=base, cache_dir=os.path.join(cache_dir, 'images'), size=size,
+                    label=False, shard_size=int(args.shard_size * (1 << 30)), workers=args.workers)
+        if masks is not None:
+            build_cache(filenames=masks, root=base, cache_dir=os.path.join(cache_dir, 'masks'), size=size,
+                        label=True, shard_size=int(args.shard_size * (1 << 30)), workers=args.workers)
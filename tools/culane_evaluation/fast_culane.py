@@ -0,0 +1,268 @@
+# A Python re-implementation of the official CULane evaluation (evaluate + eval.sh + cal_total.py),
+# same spline interpolation, 30px lanes, IoU threshold & KM matching as the C++ code, but:
+# each lane is rasterized once into a cropped bounding-box mask, all pairwise IoUs of an image are computed at once,
+# and images of all splits are evaluated in parallel worker processes, results are returned in memory
+# Usage: python fast_culane.py <data_dir> <detect_dir> <experiment name> [test/val] [number of processes]
+import os
+import cv2
+import numpy as np
+from multiprocessing import Pool
+
+TEST_SPLITS = ['normal', 'crowd', 'hlight', 'shadow', 'noline', 'arrow', 'curve', 'cross', 'night']
+
+
+def get_split_lists(data_dir, split='test'):
+    # Same lists as eval.sh (test) & eval_validation.sh (val)
+    if split == 'test':
+        return {name: data_dir + 'list/test_split/test{}_{}.txt'.format(i, name) for i, name in enumerate(TEST_SPLITS)}
+    elif split == 'val':
+        return {'val': data_dir + 'list/val.txt'}
+    else:
+        raise ValueError
+
+
+def read_lane_file(filename):
+    # Lanes as float32 N x 2 arrays (Point2f), a missing file means no lanes
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as f:
+        lines = f.read().splitlines()
+    lanes = []
+    for line in lines:
+        values = line.split()
+        values = values[:len(values) // 2 * 2]
+        lanes.append(np.array(values, dtype=np.float64).astype(np.float32).reshape(-1, 2))
+
+    return lanes
+
+
+def spline_interp(points, times=50):
+    # Natural cubic spline over the chord length, same as Spline::splineInterpTimes() (2-point lanes are kept as is)
+    n = points.shape[0]
+    if n <= 2:
+        return points
+    p = points.astype(np.float64)
+    diff = p[1:] - p[:-1]
+    h = np.sqrt((diff ** 2).sum(axis=1))
+    slopes = diff / h[:, None]
+    a = h[:-1]
+    b = 2 * (h[:-1] + h[1:])
+    c = h[1:].copy()
+    d = 6 * (slopes[1:] - slopes[:-1])
+
+    # TDMA
+    c[0] = c[0] / b[0]
+    d[0] = d[0] / b[0]
+    for i in range(1, n - 2):
+        temp = b[i] - a[i] * c[i - 1]
+        c[i] = c[i] / temp
+        d[i] = (d[i] - a[i] * d[i - 1]) / temp
+    m = np.zeros((n, 2))
+    m[n - 2] = d[n - 3]
+    for i in range(n - 4, -1, -1):
+        m[i + 1] = d[i] - c[i] * m[i + 2]
+    m[0] = 0
+    m[n - 1] = 0
+
+    # Evaluate all segments at once
+    coef_b = slopes - (2 * h[:, None] * m[:-1] + h[:, None] * m[1:]) / 6
+    coef_c = m[:-1] / 2
+    coef_d = (m[1:] - m[:-1]) / (6 * h[:, None])
+    t = (h[:, None] / times) * np.arange(times)[None, :]  # (n - 1) x times
+    t = t[:, :, None]
+    res = p[:-1, None, :] + coef_b[:, None, :] * t + coef_c[:, None, :] * t ** 2 + coef_d[:, None, :] * t ** 3
+
+    return np.concatenate([res.reshape(-1, 2).astype(np.float32), points[-1:]], axis=0)
+
+
+def rasterize(lane, width, im_size):
+    # Draw a lane as in LaneCompare::get_lane_similarity(), but only on its bounding box (clipped to the image)
+    # Returns (mask, (y0, x0)) or None for invalid/invisible lanes
+    if lane.shape[0] < 2:
+        return None
+    points = spline_interp(lane)
+    points = points[np.isfinite(points).all(axis=1)]
+    if points.shape[0] < 2:
+        return None
+    points = np.rint(points).astype(np.int64)  # cvRound()
+    h, w = im_size
+    pad = width // 2 + 2
+    x0 = max(int(points[:, 0].min()) - pad, 0)
+    y0 = max(int(points[:, 1].min()) - pad, 0)
+    x1 = min(int(points[:, 0].max()) + pad + 1, w)
+    y1 = min(int(points[:, 1].max()) + pad + 1, h)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    points = (points - np.array([x0, y0])).tolist()
+    for i in range(len(points) - 1):
+        cv2.line(mask, tuple(points[i]), tuple(points[i + 1]), 1, width)
+
+    return mask, (y0, x0)
+
+
+def pairwise_iou(anno_masks, detect_masks):
+    # IoU of all anno x detect lane pairs in 1 matrix product on the union bounding box
+    iou = np.zeros((len(anno_masks), len(detect_masks)), dtype=np.float64)
+    anno_ids = [i for i, x in enumerate(anno_masks) if x is not None]
+    detect_ids = [i for i, x in enumerate(detect_masks) if x is not None]
+    if len(anno_ids) == 0 or len(detect_ids) == 0:
+        return iou
+    valid = [anno_masks[i] for i in anno_ids] + [detect_masks[i] for i in detect_ids]
+    y0 = min(o[0] for _, o in valid)
+    x0 = min(o[1] for _, o in valid)
+    y1 = max(o[0] + m.shape[0] for m, o in valid)
+    x1 = max(o[1] + m.shape[1] for m, o in valid)
+    canvas = np.zeros((len(valid), y1 - y0, x1 - x0), dtype=np.float32)
+    for i, (m, o) in enumerate(valid):
+        canvas[i, o[0] - y0: o[0] - y0 + m.shape[0], o[1] - x0: o[1] - x0 + m.shape[1]] = m
+    canvas = canvas.reshape(len(valid), -1)
+    anno = canvas[:len(anno_ids)]
+    detect = canvas[len(anno_ids):]
+    inter = anno @ detect.T
+    union = anno.sum(axis=1)[:, None] + detect.sum(axis=1)[None, :] - inter
+    iou[np.ix_(anno_ids, detect_ids)] = inter / union
+
+    return iou
+
+
+def km_match(similarity):
+    # Same KM algorithm (and tie-breaking) as pipartiteGraph in hungarianGraph.hpp,
+    # returns the matched detection index (or -1) for each annotation
+    m, n = similarity.shape
+    exchanged = m > n
+    mat = (similarity.T if exchanged else similarity).tolist()
+    if exchanged:
+        m, n = n, m
+    left_match = [-1] * m
+    right_match = [-1] * n
+    right_weight = [0.] * n
+    left_weight = [max([-1e5] + row) for row in mat]
+
+    def dfs(u, left_used, right_used):
+        left_used[u] = True
+        for v in range(n):
+            if not right_used[v] and abs(left_weight[u] + right_weight[v] - mat[u][v]) < 1e-2:
+                right_used[v] = True
+                if right_match[v] == -1 or dfs(right_match[v], left_used, right_used):
+                    right_match[v] = u
+                    left_match[u] = v
+                    return True
+        return False
+
+    for u in range(m):
+        while True:
+            left_used = [False] * m
+            right_used = [False] * n
+            if dfs(u, left_used, right_used):
+                break
+            d = 1e10
+            for i in range(m):
+                if left_used[i]:
+                    for j in range(n):
+                        if not right_used[j]:
+                            d = min(d, left_weight[i] + right_weight[j] - mat[i][j])
+            if d == 1e10:
+                return right_match if exchanged else left_match
+            for i in range(m):
+                if left_used[i]:
+                    left_weight[i] -= d
+            for j in range(n):
+                if right_used[j]:
+                    right_weight[j] += d
+
+    return right_match if exchanged else left_match
+
+
+def count_im_pair(anno_lanes, detect_lanes, width, iou_threshold, im_size):
+    # tp, fp, fn of 1 image, same as Counter::count_im_pair()
+    if len(anno_lanes) == 0:
+        return 0, len(detect_lanes), 0
+    if len(detect_lanes) == 0:
+        return 0, 0, len(anno_lanes)
+    similarity = pairwise_iou([rasterize(x, width, im_size) for x in anno_lanes],
+                              [rasterize(x, width, im_size) for x in detect_lanes])
+    anno_match = km_match(similarity)
+    tp = sum(1 for i, j in enumerate(anno_match) if j >= 0 and similarity[i, j] > iou_threshold)
+
+    return tp, len(detect_lanes) - tp, len(anno_lanes) - tp
+
+
+def _count_images(args):
+    split_name, filenames, data_dir, detect_dir, width, iou_threshold, im_size = args
+    tp, fp, fn = 0, 0, 0
+    for filename in filenames:
+        txt_name = filename[:filename.rfind('.')] + '.lines.txt'
+        res = count_im_pair(read_lane_file(data_dir + txt_name), read_lane_file(detect_dir + txt_name),
+                            width, iou_threshold, im_size)
+        tp += res[0]
+        fp += res[1]
+        fn += res[2]
+
+    return split_name, tp, fp, fn
+
+
+def get_scores(tp, fp, fn):
+    # Same as Counter::get_precision/get_recall (-1 without detections/ground truth) and the Fmeasure in evaluate.cpp
+    # (unguarded division, e.g. -1 if both are -1, nan if both are 0)
+    precision = tp / (tp + fp) if tp + fp > 0 else -1.
+    recall = tp / (tp + fn) if tp + fn > 0 else -1.
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall != 0 else float('nan')
+
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'precision': precision, 'recall': recall, 'f1': f1}
+
+
+def evaluate_culane(data_dir, detect_dir='./output/', split='test', processes=None, width=30, iou_threshold=0.5,
+                    im_size=(590, 1640), chunk_size=256):
+    # Arguments: data_dir/detect_dir are prefixes of the list entries (same as -a/-d in eval.sh, end with /)
+    # Return: {split name: {tp, fp, fn, precision, recall, f1}} with an extra 'total' entry (summed counts)
+    split_lists = get_split_lists(data_dir, split)
+    jobs = []
+    for name, list_file in split_lists.items():
+        with open(list_file, 'r') as f:
+            filenames = [x for x in f.read().splitlines() if x != '']
+        jobs += [(name, filenames[i: i + chunk_size], data_dir, detect_dir, width, iou_threshold, im_size)
+                 for i in range(0, len(filenames), chunk_size)]
+
+    # Chunks of all splits share 1 pool for load balancing, counts are reduced per split
+    if processes is None:
+        processes = os.cpu_count()
+    if processes > 1 and len(jobs) > 1:
+        with Pool(processes=processes) as pool:
+            counts = pool.map(_count_images, jobs)
+    else:
+        counts = [_count_images(x) for x in jobs]
+    totals = {name: [0, 0, 0] for name in split_lists.keys()}
+    for name, tp, fp, fn in counts:
+        totals[name][0] += tp
+        totals[name][1] += fp
+        totals[name][2] += fn
+    results = {name: get_scores(*x) for name, x in totals.items()}
+    results['total'] = get_scores(*[sum(x[i] for x in totals.values()) for i in range(3)])
+
+    return results
+
+
+def format_results(results):
+    # Similar to the official per-split output files
+    return ''.join(['{}\ntp: {} fp: {} fn: {}\nprecision: {}\nrecall: {}\nFmeasure: {}\n\n'.format(
+        name, x['tp'], x['fp'], x['fn'], x['precision'], x['recall'], x['f1']) for name, x in results.items()])
+
+
+if __name__ == '__main__':
+    # args: data_dir, detect_dir, experiment name, [test/val], [number of processes]
+    import sys
+    if len(sys.argv) not in [4, 5, 6]:
+        sys.exit('Invalid input arguments')
+    split = sys.argv[4] if len(sys.argv) >= 5 else 'test'
+    res = evaluate_culane(data_dir=sys.argv[1], detect_dir=sys.argv[2], split=split,
+                          processes=int(sys.argv[5]) if len(sys.argv) == 6 else None)
+    print(format_results(res))
+    f1 = res['total']['f1'] * 100
+    print('F1 score: ' + str(f1))
+    os.makedirs('./output', exist_ok=True)
+    with open('./output/' + sys.argv[3] + '_iou0.5_' + ('split' if split == 'test' else 'validation') + '.txt',
+              'w') as f:
+        f.write(format_results(res))
+    with open('../../log.txt', 'a') as f:
+        f.write(sys.argv[3] + ': ' + str(f1) + '\n')
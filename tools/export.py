@@ -0,0 +1,227 @@
+# Export lane detection & segmentation models to TorchScript (traced) and ONNX with fixed input shapes,
+# check numerical parity against eager mode on random inputs and compare CPU latency
+# Run from the project root, e.g.:
+# python -m tools.export --task=lane --dataset=culane --backbone=erfnet --method=scnn
+# python -m tools.export --all
+import os
+import time
+import json
+import yaml
+import argparse
+from argparse import Namespace
+from collections import OrderedDict
+import torch
+from utils.all_utils_landec import build_lane_detection_model
+from utils.all_utils_semseg import build_segmentation_model, load_checkpoint
+from torchvision_models.lane_detection import set_spatial_conv_engine
+from torchvision_models.transformer import set_fused_attention
+from tools.profiling_utils import latency_stats
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+LANE_BACKBONES = ['erfnet', 'enet', 'vgg16', 'resnet18', 'resnet34', 'resnet50', 'resnet101']
+LANE_METHODS = ['baseline', 'scnn']
+SEG_MODELS = ['fcn', 'erfnet', 'deeplabv2', 'deeplabv3', 'enet']
+
+
+class ExportWrapper(torch.nn.Module):
+    # Dict outputs (with optional keys) -> a tuple in a fixed key order, for both TorchScript and ONNX
+    def __init__(self, net, output_names):
+        super().__init__()
+        self.net = net
+        self.output_names = output_names
+
+    def forward(self, x):
+        outputs = self.net(x)
+
+        return tuple([outputs[k] for k in self.output_names])
+
+
+def build_model(configs, task, dataset, backbone=None, method='baseline', model=None, encoder_only=False,
+                continue_from=None):
+    # Return: (model in eval mode on CPU, fixed input size (H, W), name)
+    if task == 'lane':
+        if dataset not in configs['LANE_DATASETS'].keys():
+            raise ValueError
+        args = Namespace(dataset=dataset, backbone=backbone, method=method, encoder_only=encoder_only,
+                         continue_from=None, scnn_engine='loop', channels_last=False)
+        net = build_lane_detection_model(args, configs[configs['LANE_DATASETS'][dataset]]['NUM_CLASSES'])
+        input_size = configs[configs['LANE_DATASETS'][dataset]]['SIZES'][0]
+        name = '_'.join(['lane', dataset, backbone, method])
+    elif task == 'seg':
+        if dataset not in configs['SEGMENTATION_DATASETS'].keys():
+            raise ValueError
+        args = Namespace(model=model, encoder_only=encoder_only, continue_from=None, state=1, channels_last=False)
+        net, city_aug, input_sizes, _ = build_segmentation_model(
+            configs, args, configs[configs['SEGMENTATION_DATASETS'][dataset]]['NUM_CLASSES'], 0,
+            configs[configs['SEGMENTATION_DATASETS'][dataset]]['SIZES'])
+        input_size = input_sizes[0] if city_aug == 2 else input_sizes[2]  # Testing input size
+        name = '_'.join(['seg', dataset, model])
+    else:
+        raise ValueError
+    if continue_from is not None:
+        load_checkpoint(net=net, optimizer=None, lr_scheduler=None, filename=continue_from)
+    net.eval()
+
+    return net, tuple(input_size), name
+
+
+def export_torchscript(wrapper, dummy, filename, meta):
+    # Traced with the fixed input shape, meta is saved as config.json in the archive
+    traced = torch.jit.trace(wrapper, dummy, check_trace=False)
+    torch.jit.save(traced, filename, _extra_files={'config.json': json.dumps(meta)})
+
+    return traced
+
+
+def export_onnx(wrapper, dummy, filename, output_names, opset_version=11):
+    torch.onnx.export(wrapper, dummy, filename, input_names=['input'], output_names=output_names,
+                      opset_version=opset_version, do_constant_folding=True)
+
+
+def max_abs_diff(reference, outputs):
+    return max([(torch.as_tensor(y).float() - x.float()).abs().max().item() for x, y in zip(reference, outputs)])
+
+
+def cpu_latency(fn, num=50, warmup=5):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(num):
+        time_now = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - time_now)
+
+    return latency_stats(times, batch_size=1)
+
+
+def export_one(net, input_size, name, save_dir, mean, std, formats=('torchscript', 'onnx'), atol=1e-4, num=50,
+               seed=0):
+    # Export 1 model (on CPU, batch size 1), check parity and latency of each format against eager mode
+    # Return: {format: {'file', 'max_abs_diff', 'parity', 'latency'}}
+    torch.manual_seed(seed)
+    dummy = torch.randn(1, 3, *input_size)
+    results = OrderedDict()
+    with torch.no_grad():
+        reference = net(dummy.clone())  # The loop SCNN engine works in place
+        output_names = list(reference.keys())
+        reference = [reference[k] for k in output_names]
+        results['eager'] = OrderedDict([('latency', cpu_latency(lambda: net(dummy.clone()), num=num))])
+
+    # Traceable SCNN (same weights & results), LSTR attention without the fused kernel (not in ONNX opset 11)
+    set_spatial_conv_engine(net, engine='functional')
+    set_fused_attention(net, enabled=False)
+    wrapper = ExportWrapper(net, output_names).eval()
+    meta = OrderedDict([('name', name), ('input_size', [1, 3] + list(input_size)), ('output_names', output_names),
+                        ('mean', mean), ('std', std)])
+    os.makedirs(save_dir, exist_ok=True)
+    with torch.no_grad():
+        if 'torchscript' in formats:
+            filename = os.path.join(save_dir, name + '.pt')
+            traced = export_torchscript(wrapper, dummy, filename, meta)
+            traced = torch.jit.load(filename)
+            diff = max_abs_diff(reference, traced(dummy))
+            results['torchscript'] = OrderedDict([('file', filename), ('max_abs_diff', diff), ('parity', diff <= atol),
+                                                  ('latency', cpu_latency(lambda: traced(dummy), num=num))])
+        if 'onnx' in formats:
+            filename = os.path.join(save_dir, name + '.onnx')
+            export_onnx(wrapper, dummy, filename, output_names)
+            results['onnx'] = OrderedDict([('file', filename)])
+            if onnxruntime is None:
+                print('onnxruntime is not installed, skipped parity & latency checks for ONNX.')
+            else:
+                session = onnxruntime.InferenceSession(filename)
+                inputs = {'input': dummy.numpy()}
+                diff = max_abs_diff(reference, session.run(output_names, inputs))
+                results['onnx']['max_abs_diff'] = diff
+                results['onnx']['parity'] = diff <= atol
+                results['onnx']['latency'] = cpu_latency(lambda: session.run(output_names, inputs), num=num)
+
+    return results
+
+
+def print_export_results(name, results):
+    print(name + ':')
+    for k, v in results.items():
+        info = ['{}: '.format(k)]
+        if 'max_abs_diff' in v.keys():
+            info.append('max abs diff {:.3e} ({}), '.format(v['max_abs_diff'], 'ok' if v['parity'] else 'FAILED'))
+        if 'latency' in v.keys():
+            info.append('mean {:.2f}ms, p50 {:.2f}ms, p90 {:.2f}ms'.format(
+                v['latency']['mean'], v['latency']['p50'], v['latency']['p90']))
+        print('  ' + ''.join(info))
+
+
+def get_all_combos(configs):
+    # Every backbone/method combination with segmentation outputs (export LSTR separately by --method=lstr)
+    combos = [dict(task='lane', dataset=d, backbone=b, method=m)
+              for d in configs['LANE_DATASETS'].keys() for b in LANE_BACKBONES for m in LANE_METHODS
+              if not (b == 'enet' and m == 'scnn')]  # No SCNN for ENet
+    combos += [dict(task='seg', dataset='city', model=m) for m in SEG_MODELS]
+
+    return combos
+
+
+if __name__ == '__main__':
+    # Settings
+    parser = argparse.ArgumentParser(description='PyTorch Auto-drive')
+    parser.add_argument('--task', type=str, default='lane',
+                        help='task selection (lane/seg) (default: lane)')
+    parser.add_argument('--dataset', type=str, default='tusimple',
+                        help='Input size & number of classes of this dataset (default: tusimple)')
+    parser.add_argument('--method', type=str, default='baseline',
+                        help='Lane detection method selection (lstr/scnn/sad/baseline) (default: baseline)')
+    parser.add_argument('--backbone', type=str, default='erfnet',
+                        help='Lane detection backbone selection '
+                             '(erfnet/enet/vgg16/resnet18/resnet34/resnet50/resnet101) (default: erfnet)')
+    parser.add_argument('--model', type=str, default='deeplabv3',
+                        help='Segmentation model selection (fcn/erfnet/deeplabv2/deeplabv3/enet) (default: deeplabv3)')
+    parser.add_argument('--encoder-only', action='store_true', default=False,
+                        help='Only the ENet encoder (default: False)')
+    parser.add_argument('--continue-from', type=str, default=None,
+                        help='Checkpoint to export (default: None, random weights)')
+    parser.add_argument('--all', action='store_true', default=False,
+                        help='Export every backbone/method combination with random weights (default: False)')
+    parser.add_argument('--formats', type=str, nargs='+', default=['torchscript', 'onnx'],
+                        help='Export formats (default: torchscript onnx)')
+    parser.add_argument('--save-dir', type=str, default='./output/export',
+                        help='Directory for exported models (default: ./output/export)')
+    parser.add_argument('--atol', type=float, default=1e-4,
+                        help='Maximum absolute difference to eager outputs (default: 1e-4)')
+    parser.add_argument('--times', type=int, default=50,
+                        help='Number of timed runs on CPU (default: 50)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='Number of intra-op threads on CPU, 0: PyTorch default (default: 0)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Save results as json (default: None)')
+    args = parser.parse_args()
+    if any(x not in ['torchscript', 'onnx'] for x in args.formats):
+        raise ValueError
+    with open('configs.yaml', 'r') as f:  # Safer and cleaner than box/EasyDict
+        configs = yaml.load(f, Loader=yaml.Loader)
+    mean = configs['GENERAL']['MEAN']
+    std = configs['GENERAL']['STD']
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    if args.all:
+        combos = get_all_combos(configs)
+    else:
+        combos = [dict(task=args.task, dataset=args.dataset, backbone=args.backbone, method=args.method,
+                       model=args.model, encoder_only=args.encoder_only, continue_from=args.continue_from)]
+    all_results = OrderedDict()
+    for combo in combos:
+        net, input_size, name = build_model(configs, **combo)
+        all_results[name] = export_one(net, input_size, name, save_dir=args.save_dir, mean=mean, std=std,
+                                       formats=args.formats, atol=args.atol, num=args.times)
+        print_export_results(name, all_results[name])
+
+    failed = [k for k, v in all_results.items() if any(not x.get('parity', True) for x in v.values())]
+    print('{}/{} models exported with parity.'.format(len(all_results) - len(failed), len(all_results)))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(all_results, f, indent=2)
+    if len(failed) > 0:
+        raise RuntimeError('Parity check failed: ' + ', '.join(failed))
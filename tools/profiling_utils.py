@@ -1,17 +1,32 @@
-import torch
+import io
+import json
 import time
+import resource
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch.cuda.amp import autocast, GradScaler
+from PIL import Image
 from tqdm import tqdm
 from utils.datasets import StandardLaneDetectionDataset
-from transforms import ToTensor, Normalize, Resize, Compose, ZeroPad, LabelMap
+from transforms import ToTensor, Normalize, Resize, CropTop, Compose, ZeroPad, LabelMap
 from utils.datasets import StandardSegmentationDataset
 from thop import profile
+from torchvision_models.lane_detection import SpatialConv, RESA
+from torchvision_models.transformer import set_fused_attention
+from utils.all_utils_landec import build_transforms as build_lane_transforms
+from utils.all_utils_semseg import build_transforms as build_seg_transforms
+from utils.inference_optimization import optimize_for_inference, max_output_diff
+from utils.memory_format import to_channels_last
+from utils.losses.hungarian_loss import HungarianLoss, linear_sum_assignment
 
 
-def init_lane(input_sizes, dataset, mean, std, base, workers=0):
+def init_lane(input_sizes, dataset, mean, std, base, workers=0, crop_top=0):
+    crop = [CropTop(top=crop_top)] if crop_top > 0 else []
     transforms_test = Compose(
-        [Resize(size_image=input_sizes, size_label=input_sizes),
-         ToTensor(),
-         Normalize(mean=mean, std=std)])
+        crop + [Resize(size_image=input_sizes, size_label=input_sizes),
+                ToTensor(),
+                Normalize(mean=mean, std=std)])
     validation_set = StandardLaneDetectionDataset(root=base, image_set='val', transforms=transforms_test,
                                                   data_set=dataset)
     validation_loader = torch.utils.data.DataLoader(dataset=validation_set, batch_size=1, num_workers=workers,
@@ -51,67 +66,143 @@ def init_seg(input_sizes, std, mean, dataset, test_base=None, test_label_id_map=
     return val_loader
 
 
-def speed_evaluate_real(net, device, loader, num, count_interpolate=True):
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.current_stream(device).synchronize()
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def get_peak_memory(device):
+    # Peak memory (MB): allocated by PyTorch on CUDA, or resident set size of this process on CPU
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    else:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def latency_stats(times, batch_size):
+    # times: per-batch latencies (seconds)
+    # Return: mean/p50/p90/p99 latency (ms) & throughput (samples/s)
+    times = np.array(times) * 1000
+    return OrderedDict([
+        ('mean', float(times.mean())),
+        ('p50', float(np.percentile(times, 50))),
+        ('p90', float(np.percentile(times, 90))),
+        ('p99', float(np.percentile(times, 99))),
+        ('throughput', float(batch_size * 1000 * len(times) / times.sum()))
+    ])
+
+
+def _timed(fn, device):
+    _synchronize(device)
+    temp = time.perf_counter()
+    res = fn()
+    _synchronize(device)
+
+    return res, time.perf_counter() - temp
+
+
+def speed_evaluate_real(net, device, loader, num, count_interpolate=True, post_fn=None):
+    # Per-batch timing of loading (I/O), the network & post-processing (post_fn(outputs, resized logits), optional)
+    # on any device, return latency stats of each stage
     net.eval()
     iterable = iter(loader)
 
+    def forward(image):
+        outputs = net(image)
+        output = outputs.get('out')  # None for LSTR
+        if count_interpolate and output is not None:
+            output = torch.nn.functional.interpolate(output, size=image.shape[-2:], mode='bilinear',
+                                                     align_corners=True)
+        return outputs, output
+
     # Warm-up hardware
     with torch.no_grad():
         for _ in range(10):
             image, _ = iterable.__next__()
             image = image.to(device)
-            _ = net(image)['out']
+            _ = forward(image)
 
     # Timing with loading images from disk
-    gpu_time = 0
-    io_time = 0
+    io_times = []
+    network_times = []
+    post_times = []
+    reset_peak_memory(device)
     with torch.no_grad():
         for _ in tqdm(range(num)):
-            # I/O
-            torch.cuda.current_stream(device).synchronize()
-            temp = time.perf_counter()
-            image, _ = iterable.__next__()
-            image = image.to(device)
-            torch.cuda.current_stream(device).synchronize()
-            io_time += (time.perf_counter() - temp)
-
-            # GPU
-            torch.cuda.current_stream(device).synchronize()
-            temp = time.perf_counter()
-            output = net(image)['out']
-            if count_interpolate:
-                _ = torch.nn.functional.interpolate(output, size=image.shape[-2:], mode='bilinear', align_corners=True)
-            torch.cuda.current_stream(device).synchronize()
-            gpu_time += (time.perf_counter() - temp)
+            (image, _), t = _timed(lambda: iterable.__next__(), device)
+            image, t_copy = _timed(lambda: image.to(device), device)
+            io_times.append(t + t_copy)
+            (outputs, output), t = _timed(lambda: forward(image), device)
+            network_times.append(t)
+            if post_fn is not None:
+                _, t = _timed(lambda: post_fn(outputs, output), device)
+                post_times.append(t)
 
-    fps = num / (io_time + gpu_time)
-    gpu_fps = num / gpu_time
+    batch_size = image.shape[0]
+    results = OrderedDict([('io', latency_stats(io_times, batch_size)),
+                           ('network', latency_stats(network_times, batch_size))])
+    if post_fn is not None:
+        results['post'] = latency_stats(post_times, batch_size)
+    results['total'] = latency_stats(np.sum([io_times, network_times] + ([post_times] if post_fn is not None else []),
+                                            axis=0), batch_size)
+    results['peak_memory'] = get_peak_memory(device)
 
-    return fps, gpu_fps
+    return results
 
 
-def speed_evaluate_simple(net, device, dummy, num, count_interpolate=True):
+def speed_evaluate_simple(net, device, dummy, num, count_interpolate=True, post_fn=None):
+    # Per-batch timing of the network & post-processing (post_fn(outputs, resized logits), optional)
+    # with a fixed input on any device, return latency stats of each stage
     net.eval()
     dummy = dummy.to(device)
     output_size = dummy.shape[-2:]
 
+    def forward():
+        outputs = net(dummy)
+        output = outputs.get('out')  # None for LSTR
+        if count_interpolate and output is not None:
+            output = torch.nn.functional.interpolate(output, size=output_size, mode='bilinear', align_corners=True)
+        return outputs, output
+
     # Warm-up hardware
     with torch.no_grad():
         for i in range(0, 10):
-            _ = net(dummy)['out']
+            _ = forward()
 
     # Timing
-    torch.cuda.current_stream(device).synchronize()
-    t_start = time.perf_counter()
+    network_times = []
+    post_times = []
+    reset_peak_memory(device)
     with torch.no_grad():
         for _ in tqdm(range(num)):
-            output = net(dummy)['out']
-            if count_interpolate:
-                _ = torch.nn.functional.interpolate(output, size=output_size, mode='bilinear', align_corners=True)
-    torch.cuda.current_stream(device).synchronize()
-    fps_gpu = num / (time.perf_counter() - t_start)
+            (outputs, output), t = _timed(forward, device)
+            network_times.append(t)
+            if post_fn is not None:
+                _, t = _timed(lambda: post_fn(outputs, output), device)
+                post_times.append(t)
+
+    batch_size = dummy.shape[0]
+    results = OrderedDict([('network', latency_stats(network_times, batch_size))])
+    if post_fn is not None:
+        results['post'] = latency_stats(post_times, batch_size)
+        results['total'] = latency_stats(np.add(network_times, post_times), batch_size)
+    results['peak_memory'] = get_peak_memory(device)
+
+    return results
 
-    return fps_gpu
+
+def print_speed_results(results):
+    for stage, v in results.items():
+        if stage == 'peak_memory':
+            print('  peak memory: {:.1f}MB'.format(v))
+        else:
+            print('  {}: mean {:.2f}ms, p50 {:.2f}ms, p90 {:.2f}ms, p99 {:.2f}ms, {:.2f} samples/s'.format(
+                stage, v['mean'], v['p50'], v['p90'], v['p99'], v['throughput']))
 
 
 def model_profile(net, height, width, device):
@@ -120,3 +211,369 @@ def model_profile(net, height, width, device):
 
     return macs, params
 
+
+def optimization_profile(net, device, dummy, num=100, atol=1e-4):
+    # Parity (max abs diff of all outputs) & network latency of optimize_for_inference() copies against eager mode,
+    # with and without channels_last
+    net.eval()
+    dummy = dummy.to(device)
+    variants = [('eager', net),
+                ('optimized', optimize_for_inference(net)),
+                ('optimized (channels_last)', optimize_for_inference(net, channels_last=True))]
+    results = OrderedDict()
+    with torch.no_grad():
+        reference = net(dummy.clone())
+        for name, module in variants:
+            diff = max_output_diff(module(dummy.clone()), reference)
+            for _ in range(10):
+                module(dummy)
+            times = [_timed(lambda: module(dummy), device)[1] for _ in range(num)]
+            results[name] = OrderedDict([('max_abs_diff', diff), ('parity', diff <= atol),
+                                         ('latency', latency_stats(times, dummy.shape[0]))])
+            print('{}: max abs diff {:.3e} ({}), mean {:.2f}ms, p50 {:.2f}ms, p90 {:.2f}ms'.format(
+                name, diff, 'ok' if diff <= atol else 'FAILED', results[name]['latency']['mean'],
+                results[name]['latency']['p50'], results[name]['latency']['p90']))
+
+    return results
+
+
+def memory_format_profile(net, device, dummy, num=50, is_mixed_precision=False):
+    # Network latency & throughput of 1 model (same weights) in contiguous (NCHW) then channels_last (NHWC) format,
+    # mixed precision only applies on CUDA
+    net.to(device)
+    results = OrderedDict()
+    for name in ['contiguous', 'channels_last']:
+        if name == 'channels_last':
+            to_channels_last(net)
+        with autocast(is_mixed_precision):
+            results[name] = speed_evaluate_simple(net=net, device=device, dummy=dummy, num=num,
+                                                  count_interpolate=False)['network']
+    results['speedup'] = results['channels_last']['throughput'] / results['contiguous']['throughput']
+    print('  contiguous: {:.2f} samples/s, channels_last: {:.2f} samples/s, speedup: {:.2f}x'.format(
+        results['contiguous']['throughput'], results['channels_last']['throughput'], results['speedup']))
+
+    return results
+
+
+def training_profile(net, device, input_size, num_classes, batch_size, accumulation_steps=1, num=10,
+                     is_mixed_precision=False):
+    # Segmentation training steps (forward, backward & SGD step) on random inputs & labels,
+    # each step accumulates gradients of accumulation_steps batches
+    # Return: step latency stats, throughput (samples/s) & peak memory, or None if out of memory
+    net.to(device)
+    net.train()
+    optimizer = torch.optim.SGD(net.parameters(), lr=1e-6, momentum=0.9)
+    criterion = torch.nn.CrossEntropyLoss(ignore_index=255)
+    scaler = GradScaler(enabled=is_mixed_precision)
+    images = torch.randn(batch_size, 3, *input_size, device=device)
+    labels = torch.randint(0, num_classes, (batch_size, *input_size), device=device)
+
+    def step():
+        for _ in range(accumulation_steps):
+            with autocast(is_mixed_precision):
+                outputs = torch.nn.functional.interpolate(net(images)['out'], size=input_size, mode='bilinear',
+                                                          align_corners=True)
+                loss = criterion(outputs, labels)
+            scaler.scale(loss / accumulation_steps).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+
+    try:
+        for _ in range(2):  # Warm-up
+            step()
+        reset_peak_memory(device)
+        times = [_timed(step, device)[1] for _ in range(num)]
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        optimizer.zero_grad()
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+        return None
+    results = latency_stats(times, batch_size * accumulation_steps)
+    results['peak_memory'] = get_peak_memory(device)
+
+    return results
+
+
+def lstr_profile(net, device, dummy, num=100, atol=1e-4):
+    # Parity (max abs diff of logits & curves) & network latency of the LSTR eval fast path (cached position
+    # embeddings without masks, last decoder layer only, fused attention) against the full path
+    # (zero padding masks, all decoder layers & auxiliary heads, nn.MultiheadAttention)
+    net.eval()
+    dummy = dummy.to(device)
+    masks = torch.zeros((dummy.shape[0], *dummy.shape[-2:]), dtype=torch.bool, device=device)
+    variants = [('full', False, lambda: net._train(dummy, masks)),
+                ('fast', True, lambda: net(dummy))]
+    results = OrderedDict()
+    outputs = {}
+    with torch.no_grad():
+        for name, fused, fn in variants:
+            set_fused_attention(net, fused)
+            outputs[name] = fn()
+            for _ in range(10):
+                fn()
+            times = [_timed(fn, device)[1] for _ in range(num)]
+            results[name] = OrderedDict([('latency', latency_stats(times, dummy.shape[0]))])
+    set_fused_attention(net, True)
+    diff = max_output_diff(outputs['fast'], outputs['full'])
+    results['max_abs_diff'] = diff
+    results['parity'] = diff <= atol
+    results['speedup'] = results['full']['latency']['mean'] / results['fast']['latency']['mean']
+    for name, _, _ in variants:
+        print('  {}: mean {:.2f}ms, p50 {:.2f}ms, p90 {:.2f}ms, {:.2f} samples/s'.format(
+            name, results[name]['latency']['mean'], results[name]['latency']['p50'],
+            results[name]['latency']['p90'], results[name]['latency']['throughput']))
+    print('  max abs diff {:.3e} ({}), speedup: {:.2f}x'.format(diff, 'ok' if diff <= atol else 'FAILED',
+                                                              results['speedup']))
+
+    return results
+
+
+def matching_profile(device, batch_size, input_size=(360, 640), num_queries=7, num_lanes=5, num_points=56, num=100):
+    # LSTR Hungarian loss (matching & losses of 1 decoder layer) on random outputs & keypoints, with the on-device
+    # exhaustive search and the Hungarian algorithm (scipy on CPU), both are optimal so losses should be the same
+    # Return: latency stats of each solver & the max loss difference
+    torch.manual_seed(0)
+    logits = torch.randn(batch_size, num_queries, 2, device=device)
+    curves = torch.rand(batch_size, num_queries, 8, device=device)
+    curves[..., 3] -= 2  # f'' away from the image rows
+    xs = torch.rand(batch_size, num_lanes, num_points) * input_size[1]
+    xs[torch.rand(batch_size, num_lanes, num_points) < 0.2] = -2
+    ys = torch.linspace(input_size[0] / 2, input_size[0] - 1, num_points).expand(batch_size, num_lanes, num_points)
+    targets = torch.stack([xs, ys], dim=-1).to(device)
+    lane_existence = (torch.rand(batch_size, num_lanes) < 0.8).float().to(device)
+    criterion = HungarianLoss()
+    lanes = criterion.prepare_targets(targets, lane_existence, input_size)
+    solvers = [('device', criterion.max_permutations)]
+    if linear_sum_assignment is None:
+        print('scipy is not installed, skipped the Hungarian algorithm.')
+    else:
+        solvers.append(('scipy', 0))
+    results = OrderedDict()
+    losses = []
+    with torch.no_grad():
+        for name, max_permutations in solvers:
+            criterion.max_permutations = max_permutations
+            for _ in range(10):
+                criterion.set_loss(logits, curves, *lanes)
+            losses.append(criterion.set_loss(logits, curves, *lanes).item())
+            times = [_timed(lambda: criterion.set_loss(logits, curves, *lanes), device)[1] for _ in range(num)]
+            results[name] = latency_stats(times, batch_size)
+            print('  {}: mean {:.2f}ms, p50 {:.2f}ms, p90 {:.2f}ms, {:.2f} samples/s'.format(
+                name, results[name]['mean'], results[name]['p50'], results[name]['p90'],
+                results[name]['throughput']))
+    if len(losses) > 1:
+        results['max_loss_diff'] = max(losses) - min(losses)
+        print('  max loss difference: {:.3e}'.format(results['max_loss_diff']))
+
+    return results
+
+
+def spatial_conv_profile(device, height, width, num_channels=128, batch_size=1, num=100, rtol=1e-4, atol=1e-5):
+    # SCNN message passing engines at the feature map size (1/8 of the input size)
+    # Check scan & functional against the original loop (outputs & gradients, asserted), then time all engines
+    loop = SpatialConv(num_channels=num_channels, engine='loop').to(device)
+    scan = SpatialConv(num_channels=num_channels, engine='scan').to(device)
+    scan.load_state_dict(loop.state_dict())
+    functional = SpatialConv(num_channels=num_channels, engine='functional').to(device)
+    functional.load_state_dict(loop.state_dict())
+    resa = RESA(num_channels=num_channels).to(device)
+    x = torch.randn(batch_size, num_channels, height // 8, width // 8, device=device)
+
+    # Equivalence
+    x_loop = x.clone().requires_grad_()
+    y_loop = loop(x_loop.clone())
+    y_loop.sum().backward()
+    for name, module in [('scan', scan), ('functional', functional)]:
+        x_engine = x.clone().requires_grad_()
+        y_engine = module(x_engine.clone())
+        y_engine.sum().backward()
+        pairs = [('output', y_loop, y_engine), ('input gradient', x_loop.grad, x_engine.grad)] + \
+            [('gradient of ' + k, a.grad, b.grad) for (k, a), b in zip(loop.named_parameters(), module.parameters())]
+        for item, a, b in pairs:
+            assert torch.allclose(a, b, rtol=rtol, atol=atol), \
+                '{} differs from loop ({}), max abs diff: {:.3e}'.format(name, item, (a - b).abs().max().item())
+    print('scan & functional match loop (outputs & gradients, rtol={}, atol={})'.format(rtol, atol))
+
+    # Latency
+    times = {}
+    with torch.no_grad():
+        for name, module in [('loop', loop), ('scan', scan), ('functional', functional), ('resa', resa)]:
+            for _ in range(10):
+                module(x.clone())
+            _synchronize(device)
+            t_start = time.perf_counter()
+            for _ in range(num):
+                module(x.clone())
+            _synchronize(device)
+            times[name] = (time.perf_counter() - t_start) / num * 1000
+            print('{}: {:.3f}ms'.format(name, times[name]))
+
+    return times
+
+
+class SyntheticDataset(torch.utils.data.Dataset):
+    # Smooth random images & labels encoded in memory (JPEG/PNG, so decoding is still timed),
+    # outputs are the same as the real datasets, depending on target:
+    # mask: (image, mask), lane: (image, mask, lane existence), filename: (image, output filename)
+    def __init__(self, image_size, transforms=None, target='mask', num_labels=34, variable_size=False,
+                 length=100000, pool_size=8, seed=0):
+        self.transforms = transforms
+        self.target = target
+        self.num_labels = num_labels
+        self.length = length
+        self.images = []
+        self.masks = []
+        rng = np.random.RandomState(seed)
+        for _ in range(pool_size):
+            h, w = image_size
+            if variable_size:  # e.g. PASCAL VOC, sizes up to image_size
+                h, w = rng.randint(h // 2, h + 1), rng.randint(w // 2, w + 1)
+            image = rng.randint(0, 256, (h // 16 + 1, w // 16 + 1, 3), dtype=np.uint8)
+            self.images.append(self._encode(Image.fromarray(image).resize((w, h), Image.BILINEAR), 'JPEG'))
+            mask = rng.randint(0, num_labels, (h // 32 + 1, w // 32 + 1), dtype=np.uint8)
+            self.masks.append(self._encode(Image.fromarray(mask).resize((w, h), Image.NEAREST), 'PNG'))
+
+    @staticmethod
+    def _encode(image, image_format):
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format)
+
+        return buffer.getvalue()
+
+    def __getitem__(self, index):
+        i = index % len(self.images)
+        img = Image.open(io.BytesIO(self.images[i])).convert('RGB')
+        if self.target == 'filename':
+            target = 'synthetic_{}.lines.txt'.format(index)
+        else:
+            target = Image.open(io.BytesIO(self.masks[i]))
+
+        # Transforms
+        if self.transforms is not None:
+            img, target = self.transforms(img, target)
+        if self.target == 'lane':
+            return img, target, torch.ones(self.num_labels - 1)
+        else:
+            return img, target
+
+    def __len__(self):
+        return self.length
+
+
+def get_data_pipelines(configs, mean, std):
+    # All init() pipelines: name -> (transforms, original image size, target type, number of labels, variable size)
+    pipelines = OrderedDict()
+    for dataset in configs['LANE_DATASETS'].keys():
+        dataset_configs = configs[configs['LANE_DATASETS'][dataset]]
+        train, test = build_lane_transforms(input_sizes=dataset_configs['SIZES'], mean=mean, std=std)
+        pipelines['lane-' + dataset + '-train'] = (train, dataset_configs['SIZES'][1], 'lane',
+                                                   dataset_configs['NUM_CLASSES'], False)
+        pipelines['lane-' + dataset + '-test'] = (test, dataset_configs['SIZES'][1], 'filename',
+                                                  dataset_configs['NUM_CLASSES'], False)
+
+    city_map = configs['CITYSCAPES']['LABEL_ID_MAP']
+    city_size = (1024, 2048)
+    seg_settings = [  # name, dataset, city_aug, input sizes, train image size, train label id map
+        ('voc', 'voc', 0, configs['PASCAL_VOC']['SIZES'], (500, 500), city_map),
+        ('city', 'city', 0, configs['CITYSCAPES']['SIZES'], city_size, city_map),
+        ('city-big', 'city', 1, configs['CITYSCAPES']['SIZES_BIG'], city_size, city_map),
+        ('city-erfnet', 'city', 2, configs['CITYSCAPES']['SIZES_ERFNET'], city_size, city_map),
+        ('gtav', 'gtav', 3, configs['GTAV']['SIZES'], (1052, 1914), city_map),
+        ('synthia', 'synthia', 3, configs['SYNTHIA']['SIZES'], (760, 1280), configs['SYNTHIA']['LABEL_ID_MAP'])
+    ]
+    for name, dataset, city_aug, input_sizes, image_size, train_label_id_map in seg_settings:
+        train, test = build_seg_transforms(dataset=dataset, input_sizes=input_sizes, mean=mean, std=std,
+                                           city_aug=city_aug, train_label_id_map=train_label_id_map,
+                                           test_label_id_map=city_map)
+        num_labels = 21 if dataset == 'voc' else len(train_label_id_map)
+        pipelines[name + '-train'] = (train, image_size, 'mask', num_labels, dataset == 'voc')
+        # Tested on the Cityscapes validation set except for VOC
+        pipelines[name + '-test'] = (test, image_size if dataset == 'voc' else city_size, 'mask',
+                                     num_labels if dataset == 'voc' else len(city_map), dataset == 'voc')
+
+    return pipelines
+
+
+def transform_profile(data_set, transforms, num=50):
+    # Average CPU time (ms) of decoding & each transform in a Compose (single process)
+    times = OrderedDict([('decode', 0.)] + [('{}: {}'.format(i, type(t).__name__), 0.)
+                                            for i, t in enumerate(transforms.transforms)])
+    keys = list(times.keys())
+    original = data_set.transforms
+    data_set.transforms = None
+    for index in range(num):
+        temp = time.perf_counter()
+        sample = data_set[index]
+        times['decode'] += time.perf_counter() - temp
+        image, target = sample[0], sample[1]
+        for key, t in zip(keys[1:], transforms.transforms):
+            temp = time.perf_counter()
+            image, target = t(image, target)
+            times[key] += time.perf_counter() - temp
+    data_set.transforms = original
+
+    return OrderedDict((k, v / num * 1000) for k, v in times.items())
+
+
+def loader_profile(data_set, workers, batch_size, pin_memory, prefetch_factor, num_batches=20):
+    # Samples/sec of a DataLoader, after the first batch (worker start-up excluded)
+    kwargs = {'prefetch_factor': prefetch_factor} if workers > 0 else {}
+    loader = torch.utils.data.DataLoader(dataset=data_set, batch_size=batch_size, num_workers=workers,
+                                         shuffle=False, pin_memory=pin_memory, drop_last=True, **kwargs)
+    iterable = iter(loader)
+    next(iterable)
+    temp = time.perf_counter()
+    for _ in range(num_batches):
+        next(iterable)
+    samples_per_sec = num_batches * batch_size / (time.perf_counter() - temp)
+    del iterable
+
+    return samples_per_sec
+
+
+def data_pipeline_profile(configs, mean, std, pipelines=None, workers=(0, 2, 4, 8), batch_sizes=(1, 8),
+                          prefetch_factors=(2,), num_batches=20, output_file=None):
+    # Throughput of all (or selected) init() pipelines on synthetic data, without any model,
+    # swept over worker counts, batch sizes, pin_memory & prefetch factors (pin_memory only with CUDA)
+    all_pipelines = get_data_pipelines(configs, mean, std)
+    if pipelines is None:
+        pipelines = list(all_pipelines.keys())
+    pin_memory_options = [False, True] if torch.cuda.is_available() else [False]
+    results = OrderedDict([
+        ('torch', torch.__version__),
+        ('num_threads', torch.get_num_threads()),
+        ('cuda', torch.cuda.is_available()),
+        ('pipelines', OrderedDict())
+    ])
+    for name in pipelines:
+        if name not in all_pipelines.keys():
+            raise ValueError('Unknown pipeline: {}, choose from {}'.format(name, list(all_pipelines.keys())))
+        transforms, image_size, target, num_labels, variable_size = all_pipelines[name]
+        data_set = SyntheticDataset(image_size=image_size, transforms=transforms, target=target,
+                                    num_labels=num_labels, variable_size=variable_size)
+        print(name)
+        transform_times = transform_profile(data_set, transforms)
+        for k, v in transform_times.items():
+            print('  {}: {:.3f}ms'.format(k, v))
+        loader_results = []
+        for w in workers:
+            for b in batch_sizes:
+                for p in pin_memory_options:
+                    for f in (prefetch_factors if w > 0 else [None]):
+                        samples_per_sec = loader_profile(data_set, workers=w, batch_size=b, pin_memory=p,
+                                                         prefetch_factor=f, num_batches=num_batches)
+                        loader_results.append(OrderedDict([('workers', w), ('batch_size', b), ('pin_memory', p),
+                                                           ('prefetch_factor', f),
+                                                           ('samples_per_sec', samples_per_sec)]))
+                        print('  workers={}, batch_size={}, pin_memory={}, prefetch_factor={}: {:.2f} samples/s'
+                              .format(w, b, p, f, samples_per_sec))
+        results['pipelines'][name] = OrderedDict([('transforms_ms', transform_times), ('loaders', loader_results)])
+
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
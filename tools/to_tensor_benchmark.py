@@ -0,0 +1,47 @@
+# Per-sample CPU time of ToTensor + Normalize vs the fused ToTensorNormalize (single thread, as in a loader worker)
+# Run from the project root, e.g.:
+# python -m tools.to_tensor_benchmark --height=288 --width=800
+import argparse
+import time
+import numpy as np
+import torch
+from PIL import Image
+from transforms import ToTensor, Normalize, ToTensorNormalize, Compose
+
+
+def benchmark(transform, image, times):
+    for _ in range(10):  # Warm up
+        transform(image, 'dummy')
+    time_now = time.perf_counter()
+    for _ in range(times):
+        transform(image, 'dummy')
+
+    return (time.perf_counter() - time_now) / times * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Auto-drive')
+    parser.add_argument('--height', type=int, default=288,
+                        help='Image height (default: 288)')
+    parser.add_argument('--width', type=int, default=800,
+                        help='Image width (default: 800)')
+    parser.add_argument('--times', type=int, default=200,
+                        help='Number of runs (default: 200)')
+    args = parser.parse_args()
+    torch.set_num_threads(1)
+    mean = [0.485, 0.456, 0.406]
+    std = [0.229, 0.224, 0.225]
+    image = Image.fromarray(np.random.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8))
+
+    transforms = {
+        'ToTensor + Normalize': Compose([ToTensor(), Normalize(mean=mean, std=std)]),
+        'ToTensorNormalize': ToTensorNormalize(mean=mean, std=std),
+        'ToTensorNormalize (channels last)': ToTensorNormalize(mean=mean, std=std, channels_last=True),
+        'ToTensorNormalize (channels last, half)': ToTensorNormalize(mean=mean, std=std, channels_last=True,
+                                                                     half=True)
+    }
+    reference = transforms['ToTensor + Normalize'](image, 'dummy')[0]
+    for name, transform in transforms.items():
+        t = benchmark(transform, image, args.times)
+        diff = (transform(image, 'dummy')[0].float() - reference).abs().max().item()
+        print('{}: {:.3f}ms/sample, max abs diff: {:.6f}'.format(name, t, diff))
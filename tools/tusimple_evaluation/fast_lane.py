@@ -0,0 +1,140 @@
+# A vectorized & parallel re-implementation of LaneEval (lane.py) with the same Accuracy/FP/FN,
+# also saves a per-frame table for error analysis
+# Usage: python fast_lane.py <pred filename> <gt filename> <experiment name> [number of processes]
+import os
+import numpy as np
+import ujson as json
+from multiprocessing import Pool
+
+
+class FastLaneEval(object):
+    pixel_thresh = 20
+    pt_thresh = 0.85
+
+    @staticmethod
+    def get_angles(gt, y_samples):
+        # Closed-form least squares slope of x = k * y + b for each lane (L x N), 0 if less than 2 valid points
+        valid = gt >= 0
+        n = valid.sum(axis=1)
+        ys = np.broadcast_to(y_samples, gt.shape)
+        count = np.maximum(n, 1)
+        y_mean = (ys * valid).sum(axis=1) / count
+        x_mean = (gt * valid).sum(axis=1) / count
+        dy = (ys - y_mean[:, None]) * valid
+        dx = (gt - x_mean[:, None]) * valid
+        var = (dy * dy).sum(axis=1)
+        k = np.divide((dy * dx).sum(axis=1), var, out=np.zeros_like(var), where=var > 0)
+
+        return np.where(n > 1, np.arctan(k), 0.)
+
+    @staticmethod
+    def bench(pred, gt, y_samples, running_time):
+        # Return accuracy, fp, fn & accuracy of each gt lane
+        if any(len(p) != len(y_samples) for p in pred):
+            raise Exception('Format of lanes error.')
+        if running_time > 200 or len(gt) + 2 < len(pred):
+            return 0., 0., 1., []
+        y_samples = np.array(y_samples, dtype=np.float64)
+        pred = np.array(pred, dtype=np.float64).reshape(len(pred), len(y_samples))
+        gt = np.array(gt, dtype=np.float64).reshape(len(gt), len(y_samples))
+        threshs = FastLaneEval.pixel_thresh / np.cos(FastLaneEval.get_angles(gt, y_samples))
+
+        # All gt x pred pairs at once (G x P x N), invalid points are -100 (so invalid-invalid pairs match)
+        pred = np.where(pred >= 0, pred, -100)
+        gt = np.where(gt >= 0, gt, -100)
+        hits = np.where(np.abs(pred[None, :, :] - gt[:, None, :]) < threshs[:, None, None], 1., 0.)
+        accs = np.sum(hits, axis=-1) / len(y_samples)
+        line_accs = accs.max(axis=1) if pred.shape[0] > 0 else np.zeros(gt.shape[0])
+        line_accs = line_accs.tolist()
+
+        fn = float(sum(1 for x in line_accs if x < FastLaneEval.pt_thresh))
+        matched = len(line_accs) - fn
+        fp = len(pred) - matched
+        if len(gt) > 4 and fn > 0:
+            fn -= 1
+        s = sum(line_accs)
+        if len(gt) > 4:
+            s -= min(line_accs)
+        return s / max(min(4.0, len(gt)), 1.), fp / len(pred) if len(pred) > 0 else 0., \
+            fn / max(min(len(gt), 4.), 1.), line_accs
+
+    @staticmethod
+    def _bench_frames(frames):
+        results = []
+        for pred, gt in frames:
+            try:
+                a, p, n, line_accs = FastLaneEval.bench(pred['lanes'], gt['lanes'], gt['h_samples'], pred['run_time'])
+            except Exception as e:
+                raise Exception('Format of lanes error.') from e
+            results.append((pred['raw_file'], len(gt['lanes']), len(pred['lanes']), a, p, n, line_accs))
+
+        return results
+
+    @staticmethod
+    def bench_one_submit(pred_file, gt_file, processes=None, table_file=None):
+        try:
+            json_pred = [json.loads(line) for line in open(pred_file).readlines()]
+        except Exception as e:
+            raise Exception('Fail to load json file of the prediction.') from e
+        json_gt = [json.loads(line) for line in open(gt_file).readlines()]
+        if len(json_gt) != len(json_pred):
+            raise Exception('We do not get the predictions of all the test tasks')
+        gts = {l['raw_file']: l for l in json_gt}
+        frames = []
+        for pred in json_pred:
+            if 'raw_file' not in pred or 'lanes' not in pred or 'run_time' not in pred:
+                raise Exception('raw_file or lanes or run_time not in some predictions.')
+            if pred['raw_file'] not in gts:
+                raise Exception('Some raw_file from your predictions do not exist in the test tasks.')
+            frames.append((pred, gts[pred['raw_file']]))
+
+        # Shard frames across processes, results are gathered (and summed) in the original order
+        if processes is None:
+            processes = os.cpu_count()
+        shard_size = max(1, -(-len(frames) // (processes * 4)))
+        shards = [frames[i: i + shard_size] for i in range(0, len(frames), shard_size)]
+        if processes > 1 and len(shards) > 1:
+            with Pool(processes=processes) as pool:
+                results = [x for shard in pool.map(FastLaneEval._bench_frames, shards) for x in shard]
+        else:
+            results = FastLaneEval._bench_frames(frames)
+        accuracy, fp, fn = 0., 0., 0.
+        for _, _, _, a, p, n, _ in results:
+            accuracy += a
+            fp += p
+            fn += n
+
+        if table_file is not None:
+            with open(table_file, 'w') as f:
+                f.write('raw_file,num_gt,num_pred,accuracy,fp,fn,lane_accuracies\n')
+                f.writelines(['{},{},{},{},{},{},{}\n'.format(x[0], x[1], x[2], x[3], x[4], x[5],
+                                                              ' '.join(['{:.4f}'.format(y) for y in x[6]]))
+                              for x in results])
+
+        num = len(gts)
+        # the first return parameter is the default ranking parameter
+        return json.dumps([
+            {'name': 'Accuracy', 'value': accuracy / num, 'order': 'desc'},
+            {'name': 'FP', 'value': fp / num, 'order': 'asc'},
+            {'name': 'FN', 'value': fn / num, 'order': 'asc'}
+        ])
+
+
+if __name__ == '__main__':
+    # args: pred filename, gt filename, experiment name, [number of processes]
+    import sys
+    try:
+        if len(sys.argv) not in [4, 5]:
+            raise Exception('Invalid input arguments')
+        results = FastLaneEval.bench_one_submit(sys.argv[1], sys.argv[2],
+                                                processes=int(sys.argv[4]) if len(sys.argv) == 5 else None,
+                                                table_file='./output/' + sys.argv[3] + '_frames.csv')
+        print(results)
+        acc = json.loads(results)[0]['value']
+        with open('../../log.txt', 'a') as f:
+            f.write(sys.argv[3] + ': ' + str(acc) + '\n')
+        with open('./output/' + sys.argv[3] + '.json', 'w') as f:
+            f.write(results)
+    except Exception as e:
+        print(e)
+        sys.exit(str(e))
@@ -92,6 +92,10 @@ def simple_segmentation_transform(images, resize_shape, mean, std, dataset='voc'
 
 
 def simple_lane_detection_transform(images, resize_shape, mean, std):
-    # Assume images in B x C x H x W
+    # Assume images in B x C x H x W (uint8 images are converted to [0.0, 1.0])
     # resize_shape: list[int]
-    pass
+    if images.dtype == torch.uint8:
+        images = images.float().div_(255.0)
+    images = F.resize(images, resize_shape, interpolation=Image.LINEAR)
+
+    return F.normalize(images, mean=mean, std=std)
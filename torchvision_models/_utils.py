@@ -2,6 +2,7 @@ from collections import OrderedDict
 
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 
 class IntermediateLayerGetter(nn.ModuleDict):
@@ -60,3 +61,26 @@ class IntermediateLayerGetter(nn.ModuleDict):
                 out_name = self.return_layers[name]
                 out[out_name] = x
         return out
+
+
+def checkpoint_module(module, fn, x):
+    # torch.utils.checkpoint on fn(x) (usually module._forward), which runs again in backward,
+    # BatchNorm running statistics of module are restored after the recomputation (only updated once per step)
+    recompute = [False]
+
+    def run(inputs):
+        if not recompute[0]:  # The original forward pass
+            recompute[0] = True
+            return fn(inputs)
+        bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+        saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in bns]
+        try:  # The recomputation could also be stopped early by an exception
+            return fn(inputs)
+        finally:
+            with torch.no_grad():
+                for m, (mean, var, num) in zip(bns, saved):
+                    m.running_mean.copy_(mean)
+                    m.running_var.copy_(var)
+                    m.num_batches_tracked.copy_(num)
+
+    return checkpoint(run, x)
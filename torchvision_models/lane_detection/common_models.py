@@ -29,6 +29,9 @@ class SCNNDecoder(nn.Module):
 
         return x
 
+    def fuse_model(self):
+        torch.quantization.fuse_modules(self, [['conv1', 'bn1']], inplace=True)
+
 
 # Reduce channel (typically to 128)
 class RESAReducer(nn.Module):
@@ -44,16 +47,24 @@ class RESAReducer(nn.Module):
 
         return x
 
+    def fuse_model(self):
+        torch.quantization.fuse_modules(self, [['conv1', 'bn1']], inplace=True)
+
 
 # SCNN head
 class SpatialConv(nn.Module):
-    def __init__(self, num_channels=128):
+    # engine: loop (original per-slice conv2d) / scan (same weights & results, contiguous conv1d scan in TorchScript) /
+    # functional (same weights & results, out-of-place, can be traced for TorchScript/ONNX export)
+    def __init__(self, num_channels=128, engine='loop'):
         super().__init__()
         self.conv_d = nn.Conv2d(num_channels, num_channels, (1, 9), padding=(0, 4))
         self.conv_u = nn.Conv2d(num_channels, num_channels, (1, 9), padding=(0, 4))
         self.conv_r = nn.Conv2d(num_channels, num_channels, (9, 1), padding=(4, 0))
         self.conv_l = nn.Conv2d(num_channels, num_channels, (9, 1), padding=(4, 0))
         self._adjust_initializations(num_channels=num_channels)
+        if engine not in ['loop', 'scan', 'functional']:
+            raise ValueError
+        self.engine = engine
 
     def _adjust_initializations(self, num_channels=128):
         # https://github.com/XingangPan/SCNN/issues/82
@@ -64,6 +75,11 @@ class SpatialConv(nn.Module):
         nn.init.uniform_(self.conv_l.weight, -bound, bound)
 
     def forward(self, input):
+        if self.engine == 'scan':
+            return self.forward_scan(input)
+        elif self.engine == 'functional':
+            return self.forward_functional(input)
+
         output = input
 
         # First one remains unchanged (according to the original paper), why not add a relu afterwards?
@@ -83,6 +99,113 @@ class SpatialConv(nn.Module):
 
         return output
 
+    def forward_scan(self, input):
+        # Same recurrence, but slices are stored as a contiguous leading dimension (S x B x C x L),
+        # so each step is a conv1d on a dense slice (no strided column views),
+        # and the scan runs in TorchScript (no Python per slice)
+        # Slices can't be batched: each one needs the ReLU output of the previous one (not associative, so no
+        # parallel prefix scan), use RESA for parallel updates
+        # Down & Up: H x B x C x W
+        output = input.permute(2, 0, 1, 3).contiguous()
+        output = _scan(output, self.conv_d.weight.squeeze(2), self.conv_d.bias, False)
+        output = _scan(output, self.conv_u.weight.squeeze(2), self.conv_u.bias, True)
+        # Right & Left: W x B x C x H
+        output = output.permute(3, 1, 2, 0).contiguous()
+        output = _scan(output, self.conv_r.weight.squeeze(3), self.conv_r.bias, False)
+        output = _scan(output, self.conv_l.weight.squeeze(3), self.conv_l.bias, True)
+
+        # Back to the memory format of the input (e.g. channels_last)
+        memory_format = torch.channels_last if not input.is_contiguous() and \
+            input.is_contiguous(memory_format=torch.channels_last) else torch.contiguous_format
+
+        return output.permute(1, 2, 3, 0).contiguous(memory_format=memory_format)
+
+    def forward_functional(self, input):
+        # Same recurrence, slices are updated out of place and concatenated in the end,
+        # so tracing works (unrolled for a fixed input shape) and the input is not modified
+        output = input
+        for conv, dim, reverse in [(self.conv_d, 2, False), (self.conv_u, 2, True),
+                                   (self.conv_r, 3, False), (self.conv_l, 3, True)]:
+            slices = list(output.split(1, dim=dim))
+            if reverse:
+                for i in range(len(slices) - 2, 0, -1):
+                    slices[i] = slices[i] + F.relu(conv(slices[i + 1]))
+            else:
+                for i in range(1, len(slices)):
+                    slices[i] = slices[i] + F.relu(conv(slices[i - 1]))
+            output = torch.cat(slices, dim=dim)
+
+        return output
+
+
+@torch.jit.script
+def _scan(x: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor, reverse: bool) -> torch.Tensor:
+    # Sequential message passing over the leading dimension of x (S x B x C x L), same order as SpatialConv
+    padding = weight.shape[-1] // 2
+    if reverse:
+        for i in range(x.shape[0] - 2, 0, -1):
+            x[i].add_(torch.conv1d(x[i + 1], weight, bias, 1, padding).relu_())
+    else:
+        for i in range(1, x.shape[0]):
+            x[i].add_(torch.conv1d(x[i - 1], weight, bias, 1, padding).relu_())
+
+    return x
+
+
+# RESA (Recurrent Feature-Shift Aggregator, https://arxiv.org/abs/2008.13719)
+# A parallel alternative to SpatialConv: each iteration updates all rows/columns at once,
+# with features shifted by H / 2^k (W / 2^k) in a circular way, so it only takes 4 x iterations steps,
+# not weight-compatible with SpatialConv
+class RESA(nn.Module):
+    def __init__(self, num_channels=128, iterations=4, alpha=2.0):
+        super().__init__()
+        self.iterations = iterations
+        self.alpha = alpha
+        self.convs = nn.ModuleDict()
+        for i in range(iterations):
+            self.convs['d' + str(i)] = nn.Conv2d(num_channels, num_channels, (1, 9), padding=(0, 4), bias=False)
+            self.convs['u' + str(i)] = nn.Conv2d(num_channels, num_channels, (1, 9), padding=(0, 4), bias=False)
+            self.convs['r' + str(i)] = nn.Conv2d(num_channels, num_channels, (9, 1), padding=(4, 0), bias=False)
+            self.convs['l' + str(i)] = nn.Conv2d(num_channels, num_channels, (9, 1), padding=(4, 0), bias=False)
+        bound = math.sqrt(2.0 / (num_channels * 9 * 5))
+        for conv in self.convs.values():
+            nn.init.uniform_(conv.weight, -bound, bound)
+
+    def forward(self, input):
+        output = input
+        h, w = output.shape[2:]
+        for direction, size, dim in [('d', h, 2), ('u', h, 2), ('r', w, 3), ('l', w, 3)]:
+            for i in range(self.iterations):
+                stride = size // 2 ** (self.iterations - i)
+                if direction in ['d', 'r']:
+                    indices = (torch.arange(size, device=output.device) + stride) % size
+                else:
+                    indices = (torch.arange(size, device=output.device) - stride) % size
+                output = output + self.alpha * F.relu(self.convs[direction + str(i)](
+                    output.index_select(dim, indices)))
+
+        return output
+
+
+def set_spatial_conv_engine(net, engine='loop'):
+    # Select how SCNN message passing is conducted in a built model:
+    # loop (original) / scan, functional (same weights & results) / resa (replace SpatialConv with a new RESA module)
+    if engine not in ['loop', 'scan', 'functional', 'resa']:
+        raise ValueError
+    for name, module in list(net.named_modules()):
+        if not isinstance(module, SpatialConv):
+            continue
+        if engine == 'resa':
+            parent = net
+            names = name.split('.')
+            for x in names[:-1]:
+                parent = getattr(parent, x)
+            setattr(parent, names[-1], RESA(num_channels=module.conv_d.in_channels).to(module.conv_d.weight.device))
+        else:
+            module.engine = engine
+
+    return net
+
 
 # Typical lane existence head originated from the SCNN paper
 class SimpleLaneExist(nn.Module):
@@ -129,6 +252,10 @@ class EDLaneExist(nn.Module):
         self.linear1 = nn.Linear(flattened_size, 128)
         self.linear2 = nn.Linear(128, num_output)
 
+        # Softmax stays in floating point when quantized
+        self.dequant = torch.quantization.DeQuantStub()
+        self.quant = torch.quantization.QuantStub()
+
     def forward(self, input):
         output = input
         for layer in self.layers:
@@ -139,7 +266,7 @@ class EDLaneExist(nn.Module):
         for layer in self.layers_final:
             output = layer(output)
 
-        output = F.softmax(output, dim=1)
+        output = self.quant(F.softmax(self.dequant(output), dim=1))
         output = self.pool(output)
         output = output.flatten(start_dim=1)
         output = self.linear1(output)
@@ -147,3 +274,6 @@ class EDLaneExist(nn.Module):
         output = self.linear2(output)
 
         return output
+
+    def fuse_model(self):
+        torch.quantization.fuse_modules(self.layers, [['0', '1']], inplace=True)
@@ -9,6 +9,14 @@ from ..mlp import MLP
 from .._utils import IntermediateLayerGetter
 
 
+def evaluate_curves(curves, ys):
+    # x = k'' / (y - f'')^2 + m'' / (y - f'') + n' + b'' * y - b''' (the lane shape model of LSTR)
+    # curves: (*, lsp_dim) LSTR curves, ys: (*, M) broadcastable, Return: xs (*, M)
+    k, f, m, n, b, b_ = curves[..., 2:8].unsqueeze(-1).unbind(dim=-2)
+
+    return k / (ys - f) ** 2 + m / (ys - f) + n + b * ys - b_
+
+
 class LSTR(nn.Module):
     def __init__(self,
                  flag=False,
@@ -59,11 +67,17 @@ class LSTR(nn.Module):
         self.specific_embed = MLP(hidden_dim, hidden_dim, lsp_dim - 4, mlp_layers)
         self.shared_embed = MLP(hidden_dim, hidden_dim, 4, mlp_layers)
 
-    def _train(self, images, interp_size):
+    def _features(self, images, masks=None, intermediate=True):
+        # masks: B x H x W bool (True for padded pixels), None for no padding (no masking in attention layers)
+        # Return: decoder outputs (num_layers x B x num_queries x hidden_dim), only the last layer if not intermediate
         p = self.backbone(images)['out']
-        pmasks = F.interpolate(interp_size, size=p.shape[-2:]).to(torch.bool)[0]
-        pos = self.position_embedding(p, pmasks)
-        hs, _ = self.transformer(self.input_proj(p), pmasks, self.query_embed.weight, pos)
+        pmasks = None if masks is None else F.interpolate(masks[None].float(), size=p.shape[-2:]).to(torch.bool)[0]
+        pos = self.position_embedding(p, pmasks)  # Cached per input shape without masks
+        hs, _ = self.transformer(self.input_proj(p), pmasks, self.query_embed.weight, pos, intermediate=intermediate)
+
+        return hs
+
+    def _heads(self, hs):
         output_class = self.class_embed(hs)
         output_specific = self.specific_embed(hs)
         output_shared = self.shared_embed(hs)
@@ -71,20 +85,30 @@ class LSTR(nn.Module):
         output_shared = output_shared.repeat(1, 1, output_specific.shape[2], 1)
         output_specific = torch.cat([output_specific[:, :, :, :2],
                                      output_shared, output_specific[:, :, :, 2:]], dim=-1)
+
+        return output_class, output_specific
+
+    def _train(self, images, masks=None):
+        output_class, output_specific = self._heads(self._features(images, masks))
         out = {'logits': output_class[-1], 'curves': output_specific[-1]}
         if self.aux_loss:
             out['lane'] = self._set_aux_loss(output_class, output_specific)
 
         return out
 
-    def _test(self, images, interp_size):
-        return self._train(images, interp_size)
+    def _test(self, images, masks=None):
+        # Heads only on the last decoder layer (auxiliary outputs are only for training losses)
+        output_class, output_specific = self._heads(self._features(images, masks, intermediate=False))
+
+        return {'logits': output_class[-1], 'curves': output_specific[-1]}
 
-    def forward(self, images, interp_size):
-        if self.flag:
-            return self._train(images, interp_size)
+    def forward(self, images, masks=None):
+        # Return: logits (B x num_queries x (num_cls + 1)), curves (B x num_queries x lsp_dim):
+        # lower, upper, k'', f'', m'', n', b'', b''' in normalized input coordinates (x, y in [0, 1])
+        if self.flag or self.training:
+            return self._train(images, masks)
         else:
-            return self._test(images, interp_size)
+            return self._test(images, masks)
 
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, outputs_coord):
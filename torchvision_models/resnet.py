@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from .utils import load_state_dict_from_url
+from ._utils import checkpoint_module
 
 
 __all__ = ['ResNet', 'resnet18', 'resnet18_reduced', 'resnet34', 'resnet50', 'resnet101',
@@ -52,8 +53,16 @@ class BasicBlock(nn.Module):
         self.bn2 = norm_layer(planes)
         self.downsample = downsample
         self.stride = stride
+        self.skip_add_relu = nn.quantized.FloatFunctional()  # Same as add + relu, quantizable
+        self.use_checkpoint = False  # Recompute activations in backward (set_activation_checkpointing())
 
     def forward(self, x):
+        if self.use_checkpoint and self.training and x.requires_grad:
+            return checkpoint_module(self, self._forward, x)
+        else:
+            return self._forward(x)
+
+    def _forward(self, x):
         identity = x
 
         out = self.conv1(x)
@@ -66,10 +75,13 @@ class BasicBlock(nn.Module):
         if self.downsample is not None:
             identity = self.downsample(x)
 
-        out += identity
-        out = self.relu(out)
+        return self.skip_add_relu.add_relu(out, identity)
 
-        return out
+    def fuse_model(self):
+        # Conv-BN(-ReLU) fusion for post-training quantization (eval mode)
+        torch.quantization.fuse_modules(self, [['conv1', 'bn1', 'relu'], ['conv2', 'bn2']], inplace=True)
+        if self.downsample is not None:
+            torch.quantization.fuse_modules(self.downsample, [['0', '1']], inplace=True)
 
 
 class Bottleneck(nn.Module):
@@ -95,10 +107,19 @@ class Bottleneck(nn.Module):
         self.conv3 = conv1x1(width, planes * self.expansion)
         self.bn3 = norm_layer(planes * self.expansion)
         self.relu = nn.ReLU(inplace=True)
+        self.relu2 = nn.ReLU(inplace=True)  # Separate ReLUs for Conv-BN-ReLU fusion
         self.downsample = downsample
         self.stride = stride
+        self.skip_add_relu = nn.quantized.FloatFunctional()
+        self.use_checkpoint = False
 
     def forward(self, x):
+        if self.use_checkpoint and self.training and x.requires_grad:
+            return checkpoint_module(self, self._forward, x)
+        else:
+            return self._forward(x)
+
+    def _forward(self, x):
         identity = x
 
         out = self.conv1(x)
@@ -107,7 +128,7 @@ class Bottleneck(nn.Module):
 
         out = self.conv2(out)
         out = self.bn2(out)
-        out = self.relu(out)
+        out = self.relu2(out)
 
         out = self.conv3(out)
         out = self.bn3(out)
@@ -115,10 +136,13 @@ class Bottleneck(nn.Module):
         if self.downsample is not None:
             identity = self.downsample(x)
 
-        out += identity
-        out = self.relu(out)
+        return self.skip_add_relu.add_relu(out, identity)
 
-        return out
+    def fuse_model(self):
+        torch.quantization.fuse_modules(self, [['conv1', 'bn1', 'relu'], ['conv2', 'bn2', 'relu2'], ['conv3', 'bn3']],
+                                        inplace=True)
+        if self.downsample is not None:
+            torch.quantization.fuse_modules(self.downsample, [['0', '1']], inplace=True)
 
 
 class ResNet(nn.Module):
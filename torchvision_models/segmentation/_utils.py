@@ -1,3 +1,4 @@
+import torch
 from torch import nn
 from collections import OrderedDict
 
@@ -14,10 +15,19 @@ class _SimpleSegmentationModel(nn.Module):
         self.scnn_layer = scnn_layer
         self.recon_head = recon_head
 
+        # Quantization boundaries (identity unless converted by utils/quantization.py),
+        # SCNN and softmax stay in floating point
+        self.quant = torch.quantization.QuantStub()
+        self.quant_scnn = torch.quantization.QuantStub()
+        self.quant_lane = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+
+    _float_modules = ['scnn_layer']
+
     def forward(self, x):
         # input_shape = x.shape[-2:]
         # contract: features is a dict of tensors
-        features = self.backbone(x)
+        features = self.backbone(self.quant(x))
         result = OrderedDict()
         x = features['out']
 
@@ -25,28 +35,66 @@ class _SimpleSegmentationModel(nn.Module):
         if self.channel_reducer is not None:
             x = self.channel_reducer(x)
         if self.scnn_layer is not None:
-            x = self.scnn_layer(x)
+            x = self.quant_scnn(self.scnn_layer(self.dequant(x)))
 
         # Semantic segmentation
-        x = self.classifier(x)
+        x = self.dequant(self.classifier(x))
         # x = F.interpolate(x, size=(513, 513), mode='bilinear', align_corners=True)
         result['out'] = x
 
         # For lane detection
         if self.lane_classifier is not None:
-            result['lane'] = self.lane_classifier(x.softmax(dim=1))
+            result['lane'] = self.dequant(self.lane_classifier(self.quant_lane(x.softmax(dim=1))))
 
         # For COCO pre-trained models
         if self.aux_classifier is not None:
             x = features['aux']
             x = self.aux_classifier(x)
             # x = F.interpolate(x, size=input_shape, mode='bilinear', align_corners=True)
-            result['aux'] = x
+            result['aux'] = self.dequant(x)
 
         # Reconstruction
         if self.recon_head is not None:
             x = features['recon']
             x = self.recon_head(x)
-            result['recon'] = x
+            result['recon'] = self.dequant(x)
+
+        return result
+
+    # Temporal feature reuse stages for lane detection (utils/key_frames.py), ResNet backbones without aux/recon heads
+    # shallow: stem & layer1 (output stride 4) on every frame, deep: the rest of the backbone, channel reduction & SCNN
+    # on key frames, heads: every frame on the propagated deep features
+    # forward_shallow returns the shallow features, then the other arguments of forward_heads (none)
+    def forward_shallow(self, x):
+        x = self.quant(x)
+        for name, module in self.backbone.items():
+            x = module(x)
+            if name == 'layer1':
+                break
+
+        return x,
+
+    def forward_deep(self, x):
+        names = list(self.backbone.keys())
+        for name in names[names.index('layer1') + 1:]:
+            x = self.backbone[name](x)
+        if self.channel_reducer is not None:
+            x = self.channel_reducer(x)
+        if self.scnn_layer is not None:
+            x = self.quant_scnn(self.scnn_layer(self.dequant(x)))
+
+        return x
+
+    def forward_heads(self, x):
+        result = OrderedDict()
+        x = self.dequant(self.classifier(x))
+        result['out'] = x
+        if self.lane_classifier is not None:
+            result['lane'] = self.dequant(self.lane_classifier(self.quant_lane(x.softmax(dim=1))))
 
         return result
+
+    def fuse_model(self):
+        # ResNet stem (blocks, reducer & heads fuse themselves)
+        if all(hasattr(self.backbone, x) for x in ['conv1', 'bn1', 'relu']):
+            torch.quantization.fuse_modules(self.backbone, [['conv1', 'bn1', 'relu']], inplace=True)
@@ -5,6 +5,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from ._utils import _SimpleSegmentationModel
+from .._utils import checkpoint_module
 
 
 __all__ = ["DeepLab"]
@@ -135,8 +136,15 @@ class ASPP(nn.Module):
             nn.BatchNorm2d(out_channels),
             nn.ReLU(),
             nn.Dropout(0.5))
+        self.use_checkpoint = False  # Recompute activations in backward (set_activation_checkpointing())
 
     def forward(self, x):
+        if self.use_checkpoint and self.training and x.requires_grad:
+            return checkpoint_module(self, self._forward, x)
+        else:
+            return self._forward(x)
+
+    def _forward(self, x):
         res = []
         for conv in self.convs:
             res.append(conv(x))
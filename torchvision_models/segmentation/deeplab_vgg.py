@@ -26,6 +26,13 @@ class VGG16(nn.Module):
         x = self.net(x)
         return x
 
+    # Temporal feature reuse stages (utils/key_frames.py): the first 2 blocks (output stride 4), the rest
+    def forward_shallow(self, x):
+        return self.net[:14](x)
+
+    def forward_deep(self, x):
+        return self.net[14:](x)
+
 
 class DeepLabV1(nn.Module):
     def __init__(self, num_classes, encoder=None, num_lanes=0, dropout_1=0.1, flattened_size=3965,
@@ -64,15 +71,26 @@ class DeepLabV1(nn.Module):
             self.lane_classifier = None
 
     def forward(self, input):
-        out = OrderedDict()
+        output, = self.forward_shallow(input)
 
-        output = self.encoder(input)
-        output = self.fc67(output)
+        return self.forward_heads(self.forward_deep(output))
 
+    # Temporal feature reuse stages (utils/key_frames.py), shallow: every frame, deep (SCNN included): key frames,
+    # heads: every frame on the propagated deep features
+    # forward_shallow returns the shallow features, then the other arguments of forward_heads (none)
+    def forward_shallow(self, input):
+        return self.encoder.forward_shallow(input),
+
+    def forward_deep(self, input):
+        output = self.fc67(self.encoder.forward_deep(input))
         if self.scnn is not None:
             output = self.scnn(output)
 
-        output = self.fc8(output)
+        return output
+
+    def forward_heads(self, input):
+        out = OrderedDict()
+        output = self.fc8(input)
         out['out'] = output
         if self.lane_classifier is not None:
             output = self.softmax(output)
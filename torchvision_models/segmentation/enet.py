@@ -7,6 +7,20 @@ from torch.nn import functional as F
 from torch.nn.parameter import Parameter
 from ..lane_detection.common_models import EDLaneExist
 
+def _fuse_conv_bn(sequential):
+    # Fuse Conv-BN(-ReLU) in an nn.Sequential for post-training quantization (PReLU is not fused)
+    modules = list(sequential.children())
+    groups = []
+    for i in range(len(modules) - 1):
+        if isinstance(modules[i], nn.Conv2d) and isinstance(modules[i + 1], nn.BatchNorm2d):
+            if i + 2 < len(modules) and type(modules[i + 2]) == nn.ReLU:
+                groups.append([str(i), str(i + 1), str(i + 2)])
+            else:
+                groups.append([str(i), str(i + 1)])
+    if len(groups) > 0:
+        torch.quantization.fuse_modules(sequential, groups, inplace=True)
+
+
 class InitialBlock(nn.Module):
     """The initial block is composed of two branches:
     1. a main branch which performs a regular convolution with stride 2;
@@ -161,14 +175,20 @@ class RegularBottleneck(nn.Module):
         # PReLU layer to apply after adding the branches
         self.out_activation = activation()
 
+        # Only the extension branch is quantized (identity unless converted by utils/quantization.py)
+        self.quant = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+
+    _float_modules = ['out_activation']
+
     def forward(self, x):
         # Main branch shortcut
         main = x
 
         # Extension branch
-        ext = self.ext_conv1(x)
+        ext = self.ext_conv1(self.quant(x))
         ext = self.ext_conv2(ext)
-        ext = self.ext_conv3(ext)
+        ext = self.dequant(self.ext_conv3(ext))
         if self.is_dropout:
             ext = self.ext_regul(ext)
 
@@ -177,6 +197,11 @@ class RegularBottleneck(nn.Module):
 
         return self.out_activation(out)
 
+    def fuse_model(self):
+        _fuse_conv_bn(self.ext_conv1)
+        _fuse_conv_bn(self.ext_conv2)
+        _fuse_conv_bn(self.ext_conv3)
+
 
 class DownsamplingBottleneck(nn.Module):
     """Downsampling bottlenecks further downsample the feature map size.
@@ -260,6 +285,12 @@ class DownsamplingBottleneck(nn.Module):
         # PReLU layer to apply after concatenating the branches
         self.out_activation = activation()
 
+        # Only the extension branch is quantized
+        self.quant = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+
+    _float_modules = ['out_activation']
+
     def forward(self, x):
         # Main branch shortcut
         if self.return_indices:
@@ -268,21 +299,17 @@ class DownsamplingBottleneck(nn.Module):
             main = self.main_max1(x)
 
         # Extension branch
-        ext = self.ext_conv1(x)
+        ext = self.ext_conv1(self.quant(x))
         ext = self.ext_conv2(ext)
-        ext = self.ext_conv3(ext)
+        ext = self.dequant(self.ext_conv3(ext))
         if self.is_dropout:
             ext = self.ext_regul(ext)
 
         # Main branch channel padding
         n, ch_ext, h, w = ext.size()
         ch_main = main.size()[1]
-        padding = torch.zeros(n, ch_ext - ch_main, h, w)
-
-        # Before concatenating, check if main is on the CPU or GPU and
-        # convert padding accordingly
-        if main.is_cuda:
-            padding = padding.cuda()
+        # Same device & dtype as the input (no constant CPU tensor when traced)
+        padding = ext.new_zeros(n, ch_ext - ch_main, h, w)
 
         # Concatenate
         main = torch.cat((main, padding), 1)
@@ -292,6 +319,19 @@ class DownsamplingBottleneck(nn.Module):
 
         return self.out_activation(out), max_indices
 
+    def fuse_model(self):
+        _fuse_conv_bn(self.ext_conv1)
+        _fuse_conv_bn(self.ext_conv2)
+        _fuse_conv_bn(self.ext_conv3)
+
+
+def _max_unpool_scatter(x, indices, output_size):
+    # Same as max_unpool2d with non-overlapping windows (indices are flattened per channel), as a scatter
+    n, c = x.shape[:2]
+    h, w = output_size[-2:]
+
+    return x.new_zeros(n, c, h * w).scatter(2, indices.flatten(2), x.flatten(2)).view(n, c, h, w)
+
 
 class UpsamplingBottleneck(nn.Module):
     """The upsampling bottlenecks upsample the feature map resolution using max
@@ -379,7 +419,10 @@ class UpsamplingBottleneck(nn.Module):
     def forward(self, x, max_indices, output_size):
         # Main branch shortcut
         main = self.main_conv1(x)
-        main = self.main_unpool1(main, max_indices, output_size=output_size)
+        if torch.onnx.is_in_onnx_export():  # No ONNX symbolic for max_unpool2d
+            main = _max_unpool_scatter(main, max_indices, output_size=output_size)
+        else:
+            main = self.main_unpool1(main, max_indices, output_size=output_size)
 
         # Extension branch
         ext = self.ext_conv1(x)
@@ -590,7 +633,18 @@ class Encoder(nn.Module):
                                                relu=encoder_relu)
         self.dilated3_7 = RegularBottleneck(128, dilation=16, padding=16, dropout_prob=dropout_2, relu=encoder_relu)
 
+    _float_modules = ['initial_block']
+    # Outputs of stage 1-3 for self attention distillation (utils/losses/lane_seg_loss.SADLoss)
+    _attention_modules = ['regular1_4', 'dilated2_8', 'dilated3_7']
+
     def forward(self, x):
+        shallow = self.forward_shallow(x)
+
+        return (self.forward_deep(shallow[0]),) + shallow[1:]
+
+    # Temporal feature reuse stages (utils/key_frames.py): the initial block, stage 1 & the stage 2 downsampler
+    # (output stride 8, max pooling indices of the decoder are from the current frame), the rest
+    def forward_shallow(self, x):
         # Initial block
         input_size = x.size()
         x = self.initial_block(x)
@@ -606,6 +660,11 @@ class Encoder(nn.Module):
         # Stage 2 - Encoder
         stage2_input_size = x.size()
         x, max_indices2_0 = self.downsample2_0(x)
+
+        return x, max_indices1_0, stage1_input_size, max_indices2_0, stage2_input_size, input_size
+
+    def forward_deep(self, x):
+        # Stage 2 - Encoder
         x = self.regular2_1(x)
         x = self.dilated2_2(x)
         x = self.asymmetric2_3(x)
@@ -625,7 +684,7 @@ class Encoder(nn.Module):
         x = self.asymmetric3_6(x)
         x = self.dilated3_7(x)
 
-        return x, max_indices1_0, stage1_input_size, max_indices2_0, stage2_input_size, input_size
+        return x
 
 
 class Decoder(nn.Module):
@@ -682,21 +741,40 @@ class ENet(nn.Module):
         else:
             self.lane_classifier = None
 
+        # Quantization boundaries of the lane classifier (encoder blocks quantize their extension branches)
+        self.quant_lane = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+
+    # Unpooling, sizes & the initial block stay in floating point when quantized
+    _float_modules = ['encoder_conv', 'decoder']
+
     def forward(self, x):
+        shallow = self.forward_shallow(x)
+
+        return self.forward_heads(self.forward_deep(shallow[0]), *shallow[1:])
+
+    # Temporal feature reuse stages (utils/key_frames.py), shallow: every frame, deep: key frames,
+    # heads: every frame on the propagated deep features
+    # forward_shallow returns the shallow features, then the other arguments of forward_heads
+    def forward_shallow(self, x):
+        return self.encoder.forward_shallow(x)
+
+    def forward_deep(self, x):
+        return self.encoder.forward_deep(x)
+
+    def forward_heads(self, x, max_indices1_0, stage1_input_size, max_indices2_0, stage2_input_size, input_size):
         out = OrderedDict()
-        x, max_indices1_0, stage1_input_size, max_indices2_0, stage2_input_size, input_size = self.encoder(x)
         if self.encoder_conv is not None:
             x = self.encoder_conv(x)
 
         if self.lane_classifier is not None:
-            out['lane'] = self.lane_classifier(x)
+            out['lane'] = self.dequant(self.lane_classifier(self.quant_lane(x)))
 
         if self.decoder is not None:
             x = self.decoder.forward(x, max_indices1_0, stage1_input_size, max_indices2_0,
                                      stage2_input_size, input_size)
         out['out'] = x
 
-
         return out
 
 # net = ENet(num_classes=19,encoder_only=True)
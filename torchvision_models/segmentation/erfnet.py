@@ -16,9 +16,10 @@ class DownsamplerBlock(nn.Module):
         self.conv = nn.Conv2d(ninput, noutput-ninput, (3, 3), stride=2, padding=1, bias=True)
         self.pool = nn.MaxPool2d(2, stride=2)
         self.bn = nn.BatchNorm2d(noutput, eps=1e-3)
+        self.cat = nn.quantized.FloatFunctional()  # Quantizable torch.cat
 
     def forward(self, input):
-        output = torch.cat([self.conv(input), self.pool(input)], 1)
+        output = self.cat.cat([self.conv(input), self.pool(input)], 1)
         output = self.bn(output)
         return F.relu(output)
     
@@ -34,7 +35,8 @@ class non_bottleneck_1d(nn.Module):
         self.conv1x3_2 = nn.Conv2d(chann, chann, (1, 3), stride=1, padding=(0, 1*dilated),
                                    bias=True, dilation=(1, dilated))
         self.bn2 = nn.BatchNorm2d(chann, eps=1e-03)
-        self.dropout = nn.Dropout2d(dropprob)
+        self.dropout = nn.Dropout2d(dropprob) if dropprob != 0 else nn.Identity()
+        self.skip_add_relu = nn.quantized.FloatFunctional()  # Quantizable add + relu
 
     def forward(self, input):
         output = self.conv3x1_1(input)
@@ -48,10 +50,13 @@ class non_bottleneck_1d(nn.Module):
         output = self.conv1x3_2(output)
         output = self.bn2(output)
 
-        if self.dropout.p != 0:
-            output = self.dropout(output)
-        
-        return F.relu(output + input)
+        output = self.dropout(output)
+
+        return self.skip_add_relu.add_relu(output, input)
+
+    def fuse_model(self):
+        # Conv-BN fusion for post-training quantization (eval mode)
+        torch.quantization.fuse_modules(self, [['conv1x3_1', 'bn1'], ['conv1x3_2', 'bn2']], inplace=True)
 
 
 class Encoder(nn.Module):
@@ -77,17 +82,28 @@ class Encoder(nn.Module):
         # Only in encoder mode:
         self.output_conv = nn.Conv2d(128, num_classes, 1, stride=1, padding=0, bias=True)
 
-    def forward(self, input, predict=False):
-        output = self.initial_block(input)
+    # Last block at 1/4, and the 2 groups of dilated blocks at 1/8, for self attention distillation (SADLoss)
+    _attention_modules = ['layers.5', 'layers.10', 'layers.14']
 
-        for layer in self.layers:
-            output = layer(output)
+    def forward(self, input, predict=False):
+        output = self.forward_deep(self.forward_shallow(input))
 
         if predict:
             output = self.output_conv(output)
 
         return output
 
+    # Temporal feature reuse stages (utils/key_frames.py): the initial block & the first downsampler (output stride 4)
+    def forward_shallow(self, input):
+        return self.layers[0](self.initial_block(input))
+
+    def forward_deep(self, input):
+        output = input
+        for layer in self.layers[1:]:
+            output = layer(output)
+
+        return output
+
 
 class UpsamplerBlock(nn.Module):
     def __init__(self, ninput, noutput):
@@ -187,16 +203,39 @@ class ERFNet(nn.Module):
         else:
             self.lane_classifier = None
 
+        # Quantization boundaries (identity unless converted by utils/quantization.py), SCNN stays in floating point
+        self.quant = torch.quantization.QuantStub()
+        self.quant_scnn = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+
+    _float_modules = ['spatial_conv']
+    # encoder.output_conv is only used with only_encode, DistributedDataParallel must allow unused parameters
+    _unused_parameters = True
+
     def forward(self, input, only_encode=False):
-        out = OrderedDict()
         if only_encode:
-            return self.encoder.forward(input, predict=True)
+            return self.dequant(self.encoder.forward(self.quant(input), predict=True))
         else:
-            output = self.encoder(input)    # predict=False by default
-            if self.spatial_conv is not None:
-                output = self.spatial_conv(output)
-            out['out'] = self.decoder.forward(output)
-
-            if self.lane_classifier is not None:
-                out['lane'] = self.lane_classifier(output)
-            return out
+            output, = self.forward_shallow(input)
+            return self.forward_heads(self.forward_deep(output))
+
+    # Temporal feature reuse stages (utils/key_frames.py), shallow: every frame, deep (SCNN included): key frames,
+    # heads: every frame on the propagated deep features
+    # forward_shallow returns the shallow features, then the other arguments of forward_heads (none)
+    def forward_shallow(self, input):
+        return self.encoder.forward_shallow(self.quant(input)),
+
+    def forward_deep(self, input):
+        output = self.encoder.forward_deep(input)
+        if self.spatial_conv is not None:
+            output = self.quant_scnn(self.spatial_conv(self.dequant(output)))
+
+        return output
+
+    def forward_heads(self, input):
+        out = OrderedDict()
+        out['out'] = self.dequant(self.decoder.forward(input))
+        if self.lane_classifier is not None:
+            out['lane'] = self.dequant(self.lane_classifier(input))
+
+        return out
@@ -4,7 +4,7 @@ import warnings
 from .._utils import IntermediateLayerGetter
 from ..utils import load_state_dict_from_url
 from .. import resnet
-from .deeplab import DeepLabV3Head, DeepLabV2Head, DeepLabV1Head, DeepLab, ReconHead
+from .deeplab import DeepLabV3Head, DeepLabV2Head, DeepLabV1Head, DeepLab, ReconHead, ASPP
 from .fcn import FCN, FCNHead
 from .erfnet import ERFNet
 from .deeplab_vgg import DeepLabV1
@@ -15,7 +15,8 @@ import torch
 
 __all__ = ['fcn_resnet50', 'fcn_resnet101', 'deeplabv2_resnet101', 'deeplabv3_resnet50', 'deeplabv3_resnet101',
            'erfnet_resnet', 'deeplabv1_vgg16', 'enet_',
-           'deeplabv1_resnet101', 'deeplabv1_resnet50', 'deeplabv1_resnet34', 'deeplabv1_resnet18']
+           'deeplabv1_resnet101', 'deeplabv1_resnet50', 'deeplabv1_resnet34', 'deeplabv1_resnet18',
+           'set_activation_checkpointing']
 
 model_urls = {
     'fcn_resnet50_coco': None,
@@ -278,3 +279,21 @@ def enet_(num_classes=19, encoder_relu=False, decoder_relu=True, dropout_1=0.01,
         net.load_state_dict(original_weights)
 
     return net
+
+
+def set_activation_checkpointing(net, layers=('layer3', 'layer4'), aspp=True):
+    # Recompute activations of ResNet blocks in layers (and ASPP) during backward instead of storing them,
+    # saves memory for large inputs at the cost of 1 more forward pass of these modules in training,
+    # results are unchanged (BatchNorm running statistics are not updated again in the recomputation)
+    # Return: number of checkpointed modules
+    count = 0
+    for name, module in net.named_modules():
+        if isinstance(module, (resnet.BasicBlock, resnet.Bottleneck)):
+            module.use_checkpoint = any(x in layers for x in name.split('.'))
+        elif isinstance(module, ASPP):
+            module.use_checkpoint = aspp
+        else:
+            continue
+        count += int(module.use_checkpoint)
+
+    return count
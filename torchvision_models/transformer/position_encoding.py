@@ -23,9 +23,20 @@ class PositionEmbeddingSine(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        self._cache = {}  # Embeddings without padding, only depend on the input shape
 
-    def forward(self, x, mask):
-        assert mask is not None
+    def forward(self, x, mask=None):
+        # mask: B x H x W bool (True for padded pixels), None for no padding (cached per input shape & device)
+        if mask is None:
+            key = (x.shape[-2], x.shape[-1], str(x.device))
+            if key not in self._cache.keys():
+                self._cache[key] = self.embed(torch.zeros((1, *x.shape[-2:]), dtype=torch.bool, device=x.device))
+
+            return self._cache[key].expand(x.shape[0], -1, -1, -1)
+
+        return self.embed(mask)
+
+    def embed(self, mask):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -34,7 +45,7 @@ class PositionEmbeddingSine(nn.Module):
             y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
 
         pos_x = x_embed[:, :, :, None] / dim_t
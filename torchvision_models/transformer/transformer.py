@@ -7,6 +7,7 @@ Copy-paste from torch.nn.Transformer with modifications:
     * positional encodings are passed in MHattention
     * extra LN at the end of encoder is removed
     * decoder returns a stack of activations from all decoding layers
+    * padding masks are optional, attention is fused in eval mode (set_fused_attention())
 """
 import copy
 from typing import Optional
@@ -44,18 +45,21 @@ class Transformer(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-    def forward(self, src, mask, query_embed, pos_embed):
+    def forward(self, src, mask, query_embed, pos_embed, intermediate: bool = True):
+        # mask: None for no padding
+        # intermediate: False to only return the last decoder layer (1 x N x num_queries x C)
         # flatten NxCxHxW to HWxNxC
         bs, c, h, w = src.shape
         src = src.flatten(2).permute(2, 0, 1)
         pos_embed = pos_embed.flatten(2).permute(2, 0, 1)
         query_embed = query_embed.unsqueeze(1).repeat(1, bs, 1)
-        mask = mask.flatten(1)
+        if mask is not None:
+            mask = mask.flatten(1)
 
         tgt = torch.zeros_like(query_embed)
         memory = self.encoder(src, src_key_padding_mask=mask, pos=pos_embed)
         hs = self.decoder(tgt, memory, memory_key_padding_mask=mask,
-                          pos=pos_embed, query_pos=query_embed)
+                          pos=pos_embed, query_pos=query_embed, intermediate=intermediate)
 
         return hs.transpose(1, 2), memory.permute(1, 2, 0).view(bs, c, h, w)
 
@@ -97,10 +101,13 @@ class TransformerDecoder(nn.Module):
                 tgt_key_padding_mask: Optional[Tensor] = None,
                 memory_key_padding_mask: Optional[Tensor] = None,
                 pos: Optional[Tensor] = None,
-                query_pos: Optional[Tensor] = None):
+                query_pos: Optional[Tensor] = None,
+                intermediate: bool = True):
+        # intermediate: False to skip intermediate outputs even with return_intermediate (e.g. no auxiliary heads)
+        return_intermediate = self.return_intermediate and intermediate
         output = tgt
 
-        intermediate = []
+        intermediates = []
 
         for layer in self.layers:
             output = layer(output, memory, tgt_mask=tgt_mask,
@@ -108,17 +115,17 @@ class TransformerDecoder(nn.Module):
                            tgt_key_padding_mask=tgt_key_padding_mask,
                            memory_key_padding_mask=memory_key_padding_mask,
                            pos=pos, query_pos=query_pos)
-            if self.return_intermediate:
-                intermediate.append(self.norm(output))
+            if return_intermediate:
+                intermediates.append(self.norm(output))
 
         if self.norm is not None:
             output = self.norm(output)
-            if self.return_intermediate:
-                intermediate.pop()
-                intermediate.append(output)
+            if return_intermediate:
+                intermediates.pop()
+                intermediates.append(output)
 
-        if self.return_intermediate:
-            return torch.stack(intermediate)
+        if return_intermediate:
+            return torch.stack(intermediates)
 
         return output.unsqueeze(0)
 
@@ -140,6 +147,7 @@ class TransformerEncoderLayer(nn.Module):
 
         self.activation = _get_activation_fn(activation)
         self.normalize_before = normalize_before
+        self.fused_attention = True
 
     def forward_post(self,
                      src,
@@ -147,8 +155,8 @@ class TransformerEncoderLayer(nn.Module):
                      src_key_padding_mask: Optional[Tensor] = None,
                      pos: Optional[Tensor] = None):
         q = k = _with_pos_embed(src, pos)
-        src2 = self.self_attn(q, k, value=src, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)[0]
+        src2 = _multihead_attention(self.self_attn, q, k, value=src, attn_mask=src_mask,
+                                    key_padding_mask=src_key_padding_mask, fused=self.fused_attention)
         src = src + self.dropout1(src2)
         src = self.norm1(src)
         src2 = self.linear2(self.dropout(self.activation(self.linear1(src))))
@@ -163,8 +171,8 @@ class TransformerEncoderLayer(nn.Module):
                     pos: Optional[Tensor] = None):
         src2 = self.norm1(src)
         q = k = _with_pos_embed(src2, pos)
-        src2 = self.self_attn(q, k, value=src2, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)[0]
+        src2 = _multihead_attention(self.self_attn, q, k, value=src2, attn_mask=src_mask,
+                                    key_padding_mask=src_key_padding_mask, fused=self.fused_attention)
         src = src + self.dropout1(src2)
         src2 = self.norm2(src)
         src2 = self.linear2(self.dropout(self.activation(self.linear1(src2))))
@@ -202,6 +210,7 @@ class TransformerDecoderLayer(nn.Module):
 
         self.activation = _get_activation_fn(activation)
         self.normalize_before = normalize_before
+        self.fused_attention = True
 
     def forward_post(self, tgt, memory,
                      tgt_mask: Optional[Tensor] = None,
@@ -211,14 +220,14 @@ class TransformerDecoderLayer(nn.Module):
                      pos: Optional[Tensor] = None,
                      query_pos: Optional[Tensor] = None):
         q = k = _with_pos_embed(tgt, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        tgt2 = _multihead_attention(self.self_attn, q, k, value=tgt, attn_mask=tgt_mask,
+                                    key_padding_mask=tgt_key_padding_mask, fused=self.fused_attention)
         tgt = tgt + self.dropout1(tgt2)
         tgt = self.norm1(tgt)
-        tgt2 = self.multihead_attn(query=_with_pos_embed(tgt, query_pos),
-                                   key=_with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = _multihead_attention(self.multihead_attn, query=_with_pos_embed(tgt, query_pos),
+                                    key=_with_pos_embed(memory, pos),
+                                    value=memory, attn_mask=memory_mask,
+                                    key_padding_mask=memory_key_padding_mask, fused=self.fused_attention)
         tgt = tgt + self.dropout2(tgt2)
         tgt = self.norm2(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt))))
@@ -236,14 +245,14 @@ class TransformerDecoderLayer(nn.Module):
                     query_pos: Optional[Tensor] = None):
         tgt2 = self.norm1(tgt)
         q = k = _with_pos_embed(tgt2, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        tgt2 = _multihead_attention(self.self_attn, q, k, value=tgt2, attn_mask=tgt_mask,
+                                    key_padding_mask=tgt_key_padding_mask, fused=self.fused_attention)
         tgt = tgt + self.dropout1(tgt2)
         tgt2 = self.norm2(tgt)
-        tgt2 = self.multihead_attn(query=_with_pos_embed(tgt2, query_pos),
-                                   key=_with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = _multihead_attention(self.multihead_attn, query=_with_pos_embed(tgt2, query_pos),
+                                    key=_with_pos_embed(memory, pos),
+                                    value=memory, attn_mask=memory_mask,
+                                    key_padding_mask=memory_key_padding_mask, fused=self.fused_attention)
         tgt = tgt + self.dropout2(tgt2)
         tgt2 = self.norm3(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt2))))
@@ -266,6 +275,37 @@ class TransformerDecoderLayer(nn.Module):
                                      tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
 
 
+def _multihead_attention(attn, query, key, value, attn_mask: Optional[Tensor] = None,
+                         key_padding_mask: Optional[Tensor] = None, fused: bool = False):
+    # Outputs of nn.MultiheadAttention (L x N x E, no attention weights),
+    # fused: in eval mode, the same projections with 1 fused scaled dot product attention kernel (PyTorch >= 2.0),
+    # instead of separate matmul, softmax & matmul (falls back to nn.MultiheadAttention if not available)
+    if not fused or attn.training or attn_mask is not None or not hasattr(F, 'scaled_dot_product_attention'):
+        return attn(query, key, value=value, attn_mask=attn_mask, key_padding_mask=key_padding_mask)[0]
+
+    L, N, E = query.shape
+    S = key.shape[0]
+    num_heads = attn.num_heads
+    w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+    b_q, b_k, b_v = attn.in_proj_bias.chunk(3)
+    q = F.linear(query, w_q, b_q).view(L, N, num_heads, E // num_heads).permute(1, 2, 0, 3)
+    k = F.linear(key, w_k, b_k).view(S, N, num_heads, E // num_heads).permute(1, 2, 0, 3)
+    v = F.linear(value, w_v, b_v).view(S, N, num_heads, E // num_heads).permute(1, 2, 0, 3)
+    mask = None if key_padding_mask is None else ~key_padding_mask[:, None, None, :]  # True: attend
+    output = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)  # N x num_heads x L x (E / num_heads)
+
+    return attn.out_proj(output.permute(2, 0, 1, 3).reshape(L, N, E))
+
+
+def set_fused_attention(net, enabled=True):
+    # Fused attention of all transformer layers in a built model (only used in eval mode), in place
+    for module in net.modules():
+        if isinstance(module, (TransformerEncoderLayer, TransformerDecoderLayer)):
+            module.fused_attention = enabled
+
+    return net
+
+
 def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
 
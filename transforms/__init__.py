@@ -1,2 +1,3 @@
 # Modified from pytorch/vision/commit/a05598032c616bdd7010ab57fb38cf549695f988
 from .transforms import *
+from .batched import *
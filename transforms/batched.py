@@ -0,0 +1,148 @@
+# Batched augmentation on the training device:
+# DataLoader workers only decode images to uint8 (ToUInt8Tensor),
+# random parameters are sampled per-sample with the same transform classes (get_affine()),
+# then the whole batch is warped by 1 affine_grid + grid_sample (image bilinear, label nearest with 255 fill)
+import numpy as np
+import torch
+from .transforms import Normalize, LabelMap, ToTensor, ToTensorNormalize
+
+
+class ToUInt8Tensor(object):
+    # Decode only: PIL image -> uint8 CHW tensor, PIL mask -> uint8/int64 HW tensor
+    # Keypoint arrays & filenames are the same as ToTensor
+    def __call__(self, image, target):
+        image = torch.as_tensor(np.array(image, dtype=np.uint8)).permute(2, 0, 1)
+        if isinstance(target, (np.ndarray, str)):
+            target = ToTensor.label_to_tensor(target)
+        elif target.mode in ['L', 'P']:
+            target = torch.as_tensor(np.array(target, dtype=np.uint8))
+        else:
+            target = ToTensor.label_to_tensor(target)
+
+        return image, target
+
+
+class BatchedTransforms(object):
+    # Apply a list of transforms to a batch on its device,
+    # supports geometric transforms with get_affine(), at most 1 LabelMap (applied first) & 1 Normalize (applied last),
+    # ToTensor is implied (uint8 -> [0, 1] float), ToTensorNormalize is treated as Normalize
+    # Inputs: uint8 images (B x 3 x H x W),
+    #         labels (B x H x W) or keypoints (B x L x N x 2, float, invalid x is -2) or None
+    # Output images are in memory_format (e.g. torch.channels_last)
+    def __init__(self, transforms, memory_format=torch.contiguous_format):
+        self.geometric = []
+        self.normalize = None
+        self.label_map = None
+        for t in transforms:
+            if isinstance(t, ToTensor):
+                continue
+            elif hasattr(t, 'get_affine'):
+                self.geometric.append(t)
+            elif isinstance(t, (Normalize, ToTensorNormalize)) and self.normalize is None:
+                self.normalize = t
+            elif isinstance(t, LabelMap) and self.label_map is None:
+                self.label_map = t
+            else:
+                raise ValueError('Not supported in batched transforms: {}'.format(type(t).__name__))
+        self.memory_format = memory_format
+        self._mean = None
+        self._std = None
+        self._label_id_map = None
+
+    def get_matrices(self, batch_size, size):
+        # Sample forward affine matrices (B x 3 x 3) for each sample
+        matrices = []
+        out_size = None
+        for _ in range(batch_size):
+            matrix = np.eye(3)
+            temp = tuple(size)
+            for t in self.geometric:
+                affine, temp = t.get_affine(temp)
+                matrix = affine @ matrix
+            if out_size is not None and tuple(temp) != out_size:
+                raise ValueError('Batched transforms must produce the same output size for all samples!')
+            out_size = tuple(temp)
+            matrices.append(matrix)
+
+        return np.stack(matrices), out_size
+
+    @staticmethod
+    def get_theta(matrices, in_size, out_size):
+        # Output -> input mapping in normalized coordinates (align_corners=False) for affine_grid
+        in_h, in_w = in_size
+        out_h, out_w = out_size
+        normalize_in = np.array([[2 / in_w, 0, -1], [0, 2 / in_h, -1], [0, 0, 1]])
+        denormalize_out = np.array([[out_w / 2, 0, out_w / 2], [0, out_h / 2, out_h / 2], [0, 0, 1]])
+
+        return (normalize_in @ np.linalg.inv(matrices) @ denormalize_out)[:, :2, :]
+
+    def __call__(self, images, targets=None):
+        B, C, H, W = images.shape
+        matrices, out_size = self.get_matrices(B, (H, W))
+        theta = torch.tensor(self.get_theta(matrices, (H, W), out_size), dtype=torch.float32, device=images.device)
+        grid = torch.nn.functional.affine_grid(theta, size=[B, C, out_size[0], out_size[1]], align_corners=False)
+
+        # Images: bilinear, fill 0 (before normalization)
+        images = images.float().div_(255)
+        images = torch.nn.functional.grid_sample(images, grid, mode='bilinear', padding_mode='zeros',
+                                                 align_corners=False)
+        if self.normalize is not None:
+            if self._mean is None or self._mean.device != images.device:
+                self._mean = torch.tensor(self.normalize.mean, device=images.device).view(1, -1, 1, 1)
+                self._std = torch.tensor(self.normalize.std, device=images.device).view(1, -1, 1, 1)
+            images = images.sub_(self._mean).div_(self._std)
+        images = images.contiguous(memory_format=self.memory_format)
+
+        if targets is None or isinstance(targets[0], str):
+            pass
+        elif targets.is_floating_point():  # Keypoints
+            targets = self.transform_points(targets, torch.tensor(matrices, dtype=torch.float32,
+                                                                  device=targets.device), out_size)
+        else:  # Labels: nearest, fill 255
+            targets = targets.long()
+            if self.label_map is not None:
+                if self._label_id_map is None or self._label_id_map.device != targets.device:
+                    self._label_id_map = self.label_map.label_id_map.to(targets.device)
+                if self.label_map.outlier:
+                    targets[targets >= self._label_id_map.shape[0]] = 0
+                targets = self._label_id_map[targets]
+            targets = torch.nn.functional.grid_sample((targets + 1).unsqueeze(1).float(), grid, mode='nearest',
+                                                      padding_mode='zeros', align_corners=False)
+            targets = targets.squeeze(1).long() - 1
+            targets[targets < 0] = 255
+
+        return images, targets
+
+    @staticmethod
+    def transform_points(points, matrices, size, ignore_x=-2):
+        # Transform keypoints (B x L x N x 2) by forward matrices (B x 3 x 3),
+        # points out of the output image are ignored (same as RandomRotation.transform_points())
+        h, w = size
+        ignore_filter = (points[:, :, :, 0] == ignore_x)
+        points = torch.einsum('bij,blnj->blni', matrices[:, :2, :2], points) + matrices[:, None, None, :2, 2]
+        ignore_filter |= (points[:, :, :, 0] > w) | (points[:, :, :, 1] > h) | ((points > 0).sum(dim=-1) < 2)
+        points[:, :, :, 0] = points[:, :, :, 0] * ~ignore_filter + ignore_x * ignore_filter
+
+        return points
+
+
+# Wrap a DataLoader that outputs (uint8 images, targets, ...), to move each batch to device & apply BatchedTransforms
+class BatchedTransformsLoader(object):
+    def __init__(self, loader, transforms, device):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.sampler = loader.sampler
+        self.transforms = transforms
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for data in self.loader:
+            images, targets = data[0], data[1]
+            images = images.to(self.device, non_blocking=True)
+            if isinstance(targets, torch.Tensor):
+                targets = targets.to(self.device, non_blocking=True)
+            images, targets = self.transforms(images, targets)
+            yield (images, targets) + tuple(data[2:])
@@ -43,6 +43,16 @@ def _setup_angle(x, name, req_sizes=(2, )):
     return [float(d) for d in x]
 
 
+# 3 x 3 affine matrices in continuous (x, y) image coordinates (origin at the top-left corner of the image),
+# used by get_affine() for BatchedTransforms
+def affine_scale(sx, sy):
+    return np.array([[sx, 0, 0], [0, sy, 0], [0, 0, 1]], dtype=np.float64)
+
+
+def affine_translate(tx, ty):
+    return np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]], dtype=np.float64)
+
+
 class Compose(object):
     def __init__(self, transforms):
         self.transforms = transforms
@@ -72,6 +82,15 @@ class Resize(object):
 
         return points
 
+    def get_affine(self, size):
+        # For BatchedTransforms: forward affine matrix in (x, y) & output size (h, w)
+        if self.size_image != self.size_label:
+            raise ValueError('Batched transforms require the same image and label size!')
+        h, w = size
+        out_h, out_w = self.size_image
+
+        return affine_scale(out_w / w, out_h / h), (out_h, out_w)
+
     def __call__(self, image, target):
         w_ori, h_ori = F._get_image_size(image)
         image = F.resize(image, self.size_image, interpolation=Image.LINEAR)
@@ -90,6 +109,9 @@ class Crop(object):
     def __init__(self, size):
         self.h, self.w = size
 
+    def get_affine(self, size):
+        return np.eye(3), (self.h, self.w)
+
     def __call__(self, image, target):
         image = F.crop(image, 0, 0, self.h, self.w)
         target = F.crop(target, 0, 0, self.h, self.w)
@@ -97,6 +119,45 @@ class Crop(object):
         return image, target
 
 
+# Remove the top rows (e.g. sky above the lane region of interest), keep the full width
+# top is in pixels of an image with height, it is scaled for other heights (e.g. pre-resized caches), None: no scaling
+class CropTop(object):
+    def __init__(self, top, height=None):
+        self.top = top
+        self.height = height
+
+    def get_top(self, h):
+        return self.top if self.height is None else round(self.top * h / self.height)
+
+    @staticmethod
+    def transform_points(points, top, ignore_x=-2):
+        # Shift a np.array (L x N x 2) of points (x, y) up, points above the crop are ignored
+        ignore_filter = (points[:, :, 0] == ignore_x) + (points[:, :, 1] < top)
+        points = points - np.array([0, top], dtype=points.dtype)
+        points[:, :, 0] = points[:, :, 0] * ~ignore_filter + ignore_x * ignore_filter
+
+        return points
+
+    def get_affine(self, size):
+        h, w = size
+        top = self.get_top(h)
+
+        return affine_translate(0, -top), (h - top, w)
+
+    def __call__(self, image, target):
+        w, h = F._get_image_size(image)
+        top = self.get_top(h)
+        image = F.crop(image, top, 0, h - top, w)
+        if isinstance(target, str):
+            return image, target
+        elif isinstance(target, np.ndarray):
+            target = self.transform_points(target, top)
+        else:
+            target = F.crop(target, top, 0, h - top, w)
+
+        return image, target
+
+
 # Pad image with zeros, yet pad target with 255 (ignore label) on bottom & right if
 # given a bigger desired size (or else nothing is done at all)
 class ZeroPad(object):
@@ -113,6 +174,11 @@ class ZeroPad(object):
 
         return image, target
 
+    def get_affine(self, size):
+        h, w = size
+
+        return np.eye(3), (max(h, self.h), max(w, self.w))
+
     def __call__(self, image, target):
         return self.zero_pad(image, target, self.h, self.w)
 
@@ -124,6 +190,13 @@ class RandomTranslation(object):
         self.trans_h = trans_h
         self.trans_w = trans_w
 
+    def get_affine(self, size):
+        th, tw = size
+        i = random.randint(0, 2 * self.trans_h)
+        j = random.randint(0, 2 * self.trans_w)
+
+        return affine_translate(self.trans_w - j, self.trans_h - i), (th, tw)
+
     def __call__(self, image, target):
         th, tw = get_tensor_image_size(image)
         image = F.pad(image, [self.trans_w, self.trans_h, self.trans_w, self.trans_h], fill=0)
@@ -189,6 +262,14 @@ class RandomScale(object):
             max_scale = min_scale
         self.max_scale = max_scale
 
+    def get_affine(self, size):
+        scale = random.uniform(self.min_scale, self.max_scale)
+        h, w = size
+        out_h = int(scale * h)
+        out_w = int(scale * w)
+
+        return affine_scale(out_w / w, out_h / h), (out_h, out_w)
+
     def __call__(self, image, target):
         scale = random.uniform(self.min_scale, self.max_scale)
         h, w = get_tensor_image_size(image)
@@ -215,6 +296,18 @@ class RandomCrop(object):
         j = random.randint(0, w - tw)
         return i, j, th, tw
 
+    def get_affine(self, size):
+        # Pad if needed (bottom & right)
+        h = max(self.size[0], size[0])
+        w = max(self.size[1], size[1])
+        th, tw = self.size
+        if w <= tw and h <= th:
+            return np.eye(3), (h, w)
+        i = random.randint(0, h - th)
+        j = random.randint(0, w - tw)
+
+        return affine_translate(-j, -i), (th, tw)
+
     def __call__(self, image, target):
         # Pad if needed
         ih, iw = get_tensor_image_size(image)
@@ -235,6 +328,12 @@ class RandomHorizontalFlip(object):
     def __init__(self, flip_prob):
         self.flip_prob = flip_prob
 
+    def get_affine(self, size):
+        if random.random() < self.flip_prob:
+            return np.array([[-1.0, 0, size[1]], [0, 1, 0], [0, 0, 1]]), size
+        else:
+            return np.eye(3), size
+
     def __call__(self, image, target):
         t = random.random()
         if t < self.flip_prob:
@@ -313,6 +412,44 @@ class Normalize(object):
         return image, target
 
 
+# Fused ToTensor + Normalize for RGB PIL images:
+# uint8 HWC -> normalized CHW float in 1 pass (x * (1 / (255 * std)) - mean / std, computed straight into the output),
+# channels_last=True keeps HWC memory (a CHW view, so no transpose at all), half=True outputs float16
+class ToTensorNormalize(object):
+    def __init__(self, mean, std, channels_last=False, half=False):
+        self.mean = mean
+        self.std = std
+        self.channels_last = channels_last
+        self.dtype = np.float16 if half else np.float32
+        shape = (1, 1, -1) if channels_last else (-1, 1, 1)
+        self.scale = (1.0 / (255.0 * np.array(std, dtype=np.float64))).astype(self.dtype).reshape(shape)
+        self.bias = (-np.array(mean, dtype=np.float64) / np.array(std, dtype=np.float64)).astype(self.dtype) \
+            .reshape(shape)
+
+    def __call__(self, image, target):
+        image = self.to_tensor_normalize(image)
+        target = ToTensor.label_to_tensor(target)
+
+        return image, target
+
+    def to_tensor_normalize(self, pic):
+        if pic.mode != 'RGB':
+            raise ValueError('Only RGB images are supported, got {}!'.format(pic.mode))
+        array = np.asarray(pic)  # HWC uint8
+        h, w, c = array.shape
+        if self.channels_last:
+            image = torch.empty((h, w, c), dtype=torch.float16 if self.dtype == np.float16 else torch.float32)
+            source = array
+        else:
+            image = torch.empty((c, h, w), dtype=torch.float16 if self.dtype == np.float16 else torch.float32)
+            source = array.transpose(2, 0, 1)
+        output = image.numpy()  # Shared memory
+        np.multiply(source, self.scale, out=output)
+        np.add(output, self.bias, out=output)
+
+        return image.permute(2, 0, 1) if self.channels_last else image
+
+
 # Init with a python list as the map(mainly for cityscapes's id -> train_id)
 class LabelMap(object):
     def __init__(self, label_id_map, outlier=False):
@@ -378,6 +515,18 @@ class RandomRotation(object):
 
         return points
 
+    def get_affine(self, size):
+        # Same rotation as transform_points(), around the image center
+        if self.expand or self.center is not None:
+            raise ValueError('Batched transforms only support rotation around the image center without expand!')
+        angle = self.get_params(self.degrees) / 180.0 * math.pi
+        h, w = size
+        rotation = np.array([[math.cos(angle), math.sin(angle), 0],
+                             [-math.sin(angle), math.cos(angle), 0],
+                             [0, 0, 1]])
+
+        return affine_translate(w / 2, h / 2) @ rotation @ affine_translate(-w / 2, -h / 2), size
+
     def __call__(self, image, target):
         angle = self.get_params(self.degrees)
         image = F.rotate(image, angle, resample=Image.LINEAR, expand=self.expand, center=self.center, fill=0)
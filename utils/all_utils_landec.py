@@ -1,43 +1,50 @@
-import os
 import cv2
 import torch
+import itertools
 import time
-import ujson as json
 import numpy as np
-from tqdm import tqdm
 from torch.cuda.amp import autocast, GradScaler
 from torchvision_models.segmentation import erfnet_resnet, deeplabv1_vgg16, deeplabv1_resnet18, deeplabv1_resnet34, \
     deeplabv1_resnet50, deeplabv1_resnet101, enet_
-from utils.datasets import StandardLaneDetectionDataset
-from transforms import ToTensor, Normalize, Resize, RandomRotation, Compose
+from torchvision_models.lane_detection import set_spatial_conv_engine, LSTR, evaluate_curves
+from utils.datasets import StandardLaneDetectionDataset, TuSimple, CULane
+from transforms import ToTensorNormalize, Resize, CropTop, RandomRotation, Compose, ToUInt8Tensor, \
+    BatchedTransforms, BatchedTransformsLoader
 from utils.all_utils_semseg import save_checkpoint, ConfusionMatrix
+from utils.lane_writer import LaneWriter
+from utils.inference_pipeline import InferencePipeline
+from utils.distributed import get_sampler, set_epoch
+from utils.memory_format import get_memory_format, to_memory_format, to_channels_last
+from utils.key_frames import KeyFrameReuse
 
 
-def erfnet_tusimple(num_classes, scnn=False, pretrained_weights='erfnet_encoder_pretrained.pth.tar'):
+def erfnet_tusimple(num_classes, scnn=False, pretrained_weights='erfnet_encoder_pretrained.pth.tar',
+                    flattened_size=4400):
     # Define ERFNet for TuSimple (With only ImageNet pretraining)
     return erfnet_resnet(pretrained_weights=pretrained_weights, num_classes=num_classes, num_lanes=num_classes - 1,
-                         dropout_1=0.3, dropout_2=0.3, flattened_size=4400, scnn=scnn)
+                         dropout_1=0.3, dropout_2=0.3, flattened_size=flattened_size, scnn=scnn)
 
 
-def erfnet_culane(num_classes, scnn=False, pretrained_weights='erfnet_encoder_pretrained.pth.tar'):
+def erfnet_culane(num_classes, scnn=False, pretrained_weights='erfnet_encoder_pretrained.pth.tar',
+                  flattened_size=4500):
     # Define ERFNet for CULane (With only ImageNet pretraining)
     return erfnet_resnet(pretrained_weights=pretrained_weights, num_classes=num_classes, num_lanes=num_classes - 1,
-                         dropout_1=0.1, dropout_2=0.1, flattened_size=4500, scnn=scnn)
+                         dropout_1=0.1, dropout_2=0.1, flattened_size=flattened_size, scnn=scnn)
 
 
-def vgg16_tusimple(num_classes, scnn=False, pretrained_weights='pytorch-pretrained'):
+def vgg16_tusimple(num_classes, scnn=False, pretrained_weights='pytorch-pretrained', flattened_size=6160):
     # Define Vgg16 for Tusimple (With only ImageNet pretraining)
     return deeplabv1_vgg16(pretrained_weights=pretrained_weights, num_classes=num_classes, num_lanes=num_classes - 1,
-                           dropout_1=0.1, flattened_size=6160, scnn=scnn)
+                           dropout_1=0.1, flattened_size=flattened_size, scnn=scnn)
 
 
-def vgg16_culane(num_classes, scnn=False, pretrained_weights='pytorch-pretrained'):
+def vgg16_culane(num_classes, scnn=False, pretrained_weights='pytorch-pretrained', flattened_size=4500):
     # Define Vgg16 for CULane (With only ImageNet pretraining)
     return deeplabv1_vgg16(pretrained_weights=pretrained_weights, num_classes=num_classes, num_lanes=num_classes - 1,
-                           dropout_1=0.1, flattened_size=4500, scnn=scnn)
+                           dropout_1=0.1, flattened_size=flattened_size, scnn=scnn)
 
 
-def resnet_tusimple(num_classes, backbone_name='resnet18', scnn=False):
+def resnet_tusimple(num_classes, backbone_name='resnet18', scnn=False, flattened_size=6160):
     # Define ResNets for Tusimple (With only ImageNet pretraining)
     model_map = {
         'resnet18': deeplabv1_resnet18,
@@ -46,10 +53,10 @@ def resnet_tusimple(num_classes, backbone_name='resnet18', scnn=False):
         'resnet101': deeplabv1_resnet101,
     }
     return model_map[backbone_name](pretrained=False, num_classes=num_classes, num_lanes=num_classes - 1,
-                                    channel_reduce=128, flattened_size=6160, scnn=scnn)
+                                    channel_reduce=128, flattened_size=flattened_size, scnn=scnn)
 
 
-def resnet_culane(num_classes, backbone_name='resnet18', scnn=False):
+def resnet_culane(num_classes, backbone_name='resnet18', scnn=False, flattened_size=4500):
     # Define ResNets for CULane (With only ImageNet pretraining)
     model_map = {
         'resnet18': deeplabv1_resnet18,
@@ -58,66 +65,157 @@ def resnet_culane(num_classes, backbone_name='resnet18', scnn=False):
         'resnet101': deeplabv1_resnet101,
     }
     return model_map[backbone_name](pretrained=False, num_classes=num_classes, num_lanes=num_classes - 1,
-                                    channel_reduce=128, flattened_size=4500, scnn=scnn)
+                                    channel_reduce=128, flattened_size=flattened_size, scnn=scnn)
 
 
-def enet_tusimple(num_classes, encoder_only, continue_from):
+def enet_tusimple(num_classes, encoder_only, continue_from, flattened_size=4400):
 
-    return enet_(num_classes=num_classes, num_lanes=num_classes - 1, dropout_1=0.01, dropout_2=0.1, flattened_size=4400,
-                 encoder_only=encoder_only, pretrained_weights=continue_from if not encoder_only else None)
+    return enet_(num_classes=num_classes, num_lanes=num_classes - 1, dropout_1=0.01, dropout_2=0.1,
+                 flattened_size=flattened_size, encoder_only=encoder_only,
+                 pretrained_weights=continue_from if not encoder_only else None)
 
 
-def enet_culane(num_classes, encoder_only, continue_from):
+def enet_culane(num_classes, encoder_only, continue_from, flattened_size=4500):
 
-    return enet_(num_classes=num_classes, num_lanes=num_classes - 1, dropout_1=0.01, dropout_2=0.1, flattened_size=4500,
-                 encoder_only=encoder_only, pretrained_weights=continue_from if not encoder_only else None)
+    return enet_(num_classes=num_classes, num_lanes=num_classes - 1, dropout_1=0.01, dropout_2=0.1,
+                 flattened_size=flattened_size, encoder_only=encoder_only,
+                 pretrained_weights=continue_from if not encoder_only else None)
 
 
-def init(batch_size, state, input_sizes, dataset, mean, std, base, workers=10):
+def lstr_tusimple(aux_loss=True):
+    # Define LSTR for TuSimple (reduced ResNet18, same settings as the original implementation)
+    return LSTR(res_dims=[16, 32, 64, 128], attn_dim=32, num_queries=7, aux_loss=aux_loss, pos_type='sine',
+                drop_out=0.1, num_heads=2, dim_feedforward=128, enc_layers=2, dec_layers=2, pre_norm=False,
+                return_intermediate=True, lsp_dim=8, mlp_layers=3, num_cls=1)
+
+
+def lstr_culane(aux_loss=True):
+    # Define LSTR for CULane (at most 4 lanes, same settings as TuSimple)
+    return LSTR(res_dims=[16, 32, 64, 128], attn_dim=32, num_queries=7, aux_loss=aux_loss, pos_type='sine',
+                drop_out=0.1, num_heads=2, dim_feedforward=128, enc_layers=2, dec_layers=2, pre_norm=False,
+                return_intermediate=True, lsp_dim=8, mlp_layers=3, num_cls=1)
+
+
+def lane_flattened_size(input_size, num_channels):
+    # Input size of the lane existence head's linear layer (output stride 8, then 2 x 2 pooling)
+    return (input_size[0] // 16) * (input_size[1] // 16) * num_channels
+
+
+def build_transforms(input_sizes, mean, std, crop_top=0):
+    # Return training & testing transforms
+    # crop_top > 0: crop the region of interest (remove top rows of the original image) before resizing
+    # ! Can't use torchvision.Transforms.Compose
+    crop = [CropTop(top=crop_top, height=input_sizes[1][0])] if crop_top > 0 else []
+    transforms_test = Compose(
+        crop + [Resize(size_image=input_sizes[0], size_label=input_sizes[0]),
+                ToTensorNormalize(mean=mean, std=std)])
+    transforms_train = Compose(
+        crop + [Resize(size_image=input_sizes[0], size_label=input_sizes[0]),
+                RandomRotation(degrees=3),
+                ToTensorNormalize(mean=mean, std=std)])
+
+    return transforms_train, transforms_test
+
+
+def keypoint_collate(batch):
+    # Pad keypoint targets (L x N x 2) with invalid lanes (x = -2) to the most lanes in this batch (at least 1)
+    # Return: images, targets (B x L x N x 2), lane_existence (B x L, 0 for padded lanes)
+    images = torch.stack([x[0] for x in batch])
+    num_points = batch[0][1].shape[1]
+    num_lanes = max([x[1].shape[0] for x in batch] + [1])
+    targets = torch.full((len(batch), num_lanes, num_points, 2), -2, dtype=torch.float32)
+    lane_existence = torch.zeros((len(batch), num_lanes), dtype=torch.float32)
+    for i, (_, target) in enumerate(batch):
+        targets[i, :target.shape[0]] = target
+        lane_existence[i, :target.shape[0]] = 1
+
+    return images, targets, lane_existence
+
+
+def keypoint_dataset(base, image_set, transforms, dataset):
+    # Lanes as keypoints (L x N x 2) instead of segmentation masks (e.g. for LSTR)
+    if dataset == 'tusimple':
+        return TuSimple(root=base, image_set=image_set, transforms=transforms)
+    elif dataset == 'culane':
+        return CULane(root=base, image_set=image_set, transforms=transforms)
+    else:
+        raise ValueError
+
+
+def init(batch_size, state, input_sizes, dataset, mean, std, base, workers=10, cache_dir=None,
+         batched_augmentation=False, device=None, channels_last=False, crop_top=0, keypoints=False):
     # Return data_loaders
     # depending on whether the state is
     # 0: training
     # 1: fast validation by mean IoU (validation set)
     # 2: just testing (test set)
     # 3: just testing (validation set)
+    # keypoints: train on keypoint targets (e.g. LSTR), without a validation loader (no mean IoU)
 
     # Transformations
-    # ! Can't use torchvision.Transforms.Compose
-    transforms_test = Compose(
-        [Resize(size_image=input_sizes[0], size_label=input_sizes[0]),
-         ToTensor(),
-         Normalize(mean=mean, std=std)])
-    transforms_train = Compose(
-        [Resize(size_image=input_sizes[0], size_label=input_sizes[0]),
-         RandomRotation(degrees=3),
-         ToTensor(),
-         Normalize(mean=mean, std=std)])
-
-    if state == 0:
-        data_set = StandardLaneDetectionDataset(root=base, image_set='train', transforms=transforms_train,
-                                                data_set=dataset)
-        data_loader = torch.utils.data.DataLoader(dataset=data_set, batch_size=batch_size,
-                                                  num_workers=workers, shuffle=True)
+    transforms_train, transforms_test = build_transforms(input_sizes=input_sizes, mean=mean, std=std,
+                                                         crop_top=crop_top)
+
+    if state == 0 and keypoints:
+        if cache_dir is not None:  # Caches are built for the segmentation style datasets
+            raise ValueError
+        data_set = keypoint_dataset(base=base, image_set='train', dataset=dataset,
+                                    transforms=ToUInt8Tensor() if batched_augmentation else transforms_train)
+        data_sampler = get_sampler(data_set, shuffle=True)
+        data_loader = torch.utils.data.DataLoader(dataset=data_set, batch_size=batch_size, collate_fn=keypoint_collate,
+                                                  num_workers=workers, shuffle=data_sampler is None,
+                                                  pin_memory=torch.cuda.is_available(), sampler=data_sampler)
+        if batched_augmentation:
+            data_loader = BatchedTransformsLoader(loader=data_loader, device=device,
+                                                  transforms=BatchedTransforms(
+                                                      transforms_train.transforms,
+                                                      memory_format=get_memory_format(channels_last)))
+        return data_loader, None
+
+    elif state == 0:
+        if batched_augmentation:  # Workers only decode, transforms_train is applied on device for each batch
+            data_set = StandardLaneDetectionDataset(root=base, image_set='train', transforms=ToUInt8Tensor(),
+                                                    data_set=dataset, cache_dir=cache_dir)
+            data_sampler = get_sampler(data_set, shuffle=True)
+            data_loader = torch.utils.data.DataLoader(dataset=data_set, batch_size=batch_size,
+                                                      num_workers=workers, shuffle=data_sampler is None,
+                                                      pin_memory=torch.cuda.is_available(), sampler=data_sampler)
+            data_loader = BatchedTransformsLoader(loader=data_loader, device=device,
+                                                  transforms=BatchedTransforms(
+                                                      transforms_train.transforms,
+                                                      memory_format=get_memory_format(channels_last)))
+        else:
+            data_set = StandardLaneDetectionDataset(root=base, image_set='train', transforms=transforms_train,
+                                                    data_set=dataset, cache_dir=cache_dir)
+            data_sampler = get_sampler(data_set, shuffle=True)
+            data_loader = torch.utils.data.DataLoader(dataset=data_set, batch_size=batch_size,
+                                                      num_workers=workers, shuffle=data_sampler is None,
+                                                      sampler=data_sampler)
         validation_set = StandardLaneDetectionDataset(root=base, image_set='val',
-                                                      transforms=transforms_test, data_set=dataset)
+                                                      transforms=transforms_test, data_set=dataset,
+                                                      cache_dir=cache_dir)
         validation_loader = torch.utils.data.DataLoader(dataset=validation_set, batch_size=batch_size * 4,
-                                                        num_workers=workers, shuffle=False)
+                                                        num_workers=workers, shuffle=False,
+                                                        pin_memory=torch.cuda.is_available(),
+                                                        sampler=get_sampler(validation_set, shuffle=False))
         return data_loader, validation_loader
 
     elif state == 1 or state == 2 or state == 3:
         image_sets = ['valfast', 'test', 'val']
         data_set = StandardLaneDetectionDataset(root=base, image_set=image_sets[state - 1],
-                                                transforms=transforms_test, data_set=dataset)
+                                                transforms=transforms_test, data_set=dataset, cache_dir=cache_dir)
         data_loader = torch.utils.data.DataLoader(dataset=data_set, batch_size=batch_size,
-                                                  num_workers=workers, shuffle=False)
+                                                  num_workers=workers, shuffle=False,
+                                                  pin_memory=torch.cuda.is_available())
         return data_loader
     else:
         raise ValueError
 
 
 def train_schedule(writer, loader, validation_loader, val_num_steps, device, criterion, net, optimizer, lr_scheduler,
-                   num_epochs, is_mixed_precision, input_sizes, exp_name, num_classes):
+                   num_epochs, is_mixed_precision, input_sizes, exp_name, num_classes, channels_last=False):
     # Should be the same as segmentation, given customized loss classes
+    memory_format = get_memory_format(channels_last)
     net.train()
     epoch = 0
     running_loss = 0.0
@@ -129,10 +227,12 @@ def train_schedule(writer, loader, validation_loader, val_num_steps, device, cri
     best_validation = 0
     while epoch < num_epochs:
         net.train()
+        set_epoch(loader, epoch)
         time_now = time.time()
         for i, data in enumerate(loader, 0):
             inputs, labels, lane_existence = data
             inputs, labels, lane_existence = inputs.to(device), labels.to(device), lane_existence.to(device)
+            inputs = to_memory_format(inputs, memory_format)
             optimizer.zero_grad()
 
             with autocast(is_mixed_precision):
@@ -154,9 +254,10 @@ def train_schedule(writer, loader, validation_loader, val_num_steps, device, cri
             # Record losses
             if current_step_num % loss_num_steps == (loss_num_steps - 1):
                 print('[%d, %d] loss: %.4f' % (epoch + 1, i + 1, running_loss / loss_num_steps))
-                writer.add_scalar('training loss',
-                                  running_loss / loss_num_steps,
-                                  current_step_num)
+                if writer is not None:
+                    writer.add_scalar('training loss',
+                                      running_loss / loss_num_steps,
+                                      current_step_num)
                 running_loss = 0.0
 
             # Record checkpoints
@@ -168,13 +269,15 @@ def train_schedule(writer, loader, validation_loader, val_num_steps, device, cri
 
                     test_pixel_accuracy, test_mIoU = fast_evaluate(loader=validation_loader, device=device, net=net,
                                                                    num_classes=num_classes, output_size=input_sizes[0],
-                                                                   is_mixed_precision=is_mixed_precision)
-                    writer.add_scalar('test pixel accuracy',
-                                      test_pixel_accuracy,
-                                      current_step_num)
-                    writer.add_scalar('test mIoU',
-                                      test_mIoU,
-                                      current_step_num)
+                                                                   is_mixed_precision=is_mixed_precision,
+                                                                   channels_last=channels_last)
+                    if writer is not None:
+                        writer.add_scalar('test pixel accuracy',
+                                          test_pixel_accuracy,
+                                          current_step_num)
+                        writer.add_scalar('test mIoU',
+                                          test_mIoU,
+                                          current_step_num)
                     net.train()
 
                     # Record best model (straight to disk)
@@ -191,18 +294,24 @@ def train_schedule(writer, loader, validation_loader, val_num_steps, device, cri
         save_checkpoint(net=net, optimizer=optimizer, lr_scheduler=lr_scheduler, filename=exp_name + '.pt')
 
 
-def fast_evaluate(net, device, loader, is_mixed_precision, output_size, num_classes):
+def fast_evaluate(net, device, loader, is_mixed_precision, output_size, num_classes, channels_last=False):
     # Fast evaluation (e.g. on the validation set) by pixel-wise mean IoU
     net.eval()
     conf_mat = ConfusionMatrix(num_classes)
+
+    def compute(image, target):
+        with autocast(is_mixed_precision):
+            output = net(image)['out']
+            if output.shape[-2:] != torch.Size(output_size):  # Skip when logits are already at output size
+                output = torch.nn.functional.interpolate(output, size=output_size, mode='bilinear',
+                                                         align_corners=True)
+            conf_mat.update(target, output.argmax(1))
+
     with torch.no_grad():
-        for image, target in tqdm(loader):
-            image, target = image.to(device), target.to(device)
-            with autocast(is_mixed_precision):
-                output = net(image)['out']
-                output = torch.nn.functional.interpolate(output, size=output_size, mode='bilinear', align_corners=True)
-                conf_mat.update(target.flatten(), output.argmax(1).flatten())
+        InferencePipeline(device=device, compute_fn=compute,
+                          memory_format=get_memory_format(channels_last) if channels_last else None).run(loader)
 
+    conf_mat.reduce_from_all_processes()
     acc_global, acc, iu = conf_mat.compute()
     print((
         'global correct: {:.2f}\n'
@@ -218,72 +327,80 @@ def fast_evaluate(net, device, loader, is_mixed_precision, output_size, num_clas
     return acc_global.item() * 100, iu.mean().item() * 100
 
 
+def limit_lanes(existence, max_lanes=5):
+    # Suppress existences (in place) of images with more than max_lanes predicted lanes
+    # existence: bool tensor size (B, num_lanes)
+    indices = (existence.sum(dim=1, keepdim=True) > max_lanes).expand_as(existence) * \
+              (existence == existence.min(dim=1, keepdim=True).values)
+    existence[indices] = 0
+
+    return existence
+
+
 # Adapted from harryhan618/SCNN_Pytorch
-def test_one_set(net, device, loader, is_mixed_precision, input_sizes, gap, ppl, thresh, dataset):
+def test_one_set(net, device, loader, is_mixed_precision, input_sizes, gap, ppl, thresh, dataset,
+                 channels_last=False, key_frame_interval=1, key_frame_threshold=0.2, crop_top=0, method='baseline'):
     # Predict on 1 data_loader and save predictions for the official script
-
-    all_lanes = []
+    # Forward & lane decoding on device (compute stage), lane formatting on CPU (post-processing stage),
+    # file writing is done asynchronously by a LaneWriter, closing it is the barrier before evaluation
+    # key_frame_interval > 1: the deep stage only runs on key frames of sequential video frames (ordered loader),
+    # other frames propagate its features (utils/key_frames.py)
+    # crop_top > 0: the loader crops this many top rows of the original image (ROI), lanes are in the full image
+    # method == 'lstr': lanes are sampled from the predicted curves instead of probability maps
+    # Return: ratio of key frames
+
+    if dataset not in ['culane', 'tusimple']:
+        raise ValueError
+    writer = LaneWriter(dataset=dataset, filenames=getattr(loader.dataset, 'masks', None), ppl=ppl,
+                        output_file='./output/tusimple_pred.json')
+    batch_indices = itertools.count()
     net.eval()
-    with torch.no_grad():
-        for images, filenames in tqdm(loader):
-            images = images.to(device)
+    reuse = KeyFrameReuse(net, max_interval=key_frame_interval, threshold=key_frame_threshold) \
+        if key_frame_interval > 1 else None
 
-            with autocast(is_mixed_precision):
-                outputs = net(images)
+    def compute(images, filenames):
+        with autocast(is_mixed_precision):
+            outputs = net(images) if reuse is None else reuse(images, filenames)
+            if method != 'lstr':
                 prob_map = torch.nn.functional.interpolate(outputs['out'], size=input_sizes[0], mode='bilinear',
                                                            align_corners=True).softmax(dim=1)
                 existence = (outputs['lane'].sigmoid() > 0.5)
                 if dataset == 'tusimple':  # At most 5 lanes
-                    indices = (existence.sum(dim=1, keepdim=True) > 5).expand_as(existence) * \
-                              (existence == existence.min(dim=1, keepdim=True).values)
-                    existence[indices] = 0
-
-            # To CPU
-            prob_map = prob_map.cpu().numpy()
-            existence = existence.cpu().numpy()
-
-            # Get coordinates for lanes
-            for j in range(existence.shape[0]):
-                lane_coordinates = prob_to_lines(prob_map[j], existence[j], resize_shape=input_sizes[1],
-                                                 gap=gap, ppl=ppl, thresh=thresh, dataset=dataset)
-
-                if dataset == 'culane':
-                    # Save each lane to disk
-                    dir_name = filenames[j][:filenames[j].rfind('/')]
-                    if not os.path.exists(dir_name):
-                        os.makedirs(dir_name)
-                    with open(filenames[j], "w") as f:
-                        for lane in lane_coordinates:
-                            if lane:  # No printing for []
-                                for (x, y) in lane:
-                                    print("{} {}".format(x, y), end=" ", file=f)
-                                print(file=f)
-                elif dataset == 'tusimple':
-                    # Save lanes to a single file
-                    formatted = {
-                        "h_samples": [160 + y * 10 for y in range(ppl)],
-                        "lanes": lane_coordinates,
-                        "run_time": 0,
-                        "raw_file": filenames[j]
-                    }
-                    all_lanes.append(json.dumps(formatted))
-                else:
-                    raise ValueError
+                    existence = limit_lanes(existence, max_lanes=5)
 
-    if dataset == 'tusimple':
-        with open('./output/tusimple_pred.json', 'w') as f:
-            for lane in all_lanes:
-                print(lane, end="\n", file=f)
+        # Get coordinates for lanes (decoded on the same device, only coordinates are copied to CPU)
+        if method == 'lstr':
+            coords, keep = get_curves_batched(outputs['logits'], outputs['curves'], gap=gap, ppl=ppl,
+                                              resize_shape=input_sizes[1], dataset=dataset, crop_top=crop_top,
+                                              max_lanes=5 if dataset == 'tusimple' else None)
+        else:
+            coords = get_lane_batched(prob_map[:, 1:, :, :], gap=gap, ppl=ppl, thresh=thresh,
+                                      resize_shape=input_sizes[1], dataset=dataset, crop_top=crop_top)
+            keep = (existence > 0) & (coords.sum(dim=-1) != 0)
+
+        return coords, keep, filenames, next(batch_indices)
+
+    def post(coords, keep, filenames, index):
+        # Save lanes to disk in the background (blocks only when the writer falls behind)
+        batch_coordinates = format_lanes_batched(coords, keep, resize_shape=input_sizes[1], gap=gap, dataset=dataset)
+        writer.put(filenames, batch_coordinates, index=index)
+
+    with torch.no_grad(), writer:
+        InferencePipeline(device=device, compute_fn=compute, post_fn=post,
+                          memory_format=get_memory_format(channels_last) if channels_last else None).run(loader)
+
+    return 1.0 if reuse is None else reuse.report()
 
 
 # Adapted from harryhan618/SCNN_Pytorch
 # Note that in tensors we have indices start from 0 and in annotations coordinates start at 1
-def get_lane(prob_map, gap, ppl, thresh, resize_shape=None, dataset='culane'):
+def get_lane(prob_map, gap, ppl, thresh, resize_shape=None, dataset='culane', crop_top=0):
     """
     Arguments:
     ----------
     prob_map: prob map for single lane, np array size (h, w)
     resize_shape:  reshape size target, (H, W)
+    crop_top: rows above the prob map in resized shape (ROI inference), coords are still in the full resized shape
     Return:
     ----------
     coords: x coords bottom up every gap px, 0 for non-exist, in resized shape
@@ -297,12 +414,12 @@ def get_lane(prob_map, gap, ppl, thresh, resize_shape=None, dataset='culane'):
     coords = np.zeros(ppl)
     for i in range(ppl):
         if dataset == 'tusimple':  # Annotation start at 10 pixel away from bottom
-            y = int(h - (ppl - i) * gap / H * h)
+            y = int(h - (ppl - i) * gap / (H - crop_top) * h)
         elif dataset == 'culane':  # Annotation start at bottom
-            y = int(h - i * gap / H * h - 1)  # Same as original SCNN code
+            y = int(h - i * gap / (H - crop_top) * h - 1)  # Same as original SCNN code
         else:
             raise ValueError
-        if y < 0:
+        if y < 0:  # Out of the prob map
             break
         line = prob_map[y, :]
         id = np.argmax(line)
@@ -314,7 +431,8 @@ def get_lane(prob_map, gap, ppl, thresh, resize_shape=None, dataset='culane'):
 
 
 # Adapted from harryhan618/SCNN_Pytorch
-def prob_to_lines(seg_pred, exist, resize_shape=None, smooth=True, gap=20, ppl=None, thresh=0.3, dataset='culane'):
+def prob_to_lines(seg_pred, exist, resize_shape=None, smooth=True, gap=20, ppl=None, thresh=0.3, dataset='culane',
+                  crop_top=0):
     """
     Arguments:
     ----------
@@ -326,6 +444,7 @@ def prob_to_lines(seg_pred, exist, resize_shape=None, smooth=True, gap=20, ppl=N
     ppl:     how many points for one lane
     thresh:  probability threshold
     all_points: Whether to save all sample points or just points predicted as lane
+    crop_top: rows cropped above seg_pred in resized shape (ROI inference), 0: seg_pred covers the full image
     Return:
     ----------
     coordinates: [x, y] list of lanes, e.g.: [ [[9, 569], [50, 549]] ,[[630, 569], [647, 549]] ]
@@ -344,7 +463,7 @@ def prob_to_lines(seg_pred, exist, resize_shape=None, smooth=True, gap=20, ppl=N
         if exist[i - 1]:
             if smooth:
                 prob_map = cv2.blur(prob_map, (9, 9), borderType=cv2.BORDER_REPLICATE)
-            coords = get_lane(prob_map, gap, ppl, thresh, resize_shape, dataset=dataset)
+            coords = get_lane(prob_map, gap, ppl, thresh, resize_shape, dataset=dataset, crop_top=crop_top)
             if coords.sum() == 0:
                 continue
             if dataset == 'tusimple':  # Invalid sample points need to be included as negative value, e.g. -2
@@ -357,29 +476,202 @@ def prob_to_lines(seg_pred, exist, resize_shape=None, smooth=True, gap=20, ppl=N
     return coordinates
 
 
-def build_lane_detection_model(args, num_classes):
+# Sampled row indices (h space) for each point of a lane, None for rows where get_lane() stops sampling
+def _sample_rows(h, H, gap, ppl, dataset, crop_top=0):
+    rows = []
+    for i in range(ppl):
+        if dataset == 'tusimple':  # Annotation start at 10 pixel away from bottom
+            y = int(h - (ppl - i) * gap / (H - crop_top) * h)
+        elif dataset == 'culane':  # Annotation start at bottom
+            y = int(h - i * gap / (H - crop_top) * h - 1)  # Same as original SCNN code
+        else:
+            raise ValueError
+        if y < 0:
+            rows += [None] * (ppl - i)
+            break
+        rows.append(y)
+
+    return rows
+
+
+# Batched & vectorized get_lane() on tensors, works on any device
+def get_lane_batched(prob_maps, gap, ppl, thresh, resize_shape, dataset='culane', smooth=True, crop_top=0):
+    """
+    Arguments:
+    ----------
+    prob_maps: prob maps for lanes, torch tensor size (B, L, h, w)
+    resize_shape:  reshape size target, (H, W)
+    smooth:  whether to smooth the probability (9 x 9 box filter with replicated borders, same as cv2.blur)
+    crop_top: same as get_lane()
+    Return:
+    ----------
+    coords: x coords bottom up every gap px, 0 for non-exist, in resized shape, float64 tensor size (B, L, ppl)
+    """
+    B, L, h, w = prob_maps.shape
+    H, W = resize_shape
+    rows = _sample_rows(h, H, gap, ppl, dataset, crop_top=crop_top)
+    valid = torch.tensor([y is not None for y in rows], dtype=torch.bool, device=prob_maps.device)
+    rows = torch.tensor([0 if y is None else y for y in rows], dtype=torch.int64, device=prob_maps.device)
+    prob_maps = prob_maps.float()
+
+    if smooth:
+        # A box filter is separable, only the 9 neighbouring rows of each sampled row are needed
+        # Replicated border == clamped indices
+        offsets = torch.arange(-4, 5, dtype=torch.int64, device=prob_maps.device)
+        indices = (rows[:, None] + offsets[None, :]).clamp_(0, h - 1).flatten()
+        lines = prob_maps[:, :, indices, :].view(B, L, ppl, 9, w).mean(dim=3)
+        lines = torch.nn.functional.pad(lines.view(B * L, ppl, w), (4, 4), mode='replicate')
+        lines = torch.nn.functional.avg_pool1d(lines, kernel_size=9, stride=1).view(B, L, ppl, w)
+    else:
+        lines = prob_maps[:, :, rows, :]
+
+    values, ids = lines.max(dim=-1)
+    coords = (ids.double() / w * W).floor()
+    coords = coords * ((values > thresh) & valid)
+    coords = coords * ((coords > 0).sum(dim=-1, keepdim=True) >= 2)
+
+    return coords
+
+
+# Batched version of prob_to_lines(), the network output could stay on GPU
+def prob_to_lines_batched(seg_pred, exist, resize_shape, smooth=True, gap=20, ppl=None, thresh=0.3,
+                          dataset='culane', crop_top=0):
+    """
+    Arguments:
+    ----------
+    seg_pred: torch tensor size (B, num_classes, h, w)
+    resize_shape:  reshape size target, (H, W)
+    exist:   torch tensor size (B, num_classes - 1) of existence
+    Other arguments are the same as prob_to_lines()
+    Return:
+    ----------
+    coordinates: list (length B) of lanes, each in the same format as prob_to_lines()
+    """
+    H, W = resize_shape
+    if ppl is None:
+        ppl = round(H / 2 / gap)
+
+    coords = get_lane_batched(seg_pred[:, 1:, :, :], gap=gap, ppl=ppl, thresh=thresh, resize_shape=resize_shape,
+                              dataset=dataset, smooth=smooth, crop_top=crop_top)
+    keep = (exist > 0) & (coords.sum(dim=-1) != 0)
+
+    # Only the coordinates go to CPU
+    return format_lanes_batched(coords.cpu(), keep.cpu(), resize_shape=resize_shape, gap=gap, dataset=dataset)
+
+
+# Lanes from LSTR curves, sampled at the same rows as get_lane_batched(), works on any device
+def get_curves_batched(logits, curves, gap, ppl, resize_shape, dataset='culane', crop_top=0, max_lanes=None):
+    """
+    Arguments:
+    ----------
+    logits: LSTR class logits, torch tensor size (B, Q, 2)
+    curves: LSTR curves in normalized input coordinates, torch tensor size (B, Q, lsp_dim)
+    resize_shape:  reshape size target, (H, W)
+    crop_top: same as get_lane()
+    max_lanes: keep at most this many lanes with the highest lane probabilities, None for no limit
+    Return:
+    ----------
+    coords: x coords bottom up every gap px, 0 for non-exist, in resized shape, float64 tensor size (B, Q, ppl)
+    keep: lanes predicted as lanes with at least 2 points, bool tensor size (B, Q)
+    """
+    H, W = resize_shape
+    indices = torch.arange(ppl, dtype=torch.float64, device=curves.device)
+    if dataset == 'tusimple':  # Annotation start at 10 pixel away from bottom
+        rows = H - (ppl - indices) * gap
+    elif dataset == 'culane':  # Annotation start at bottom
+        rows = H - indices * gap - 1
+    else:
+        raise ValueError
+    ys = (rows - crop_top) / (H - crop_top)  # Normalized y in the network input
+
+    # Points between the lowest & highest y of each curve, inside the image
+    curves = curves.double()
+    xs = evaluate_curves(curves, ys)
+    valid = (ys >= curves[..., 0:1]) & (ys <= curves[..., 1:2]) & (ys >= 0) & (xs >= 0) & (xs < 1)
+    coords = torch.where(valid, xs * W, torch.zeros_like(xs))
+
+    probs = logits.float().softmax(dim=-1)
+    keep = (probs.argmax(dim=-1) == 1) & ((coords > 0).sum(dim=-1) >= 2)
+    if max_lanes is not None and keep.shape[1] > max_lanes:
+        ranks = torch.where(keep, probs[..., 1], -torch.ones_like(probs[..., 1])) \
+            .argsort(dim=1, descending=True).argsort(dim=1)
+        keep = keep & (ranks < max_lanes)
+
+    return coords, keep
+
+
+# Batched lane decoding for LSTR, same as prob_to_lines_batched()
+def curves_to_lines_batched(logits, curves, resize_shape, gap=20, ppl=None, dataset='culane', crop_top=0,
+                            max_lanes=None):
+    H, W = resize_shape
+    if ppl is None:
+        ppl = round(H / 2 / gap)
+
+    coords, keep = get_curves_batched(logits, curves, gap=gap, ppl=ppl, resize_shape=resize_shape, dataset=dataset,
+                                      crop_top=crop_top, max_lanes=max_lanes)
+
+    # Only the coordinates go to CPU
+    return format_lanes_batched(coords.cpu(), keep.cpu(), resize_shape=resize_shape, gap=gap, dataset=dataset)
+
+
+def format_lanes_batched(coords, keep, resize_shape, gap=20, dataset='culane'):
+    # Format lanes from get_lane_batched() (on CPU) in the same way as prob_to_lines()
+    # coords: (B, num_lanes, ppl), keep: (B, num_lanes)
+    H, W = resize_shape
+    coords = coords.tolist()
+    keep = keep.tolist()
+    coordinates = []
+    for i in range(len(coords)):
+        lanes = []
+        for j in range(len(coords[i])):
+            if not keep[i][j]:
+                continue
+            if dataset == 'tusimple':  # Invalid sample points need to be included as negative value, e.g. -2
+                lanes.append([x if x > 0 else -2 for x in coords[i][j]])
+            elif dataset == 'culane':
+                lanes.append([[x, H - k * gap - 1] for k, x in enumerate(coords[i][j]) if x > 0])
+            else:
+                raise ValueError
+        coordinates.append(lanes)
+
+    return coordinates
+
+
+def build_lane_detection_model(args, num_classes, input_size=None):
+    # input_size: (h, w) for the lane existence head, None for the default training size (e.g. ROI inputs)
+    # LSTR has its own backbone (reduced ResNet18) and works for any input size
     scnn = True if args.method == 'scnn' else False
-    if args.dataset == 'tusimple' and args.backbone == 'erfnet':
-        net = erfnet_tusimple(num_classes=num_classes, scnn=scnn)
+    kwargs = {}
+    if input_size is not None and args.method != 'lstr':  # ERFNet & ENet existence heads have 5 channels
+        kwargs['flattened_size'] = lane_flattened_size(
+            input_size, num_channels=5 if args.backbone in ['erfnet', 'enet'] else num_classes)
+    if args.method == 'lstr' and args.dataset == 'tusimple':
+        net = lstr_tusimple()
+    elif args.method == 'lstr' and args.dataset == 'culane':
+        net = lstr_culane()
+    elif args.dataset == 'tusimple' and args.backbone == 'erfnet':
+        net = erfnet_tusimple(num_classes=num_classes, scnn=scnn, **kwargs)
     elif args.dataset == 'culane' and args.backbone == 'erfnet':
-        net = erfnet_culane(num_classes=num_classes, scnn=scnn)
+        net = erfnet_culane(num_classes=num_classes, scnn=scnn, **kwargs)
     elif args.dataset == 'culane' and args.backbone == 'vgg16':
-        net = vgg16_culane(num_classes=num_classes, scnn=scnn)
+        net = vgg16_culane(num_classes=num_classes, scnn=scnn, **kwargs)
     elif args.dataset == 'tusimple' and args.backbone == 'vgg16':
-        net = vgg16_tusimple(num_classes=num_classes, scnn=scnn)
+        net = vgg16_tusimple(num_classes=num_classes, scnn=scnn, **kwargs)
     elif args.dataset == 'tusimple' and 'resnet' in args.backbone:
-        net = resnet_tusimple(num_classes=num_classes, scnn=scnn, backbone_name=args.backbone)
+        net = resnet_tusimple(num_classes=num_classes, scnn=scnn, backbone_name=args.backbone, **kwargs)
     elif args.dataset == 'culane' and 'resnet' in args.backbone:
-        net = resnet_culane(num_classes=num_classes, scnn=scnn, backbone_name=args.backbone)
+        net = resnet_culane(num_classes=num_classes, scnn=scnn, backbone_name=args.backbone, **kwargs)
     elif args.dataset == 'tusimple' and args.backbone == 'enet':
         net = enet_tusimple(num_classes=num_classes, encoder_only=args.encoder_only,
-                            continue_from=args.continue_from)
+                            continue_from=args.continue_from, **kwargs)
     elif args.dataset == 'culane' and args.backbone == 'enet':
         net = enet_culane(num_classes=num_classes, encoder_only=args.encoder_only,
-                            continue_from=args.continue_from)
-    elif args.method == 'lstr':
-        pass
+                          continue_from=args.continue_from, **kwargs)
     else:
         raise ValueError
+    if scnn:
+        set_spatial_conv_engine(net, engine=args.scnn_engine)
+    if args.channels_last:
+        to_channels_last(net)
 
     return net
@@ -1,14 +1,18 @@
 import time
 from collections import OrderedDict
+from contextlib import nullcontext
 import torch
 import warnings
 from torch.cuda.amp import autocast, GradScaler
-from tqdm import tqdm
 from torchvision_models.segmentation import deeplabv2_resnet101, deeplabv3_resnet101, fcn_resnet101, erfnet_resnet, \
     enet_
 from transforms import ToTensor, Normalize, RandomHorizontalFlip, Resize, RandomCrop, RandomTranslation, \
-    ZeroPad, LabelMap, RandomScale, Compose
+    ZeroPad, LabelMap, RandomScale, Compose, ToTensorNormalize, ToUInt8Tensor, BatchedTransforms, \
+    BatchedTransformsLoader
 from utils.datasets import StandardSegmentationDataset
+from utils.inference_pipeline import InferencePipeline
+from utils.distributed import is_main_process, unwrap_model, get_sampler, set_epoch
+from utils.memory_format import get_memory_format, to_memory_format, to_channels_last
 
 
 def fcn(num_classes):
@@ -39,21 +43,73 @@ def enet(num_classes, encoder_only, continue_from):
 
 # Copied and simplified from torch/vision/references/segmentation
 class ConfusionMatrix(object):
-    def __init__(self, num_classes):
+    # Accumulated on device, labels out of [0, num_classes) (e.g. 255) are ignored
+    # per_image: also keep the mean IoU of each image (over classes in its label or prediction) to find worst frames
+    def __init__(self, num_classes, per_image=False):
         self.num_classes = num_classes
+        self.per_image = per_image
         self.mat = None
+        self.image_ious = []
 
     def update(self, a, b):
+        # a: labels, b: predictions (B x H x W, or flattened if not per_image)
         n = self.num_classes
         if self.mat is None:
             self.mat = torch.zeros((n, n), dtype=torch.int64, device=a.device)
         with torch.no_grad():
-            k = (a >= 0) & (a < n)
-            inds = n * a[k].to(torch.int64) + b[k]
-            self.mat += torch.bincount(inds, minlength=n ** 2).reshape(n, n)
+            # Fused int32 flat index (no boolean gather), ignored pixels go to an extra bin n * n
+            batch_size = a.shape[0] if self.per_image else 1
+            a = a.reshape(batch_size, -1).to(torch.int32)
+            b = b.reshape(batch_size, -1).to(torch.int32)
+            inds = torch.where((a >= 0) & (a < n), a * n + b, torch.full_like(a, n * n))
+            if batch_size > 1:
+                inds += torch.arange(0, batch_size * (n * n + 1), n * n + 1, dtype=torch.int32,
+                                     device=a.device).unsqueeze(1)
+            counts = torch.bincount(inds.flatten(), minlength=batch_size * (n * n + 1))
+            counts = counts.view(batch_size, n * n + 1)[:, :-1].reshape(batch_size, n, n)
+            self.mat += counts.sum(dim=0)
+            if self.per_image:
+                diag = counts.diagonal(dim1=1, dim2=2)
+                union = counts.sum(dim=1) + counts.sum(dim=2) - diag
+                present = union > 0
+                iu = diag.float() / union.clamp(min=1).float()
+                self.image_ious.append((iu * present).sum(dim=1) / present.sum(dim=1).clamp(min=1).float())
 
     def reset(self):
         self.mat.zero_()
+        self.image_ious = []
+
+    def reduce_from_all_processes(self):
+        # Sum over processes for exact global metrics,
+        # per-image IoUs are gathered in dataset order (EvaluationSampler: rank, rank + world size, ...)
+        if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+            return
+        torch.distributed.barrier()
+        if self.mat is None:  # No images in this process
+            device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else 'cpu'
+            self.mat = torch.zeros((self.num_classes, self.num_classes), dtype=torch.int64, device=device)
+        torch.distributed.all_reduce(self.mat)
+        if self.per_image:
+            world_size = torch.distributed.get_world_size()
+            ious = torch.cat(self.image_ious) if len(self.image_ious) > 0 else \
+                torch.zeros(0, device=self.mat.device)
+            lengths = [torch.zeros(1, dtype=torch.int64, device=ious.device) for _ in range(world_size)]
+            torch.distributed.all_gather(lengths, torch.tensor([ious.shape[0]], device=ious.device))
+            lengths = [x.item() for x in lengths]
+            padded = torch.full((max(lengths),), float('inf'), device=ious.device)  # Padding only at the end
+            padded[:ious.shape[0]] = ious
+            gathered = [torch.empty_like(padded) for _ in range(world_size)]
+            torch.distributed.all_gather(gathered, padded)
+            self.image_ious = [torch.stack(gathered, dim=1).flatten()[:sum(lengths)]]
+
+    def worst(self, k=10):
+        # Dataset indices (after reduce_from_all_processes() in distributed testing) & mean IoUs of the k worst images
+        if len(self.image_ious) == 0:
+            return [], []
+        ious = torch.cat(self.image_ious).cpu()
+        values, indices = ious.topk(min(k, ious.shape[0]), largest=False)
+
+        return indices.tolist(), values.tolist()
 
     def compute(self):
         h = self.mat.float()
@@ -63,10 +119,12 @@ class ConfusionMatrix(object):
         return acc_global, acc, iu
 
 
-# Save model checkpoints (supports amp)
+# Save model checkpoints (supports amp), only from the main process in distributed training
 def save_checkpoint(net, optimizer, lr_scheduler, filename='temp.pt'):
+    if not is_main_process():
+        return
     checkpoint = {
-        'model': net.state_dict(),
+        'model': unwrap_model(net).state_dict(),
         'optimizer': optimizer.state_dict() if optimizer is not None else None,
         'lr_scheduler': lr_scheduler.state_dict() if lr_scheduler is not None else None
     }
@@ -79,7 +137,7 @@ def load_checkpoint(net, optimizer, lr_scheduler, filename):
     # To keep BC while having a acceptable variable name for lane detection
     checkpoint['model'] = OrderedDict((k.replace('aux_head', 'lane_classifier') if 'aux_head' in k else k, v)
                                       for k, v in checkpoint['model'].items())
-    net.load_state_dict(checkpoint['model'])
+    unwrap_model(net).load_state_dict(checkpoint['model'])
 
     if optimizer is not None:
         try:  # Shouldn't be necessary, but just in case
@@ -95,19 +153,9 @@ def load_checkpoint(net, optimizer, lr_scheduler, filename):
             pass
 
 
-def init(batch_size, state, input_sizes, std, mean, dataset, train_base, train_label_id_map,
-         test_base=None, test_label_id_map=None, city_aug=0, workers=8):
-    # Return data_loaders
-    # depending on whether the state is
-    # 1: training
-    # 2: just testing
-
-    # Transformations
+def build_transforms(dataset, input_sizes, mean, std, city_aug, train_label_id_map, test_label_id_map):
+    # Return training & testing transforms
     # ! Can't use torchvision.Transforms.Compose
-    if test_base is None:
-        test_base = train_base
-    if test_label_id_map is None:
-        test_label_id_map = train_label_id_map
     if dataset == 'voc':
         transform_train = Compose(
             [ToTensor(),
@@ -141,9 +189,8 @@ def init(batch_size, state, input_sizes, std, mean, dataset, train_base, train_l
                      Normalize(mean=mean, std=std),
                      LabelMap(train_label_id_map, outlier=outlier)])
             transform_test = Compose(
-                [ToTensor(),
+                [ToTensorNormalize(mean=mean, std=std),  # Normalization commutes with bilinear resizing
                  Resize(size_image=input_sizes[2], size_label=input_sizes[2]),
-                 Normalize(mean=mean, std=std),
                  LabelMap(test_label_id_map)])
         elif city_aug == 2:  # ERFNet and ENet
             transform_train = Compose(
@@ -165,9 +212,8 @@ def init(batch_size, state, input_sizes, std, mean, dataset, train_base, train_l
                  RandomHorizontalFlip(flip_prob=0.5),
                  Normalize(mean=mean, std=std)])
             transform_test = Compose(
-                [ToTensor(),
+                [ToTensorNormalize(mean=mean, std=std),  # Normalization commutes with bilinear resizing
                  Resize(size_image=input_sizes[2], size_label=input_sizes[2]),
-                 Normalize(mean=mean, std=std),
                  LabelMap(test_label_id_map)])
         else:  # Standard city
             transform_train = Compose(
@@ -180,39 +226,82 @@ def init(batch_size, state, input_sizes, std, mean, dataset, train_base, train_l
                  Normalize(mean=mean, std=std),
                  LabelMap(train_label_id_map, outlier=outlier)])
             transform_test = Compose(
-                [ToTensor(),
+                [ToTensorNormalize(mean=mean, std=std),  # Normalization commutes with bilinear resizing
                  Resize(size_image=input_sizes[2], size_label=input_sizes[2]),
-                 Normalize(mean=mean, std=std),
                  LabelMap(test_label_id_map)])
     else:
         raise ValueError
 
+    return transform_train, transform_test
+
+
+def init(batch_size, state, input_sizes, std, mean, dataset, train_base, train_label_id_map,
+         test_base=None, test_label_id_map=None, city_aug=0, workers=8, cache_dir=None, batched_augmentation=False,
+         device=None, channels_last=False):
+    # Return data_loaders
+    # depending on whether the state is
+    # 1: training
+    # 2: just testing
+
+    # Transformations
+    if test_base is None:
+        test_base = train_base
+    if test_label_id_map is None:
+        test_label_id_map = train_label_id_map
+    transform_train, transform_test = build_transforms(dataset=dataset, input_sizes=input_sizes, mean=mean, std=std,
+                                                       city_aug=city_aug, train_label_id_map=train_label_id_map,
+                                                       test_label_id_map=test_label_id_map)
+
     # Not the actual test set (i.e. validation set)
     test_set = StandardSegmentationDataset(root=test_base, image_set='val', transforms=transform_test,
-                                           data_set='city' if dataset == 'gtav' or dataset == 'synthia' else dataset)
+                                           data_set='city' if dataset == 'gtav' or dataset == 'synthia' else dataset,
+                                           cache_dir=cache_dir)
     if (city_aug == 1 or city_aug == 3) and state == 0:  # Avoid OOM
-        val_loader = torch.utils.data.DataLoader(dataset=test_set, batch_size=2, num_workers=workers, shuffle=False)
+        val_loader = torch.utils.data.DataLoader(dataset=test_set, batch_size=2, num_workers=workers, shuffle=False,
+                                                 pin_memory=torch.cuda.is_available(),
+                                                 sampler=get_sampler(test_set, shuffle=False))
     else:
         val_loader = torch.utils.data.DataLoader(dataset=test_set, batch_size=batch_size, num_workers=workers,
-                                                 shuffle=False)
+                                                 shuffle=False, pin_memory=torch.cuda.is_available(),
+                                                 sampler=get_sampler(test_set, shuffle=False))
 
     # Testing
     if state == 1:
         return val_loader
     else:
         # Training
-        train_set = StandardSegmentationDataset(root=train_base, image_set='trainaug' if dataset == 'voc' else 'train',
-                                                transforms=transform_train, data_set=dataset)
-        train_loader = torch.utils.data.DataLoader(dataset=train_set, batch_size=batch_size,
-                                                   num_workers=workers, shuffle=True)
+        if batched_augmentation:  # Workers only decode, transform_train is applied on device for each batch
+            if dataset == 'voc' or dataset == 'gtav':  # Various image sizes can't be batched before resizing
+                raise ValueError
+            train_set = StandardSegmentationDataset(root=train_base, image_set='train', transforms=ToUInt8Tensor(),
+                                                    data_set=dataset, cache_dir=cache_dir)
+            train_sampler = get_sampler(train_set, shuffle=True)
+            train_loader = torch.utils.data.DataLoader(dataset=train_set, batch_size=batch_size,
+                                                       num_workers=workers, shuffle=train_sampler is None,
+                                                       pin_memory=torch.cuda.is_available(), sampler=train_sampler)
+            train_loader = BatchedTransformsLoader(loader=train_loader, device=device,
+                                                   transforms=BatchedTransforms(
+                                                       transform_train.transforms,
+                                                       memory_format=get_memory_format(channels_last)))
+        else:
+            train_set = StandardSegmentationDataset(root=train_base,
+                                                    image_set='trainaug' if dataset == 'voc' else 'train',
+                                                    transforms=transform_train, data_set=dataset, cache_dir=cache_dir)
+            train_sampler = get_sampler(train_set, shuffle=True)
+            train_loader = torch.utils.data.DataLoader(dataset=train_set, batch_size=batch_size,
+                                                       num_workers=workers, shuffle=train_sampler is None,
+                                                       sampler=train_sampler)
         return train_loader, val_loader
 
 
 def train_schedule(writer, loader, val_num_steps, validation_loader, device, criterion, net, optimizer, lr_scheduler,
                    num_epochs, is_mixed_precision, num_classes, categories, input_sizes, selector, classes,
-                   encoder_only):
+                   encoder_only, channels_last=False, accumulation_steps=1):
     # Poly training schedule
     # Validate and find the best snapshot
+    # Gradients of accumulation_steps batches are averaged before each optimizer step (lr_scheduler also steps once),
+    # i.e. the effective batch size is accumulation_steps x batch size
+    memory_format = get_memory_format(channels_last)
     best_mIoU = 0
     net.train()
     epoch = 0
@@ -224,47 +313,62 @@ def train_schedule(writer, loader, val_num_steps, validation_loader, device, cri
     # Training
     while epoch < num_epochs:
         net.train()
+        set_epoch(loader, epoch)
         conf_mat = ConfusionMatrix(num_classes)
         time_now = time.time()
+        num_samples = 0
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        optimizer.zero_grad()
         for i, data in enumerate(loader, 0):
             inputs, labels = data
-            inputs, labels = inputs.to(device), labels.to(device)
-            optimizer.zero_grad()
-
-            with autocast(is_mixed_precision):
-                outputs = net(inputs)['out']
-
-                if encoder_only:
-                    labels = labels.unsqueeze(0)
-                    if labels.dtype not in (torch.float32, torch.float64):
-                        labels = labels.to(torch.float32)
-                    labels = torch.nn.functional.interpolate(labels, size=input_sizes[1], mode='nearest')
-                    labels = labels.to(torch.int64)
-                    labels = labels.squeeze(0)
+            inputs, labels = to_memory_format(inputs.to(device), memory_format), labels.to(device)
+            num_samples += inputs.shape[0]
+            # The last group of an epoch can be smaller
+            group_start = i - i % accumulation_steps
+            group_size = min(accumulation_steps, len(loader) - group_start)
+            is_step = i == group_start + group_size - 1
+            # No gradient all-reduce (DDP) until the last batch of a group
+            with nullcontext() if is_step or not hasattr(net, 'no_sync') else net.no_sync():
+                with autocast(is_mixed_precision):
+                    outputs = net(inputs)['out']
+
+                    if encoder_only:
+                        labels = labels.unsqueeze(0)
+                        if labels.dtype not in (torch.float32, torch.float64):
+                            labels = labels.to(torch.float32)
+                        labels = torch.nn.functional.interpolate(labels, size=input_sizes[1], mode='nearest')
+                        labels = labels.to(torch.int64)
+                        labels = labels.squeeze(0)
+                    else:
+                        outputs = torch.nn.functional.interpolate(outputs, size=input_sizes[0], mode='bilinear',
+                                                                  align_corners=True)
+                    conf_mat.update(labels.flatten(), outputs.argmax(1).flatten())
+                    loss = criterion(outputs, labels)
+
+                if is_mixed_precision:
+                    scaler.scale(loss / group_size).backward()
                 else:
-                    outputs = torch.nn.functional.interpolate(outputs, size=input_sizes[0], mode='bilinear',
-                                                              align_corners=True)
-                conf_mat.update(labels.flatten(), outputs.argmax(1).flatten())
-                loss = criterion(outputs, labels)
-
-            if is_mixed_precision:
-                scaler.scale(loss).backward()
-                scaler.step(optimizer)
-                scaler.update()
-            else:
-                loss.backward()
-                optimizer.step()
+                    (loss / group_size).backward()
 
-            lr_scheduler.step()
+            if is_step:
+                if is_mixed_precision:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
+                optimizer.zero_grad()
+                lr_scheduler.step()
             running_loss += loss.item()
             current_step_num = int(epoch * len(loader) + i + 1)
 
             # Record losses
             if current_step_num % loss_num_steps == (loss_num_steps - 1):
                 print('[%d, %d] loss: %.4f' % (epoch + 1, i + 1, running_loss / loss_num_steps))
-                writer.add_scalar('training loss',
-                                  running_loss / loss_num_steps,
-                                  current_step_num)
+                if writer is not None:
+                    writer.add_scalar('training loss',
+                                      running_loss / loss_num_steps,
+                                      current_step_num)
                 running_loss = 0.0
 
             # Validate and find the best snapshot
@@ -274,13 +378,14 @@ def train_schedule(writer, loader, val_num_steps, validation_loader, device, cri
                                                               output_size=input_sizes[2], labels_size=input_sizes[1],
                                                               selector=selector, classes=classes,
                                                               is_mixed_precision=is_mixed_precision,
-                                                              encoder_only=encoder_only)
-                writer.add_scalar('test pixel accuracy',
-                                  test_pixel_accuracy,
-                                  current_step_num)
-                writer.add_scalar('test mIoU',
-                                  test_mIoU,
-                                  current_step_num)
+                                                              encoder_only=encoder_only, channels_last=channels_last)
+                if writer is not None:
+                    writer.add_scalar('test pixel accuracy',
+                                      test_pixel_accuracy,
+                                      current_step_num)
+                    writer.add_scalar('test mIoU',
+                                      test_mIoU,
+                                      current_step_num)
                 net.train()
 
                 # Record best model (straight to disk)
@@ -289,6 +394,7 @@ def train_schedule(writer, loader, val_num_steps, validation_loader, device, cri
                     save_checkpoint(net=net, optimizer=optimizer, lr_scheduler=lr_scheduler)
 
         # Evaluate training accuracies (same metric as validation, but must be on-the-fly to save time)
+        conf_mat.reduce_from_all_processes()
         with autocast(is_mixed_precision):
             acc_global, acc, iu = conf_mat.compute()
         print(categories)
@@ -304,41 +410,51 @@ def train_schedule(writer, loader, val_num_steps, validation_loader, device, cri
 
         train_pixel_acc = acc_global.item() * 100
         train_mIoU = iu.mean().item() * 100
-        writer.add_scalar('train pixel accuracy',
-                          train_pixel_acc,
-                          epoch + 1)
-        writer.add_scalar('train mIoU',
-                          train_mIoU,
-                          epoch + 1)
+        if writer is not None:
+            writer.add_scalar('train pixel accuracy',
+                              train_pixel_acc,
+                              epoch + 1)
+            writer.add_scalar('train mIoU',
+                              train_mIoU,
+                              epoch + 1)
 
         epoch += 1
-        print('Epoch time: %.2fs' % (time.time() - time_now))
+        epoch_time = time.time() - time_now
+        print('Epoch time: %.2fs, %.2f samples/s' % (epoch_time, num_samples / epoch_time))
+        if device.type == 'cuda':
+            print('Peak memory: %.1fMB' % (torch.cuda.max_memory_allocated(device) / 2 ** 20))
 
 
 # Copied and modified from torch/vision/references/segmentation
 def test_one_set(loader, device, net, num_classes, categories, output_size, labels_size, is_mixed_precision,
-                 selector=None, classes=None, encoder_only=False):
+                 selector=None, classes=None, encoder_only=False, worst_k=0, channels_last=False):
     # Evaluate on 1 data_loader
     # Use selector & classes to select part of the classes as metric (for SYNTHIA)
+    # worst_k > 0: also print the worst k images by mean IoU
     net.eval()
-    conf_mat = ConfusionMatrix(num_classes)
+    conf_mat = ConfusionMatrix(num_classes, per_image=worst_k > 0)
+
+    def compute(image, target):
+        with autocast(is_mixed_precision):
+            output = net(image)['out']
+            if encoder_only:
+                target = target.unsqueeze(0)
+                if target.dtype not in (torch.float32, torch.float64):
+                    target = target.to(torch.float32)
+                target = torch.nn.functional.interpolate(target, size=labels_size, mode='nearest')
+                target = target.to(torch.int64)
+                target = target.squeeze(0)
+            elif output.shape[-2:] != torch.Size(output_size):  # Skip when logits are already at output size
+                output = torch.nn.functional.interpolate(output, size=output_size, mode='bilinear',
+                                                         align_corners=True)
+            conf_mat.update(target, output.argmax(1))
+
+    # Confusion matrix is updated on device, the pipeline overlaps data copies with the forward pass
     with torch.no_grad():
-        for image, target in tqdm(loader):
-            image, target = image.to(device), target.to(device)
-            with autocast(is_mixed_precision):
-                output = net(image)['out']
-                if encoder_only:
-                    target = target.unsqueeze(0)
-                    if target.dtype not in (torch.float32, torch.float64):
-                        target = target.to(torch.float32)
-                    target = torch.nn.functional.interpolate(target, size=labels_size, mode='nearest')
-                    target = target.to(torch.int64)
-                    target = target.squeeze(0)
-                else:
-                    output = torch.nn.functional.interpolate(output, size=output_size, mode='bilinear',
-                                                             align_corners=True)
-                conf_mat.update(target.flatten(), output.argmax(1).flatten())
+        InferencePipeline(device=device, compute_fn=compute,
+                          memory_format=get_memory_format(channels_last) if channels_last else None).run(loader)
 
+    conf_mat.reduce_from_all_processes()
     acc_global, acc, iu = conf_mat.compute()
     print(categories)
     print((
@@ -354,6 +470,12 @@ def test_one_set(loader, device, net, num_classes, categories, output_size, labe
         -1 if classes is None else classes,
         -1 if selector is None else iu[selector].mean().item() * 100))
 
+    if worst_k > 0:
+        images = getattr(loader.dataset, 'images', None)
+        print('Worst {} images (mean IoU):'.format(worst_k))
+        for index, value in zip(*conf_mat.worst(worst_k)):
+            print('{}: {:.2f}'.format(index if images is None else images[index], value * 100))
+
     if selector is None:
         iou = iu.mean().item() * 100
     else:
@@ -386,5 +508,7 @@ def build_segmentation_model(configs, args, num_classes, city_aug, input_sizes):
         city_aug = 2
     else:
         raise ValueError
+    if args.channels_last:
+        to_channels_last(net)
 
     return net, city_aug, input_sizes, weights
@@ -0,0 +1,112 @@
+import os
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+
+
+# A memory-mappable uint8 cache of pre-decoded (and optionally pre-resized) images or masks
+# Layout of a cache directory:
+#   shard_00000.bin, shard_00001.bin, ...: contiguous raw uint8 arrays (HWC for images, HW for masks)
+#   index.npy: int64 array of [shard, offset, h, w, c] for each file
+#   keys.txt: file path of each row (relative to the dataset root, so that the root can be moved)
+class ImageCache(object):
+    def __init__(self, cache_dir, root):
+        self.cache_dir = cache_dir
+        self.root = root
+        self.index = np.load(os.path.join(cache_dir, 'index.npy'))
+        with open(os.path.join(cache_dir, 'keys.txt'), 'r') as f:
+            self.keys = {x.rstrip('\n'): i for i, x in enumerate(f.readlines())}
+        assert len(self.keys) == self.index.shape[0]
+        self._shards = {}  # Opened lazily, i.e. once for each DataLoader worker
+
+    def __getstate__(self):
+        # Do not pickle memmaps to DataLoader workers
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+
+        return state
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, filename):
+        return os.path.relpath(filename, self.root) in self.keys
+
+    def get(self, filename):
+        # Return a read-only np.ndarray view of the memmap, None on cache miss
+        i = self.keys.get(os.path.relpath(filename, self.root))
+        if i is None:
+            return None
+        shard, offset, h, w, c = self.index[i].tolist()
+        data = self._shard(shard)[offset: offset + h * w * c]
+
+        return data.reshape(h, w, c) if c > 1 else data.reshape(h, w)
+
+    def open(self, filename):
+        # Same as Image.open() for the cached formats, fall back to the original file on cache miss
+        data = self.get(filename)
+
+        return Image.open(filename) if data is None else Image.fromarray(data)
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(os.path.join(self.cache_dir, 'shard_{:05d}.bin'.format(shard)),
+                                            dtype=np.uint8, mode='r')
+
+        return self._shards[shard]
+
+
+def open_cache(cache_dir, root):
+    # Returns None if there is no cache
+    if cache_dir is None or not os.path.exists(os.path.join(cache_dir, 'index.npy')):
+        return None
+    else:
+        return ImageCache(cache_dir=cache_dir, root=root)
+
+
+def _decode(args):
+    filename, size, label = args
+    image = Image.open(filename)
+    if label:
+        if image.mode not in ['L', 'P']:
+            raise ValueError('Only 8-bit masks can be cached: {} ({})'.format(filename, image.mode))
+    else:
+        image = image.convert('RGB')
+    if size is not None and image.size != (size[1], size[0]):
+        # Same interpolation as transforms.Resize
+        image = image.resize((size[1], size[0]), Image.NEAREST if label else Image.LINEAR)
+
+    return np.ascontiguousarray(np.asarray(image, dtype=np.uint8))
+
+
+def build_cache(filenames, root, cache_dir, size=None, label=False, shard_size=4 << 30, workers=8):
+    # Decode (& resize to size (h, w)) all files once and write them to sharded contiguous files
+    # shard_size: maximum bytes per shard (a single file is never split)
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(os.path.join(cache_dir, 'index.npy')):
+        os.remove(os.path.join(cache_dir, 'index.npy'))
+    index = np.zeros((len(filenames), 5), dtype=np.int64)
+    shard = 0
+    offset = 0
+    f = open(os.path.join(cache_dir, 'shard_{:05d}.bin'.format(shard)), 'wb')
+    try:
+        with Pool(processes=workers) as pool:
+            for i, data in enumerate(pool.imap(_decode, [(x, size, label) for x in filenames], chunksize=16)):
+                if offset > 0 and offset + data.nbytes > shard_size:
+                    f.close()
+                    shard += 1
+                    offset = 0
+                    f = open(os.path.join(cache_dir, 'shard_{:05d}.bin'.format(shard)), 'wb')
+                f.write(data.tobytes())
+                index[i] = [shard, offset, data.shape[0], data.shape[1], 1 if data.ndim == 2 else data.shape[2]]
+                offset += data.nbytes
+                if (i + 1) % 1000 == 0:
+                    print('{}/{}'.format(i + 1, len(filenames)))
+    finally:
+        f.close()
+
+    # Index is written last, so an incomplete cache is never used
+    with open(os.path.join(cache_dir, 'keys.txt'), 'w') as f:
+        f.writelines([os.path.relpath(x, root) + '\n' for x in filenames])
+    np.save(os.path.join(cache_dir, 'index.npy'), index)
+    print('Cached {} files in {} shard(s): {}'.format(len(filenames), shard + 1, cache_dir))
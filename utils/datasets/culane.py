@@ -1,9 +1,9 @@
 import torchvision
 import os
-import pickle
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
+from .keypoint_store import KeypointStore
 
 
 # CULane direct loading (work with the segmentation style lists)
@@ -31,19 +31,16 @@ class CULane(torchvision.datasets.VisionDataset):
             self.targets = [os.path.join('./output', x + '.lines.txt') for x in contents]
         else:  # Train
             self.images = [os.path.join(root, x[:x.find(' ')] + '.jpg') for x in contents]
-            self.targets = []
-            print('Loading targets into memory...')
-            processed_file = os.path.join(root, 'train_processed_targets')
-            if os.path.exists(processed_file):
-                with open(processed_file, 'rb') as f:
-                    self.targets = pickle.load(f)
-            else:
-                print('Pre-processing will only be performed for 1 time, please wait ~10 minutes.')
+            print('Loading targets...')
+            store_dir = os.path.join(root, 'train_keypoints')
+            if not KeypointStore.exists(store_dir, ppl=ppl, gap=gap, start=start):
+                print('Pre-processing will only be performed for 1 time.')
+                lanes = []
                 for x in tqdm(contents):
                     with open(os.path.join(root, x[:x.find(' ')] + '.lines.txt'), 'r') as f:
-                        self.targets.append(self._load_target(f.readlines()))
-                with open(processed_file, 'wb') as f:
-                    pickle.dump(self.targets, f)
+                        lanes.append(self._load_target(f.readlines()))
+                KeypointStore.build(store_dir, lanes=lanes, ppl=ppl, gap=gap, start=start)
+            self.targets = KeypointStore(store_dir)  # Memory-mapped, shared by all workers
             print('Loading complete.')
 
         assert len(self.targets) == len(self.images)
@@ -65,18 +62,11 @@ class CULane(torchvision.datasets.VisionDataset):
     def __len__(self):
         return len(self.images)
 
-    def _load_target(self, lines):
-        # Read file content to lists (file content could be empty or variable number of lanes)
-        target = np.array([[[-2.0, self.start + i * self.gap] for i in range(self.ppl)]
-                          for _ in range(len(lines))], dtype=np.float32)
-        for i in range(len(lines)):  # lines=[] will end this immediately
-            temp = [float(k) for k in lines[i].strip().split(' ')]
-            for j in range(int(len(temp) / 2)):
-                x = temp[2 * j]
-                y = temp[2 * j + 1]
-                target[i][target[i][:, 1] == y] = [x, y]
-
-        return target
+    @staticmethod
+    def _load_target(lines):
+        # Read file content to a list of flat np.arrays [x1, y1, x2, y2, ...] for KeypointStore
+        # (file content could be empty or variable number of lanes)
+        return [np.array(line.split(), dtype=np.float64) for line in lines if line.strip() != '']
 
     @staticmethod
     def load_target_xy(lines):
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+
+
+# Columnar keypoint store for lane annotations sampled at fixed rows (y = start + k * gap, k < ppl)
+# Files in a store directory (all .npy, opened with mmap_mode so DataLoader workers share the page cache):
+#   xs.npy: float32 (total number of lanes x ppl), x coordinates, -2 for empty points
+#   offsets.npy: int64 (number of images + 1), lanes of image i are xs[offsets[i]: offsets[i + 1]]
+#   meta.npy: float64 [ppl, gap, start]
+class KeypointStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.ppl, self.gap, self.start = np.load(os.path.join(path, 'meta.npy')).tolist()
+        self.ppl = int(self.ppl)
+        self.ys = self.start + np.arange(self.ppl, dtype=np.float32) * self.gap
+        self._xs = None
+        self._offsets = None
+
+    def __getstate__(self):
+        # Re-open memmaps in each DataLoader worker instead of pickling the arrays
+        state = self.__dict__.copy()
+        state['_xs'] = None
+        state['_offsets'] = None
+
+        return state
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index):
+        # Return L x N x 2 np.array (a copy, transforms may modify it), empty points are (-2, y)
+        xs = self.xs[self.offsets[index]: self.offsets[index + 1]]
+        target = np.empty((xs.shape[0], self.ppl, 2), dtype=np.float32)
+        target[:, :, 0] = xs
+        target[:, :, 1] = self.ys
+
+        return target
+
+    @property
+    def xs(self):
+        if self._xs is None:
+            self._xs = np.load(os.path.join(self.path, 'xs.npy'), mmap_mode='r')
+
+        return self._xs
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = np.load(os.path.join(self.path, 'offsets.npy'), mmap_mode='r')
+
+        return self._offsets
+
+    @staticmethod
+    def exists(path, ppl, gap, start):
+        # Check for a complete store with the same sampling
+        if not os.path.exists(os.path.join(path, 'meta.npy')):
+            return False
+
+        return np.load(os.path.join(path, 'meta.npy')).tolist() == [ppl, gap, start]
+
+    @staticmethod
+    def build(path, lanes, ppl, gap, start):
+        # lanes: list (each image) of lists (each lane) of flat np.arrays [x1, y1, x2, y2, ...]
+        # Points not on the sampled rows are ignored (same as matching y exactly), later points overwrite
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, 'meta.npy')):
+            os.remove(os.path.join(path, 'meta.npy'))
+        offsets = np.zeros(len(lanes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in lanes])
+        flat = [lane for image in lanes for lane in image]
+        xs = np.full((len(flat), ppl), -2.0, dtype=np.float32)
+        if len(flat) > 0:
+            points = np.concatenate(flat).astype(np.float64).reshape(-1, 2)
+            lane_ids = np.repeat(np.arange(len(flat)), [len(x) // 2 for x in flat])
+            rows = (points[:, 1] - start) / gap
+            valid = (rows == np.round(rows)) & (rows >= 0) & (rows < ppl)
+            xs[lane_ids[valid], rows[valid].astype(np.int64)] = points[valid, 0]
+
+        np.save(os.path.join(path, 'xs.npy'), xs)
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        np.save(os.path.join(path, 'meta.npy'), np.array([ppl, gap, start], dtype=np.float64))  # Written last
+
+        return KeypointStore(path)
@@ -2,11 +2,13 @@ import torchvision
 import os
 import torch
 from PIL import Image
+from .cache import open_cache
 
 
 # Lane detection as segmentation
 class StandardLaneDetectionDataset(torchvision.datasets.VisionDataset):
-    def __init__(self, root, image_set, transforms=None, transform=None, target_transform=None, data_set='tusimple'):
+    def __init__(self, root, image_set, transforms=None, transform=None, target_transform=None, data_set='tusimple',
+                 cache_dir=None):
         super().__init__(root, transforms, transform, target_transform)
         if image_set == 'valfast':
             self.test = 1
@@ -36,17 +38,23 @@ class StandardLaneDetectionDataset(torchvision.datasets.VisionDataset):
 
         assert (len(self.images) == len(self.masks))
 
+        # Optional pre-decoded caches (built by tools/build_cache.py), files not in cache are read from disk
+        if cache_dir is not None:
+            cache_dir = os.path.join(cache_dir, data_set, image_set)
+        self.image_cache = open_cache(None if cache_dir is None else os.path.join(cache_dir, 'images'), root)
+        self.mask_cache = open_cache(None if cache_dir is None else os.path.join(cache_dir, 'masks'), root)
+
     def __getitem__(self, index):
         # Return x (input image) & y (mask image, i.e. pixel-wise supervision) & lane existence (a list),
         # if not just testing,
         # else just return input image.
-        img = Image.open(self.images[index]).convert('RGB')
+        img = self._open(self.images[index], self.image_cache).convert('RGB')
         if self.test == 2:
             target = self.masks[index]
         elif self.test == 1:
-            target = Image.open(self.masks[index])
+            target = self._open(self.masks[index], self.mask_cache)
         else:
-            target = Image.open(self.masks[index])
+            target = self._open(self.masks[index], self.mask_cache)
             lane_existence = torch.tensor(self.lane_existences[index]).float()
 
         # Transforms
@@ -60,6 +68,10 @@ class StandardLaneDetectionDataset(torchvision.datasets.VisionDataset):
     def __len__(self):
         return len(self.images)
 
+    @staticmethod
+    def _open(filename, cache):
+        return Image.open(filename) if cache is None else cache.open(filename)
+
     def _init_all(self):
         # Got the lists from 2 datasets to be in the same format
         split_f = os.path.join(self.splits_dir, self.image_set + '.txt')
@@ -2,12 +2,13 @@ import torchvision
 import os
 import numpy as np
 from PIL import Image
+from .cache import open_cache
 
 
 # Reimplemented based on torchvision.datasets.VOCSegmentation
 class StandardSegmentationDataset(torchvision.datasets.VisionDataset):
     def __init__(self, root, image_set, transforms=None, transform=None, target_transform=None, data_set='voc',
-                 mask_type='.png'):
+                 mask_type='.png', cache_dir=None):
         super().__init__(root, transforms, transform, target_transform)
         self.mask_type = mask_type
         if data_set == 'voc':
@@ -23,11 +24,18 @@ class StandardSegmentationDataset(torchvision.datasets.VisionDataset):
 
         assert (len(self.images) == len(self.masks))
 
+        # Optional pre-decoded caches (built by tools/build_cache.py), files not in cache are read from disk
+        if cache_dir is not None:
+            cache_dir = os.path.join(cache_dir, data_set, image_set)
+        self.image_cache = open_cache(None if cache_dir is None else os.path.join(cache_dir, 'images'), root)
+        self.mask_cache = open_cache(None if cache_dir is None else os.path.join(cache_dir, 'masks'), root)
+
     def __getitem__(self, index):
-        img = Image.open(self.images[index]).convert('RGB')
+        img = self._open(self.images[index], self.image_cache).convert('RGB')
         # Return x(input image) & y(mask images as a list)
         # Supports .png & .npy
-        target = Image.open(self.masks[index]) if '.png' in self.masks[index] else np.load(self.masks[index])
+        target = self._open(self.masks[index], self.mask_cache) if '.png' in self.masks[index] \
+            else np.load(self.masks[index])
 
         # Transforms
         if self.transforms is not None:
@@ -38,6 +46,10 @@ class StandardSegmentationDataset(torchvision.datasets.VisionDataset):
     def __len__(self):
         return len(self.images)
 
+    @staticmethod
+    def _open(filename, cache):
+        return Image.open(filename) if cache is None else cache.open(filename)
+
     def _voc_init(self, root, image_set):
         image_dir = os.path.join(root, 'JPEGImages')
         mask_dir = os.path.join(root, 'SegmentationClassAug')
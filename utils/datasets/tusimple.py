@@ -4,6 +4,7 @@ import ujson as json
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
+from .keypoint_store import KeypointStore
 
 
 # TuSimple direct loading
@@ -32,21 +33,21 @@ class TuSimple(torchvision.datasets.VisionDataset):
         else:  # Train
             self.images = [os.path.join(root, 'clips', x[:x.find(' ')] + '.jpg') for x in contents]
 
-            # Load target lanes (small dataset, directly load all of them in the memory)
-            print('Loading targets into memory...')
-            target_files = [os.path.join(root, 'label_data_0313.json'),
-                            os.path.join(root, 'label_data_0601.json')]
-            json_contents = self.concat_jsons(target_files)
-            self.targets = []
-            for i in tqdm(range(len(json_contents))):
-                lines = json_contents[i]['lanes']
-                h_samples = json_contents[i]['h_samples']
-                temp = np.array([[[-2.0, self.start + j * self.gap] for j in range(self.ppl)]
-                                for _ in range(len(lines))], dtype=np.float32)
-                for j in range(len(h_samples)):
-                    for k in range(len(lines)):
-                        temp[k][temp[k][:, 1] == h_samples[j]] = [float(lines[k][j]), h_samples[j]]
-                self.targets.append(temp)
+            # Load target lanes
+            print('Loading targets...')
+            store_dir = os.path.join(root, 'train_keypoints')
+            if not KeypointStore.exists(store_dir, ppl=ppl, gap=gap, start=start):
+                target_files = [os.path.join(root, 'label_data_0313.json'),
+                                os.path.join(root, 'label_data_0601.json')]
+                json_contents = self.concat_jsons(target_files)
+                lanes = []
+                for x in tqdm(json_contents):
+                    h_samples = np.array(x['h_samples'], dtype=np.float64)
+                    lanes.append([np.stack([np.array(lane, dtype=np.float64), h_samples], axis=1).flatten()
+                                  for lane in x['lanes']])
+                KeypointStore.build(store_dir, lanes=lanes, ppl=ppl, gap=gap, start=start)
+            self.targets = KeypointStore(store_dir)  # Memory-mapped, shared by all workers
+            print('Loading complete.')
 
         assert len(self.targets) == len(self.images)
 
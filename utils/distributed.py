@@ -0,0 +1,118 @@
+# Multi-process (DistributedDataParallel) training helpers,
+# launched by torchrun (or python -m torch.distributed.launch --use_env), 1 process per GPU or per CPU worker
+import os
+import builtins
+import torch
+
+
+def init_distributed_mode(backend=None):
+    # Initialize from torchrun environment variables,
+    # default backend is nccl with CUDA and gloo without (so it also runs on CPU-only machines)
+    # Return: (is distributed, rank, world size, local rank)
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        return False, 0, 1, 0
+    rank = int(os.environ['RANK'])
+    world_size = int(os.environ['WORLD_SIZE'])
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    torch.distributed.init_process_group(backend=backend, init_method='env://', world_size=world_size, rank=rank)
+    torch.distributed.barrier()
+    setup_for_distributed(rank == 0)
+
+    return True, rank, world_size, local_rank
+
+
+def setup_for_distributed(is_master):
+    # Only print from the main process (use print(..., force=True) otherwise)
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_master or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def is_dist_avail_and_initialized():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def get_world_size():
+    return torch.distributed.get_world_size() if is_dist_avail_and_initialized() else 1
+
+
+def get_rank():
+    return torch.distributed.get_rank() if is_dist_avail_and_initialized() else 0
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def synchronize():
+    if is_dist_avail_and_initialized():
+        torch.distributed.barrier()
+
+
+def get_device(local_rank=0):
+    if torch.cuda.is_available():
+        return torch.device('cuda:' + str(local_rank))
+    else:
+        return torch.device('cpu')
+
+
+def wrap_model(net, device, sync_bn=False, find_unused_parameters=None):
+    # DDP wrapper (no-op when not distributed), BatchNorm layers are converted in place and keep their parameters
+    # find_unused_parameters: None for the model's _unused_parameters (e.g. ERFNet's encoder-only output_conv)
+    if not is_dist_avail_and_initialized():
+        return net
+    if find_unused_parameters is None:
+        find_unused_parameters = getattr(net, '_unused_parameters', False)
+    if sync_bn:
+        net = torch.nn.SyncBatchNorm.convert_sync_batchnorm(net)
+    return torch.nn.parallel.DistributedDataParallel(net, device_ids=[device.index] if device.type == 'cuda' else None,
+                                                     find_unused_parameters=find_unused_parameters)
+
+
+def unwrap_model(net):
+    # The actual model, to keep checkpoints the same as single-process training
+    if isinstance(net, torch.nn.parallel.DistributedDataParallel):
+        return net.module
+    return net
+
+
+def get_sampler(data_set, shuffle):
+    # DistributedSampler for training (padded to equal lengths),
+    # an un-padded rank-strided sampler for evaluation so that reduced metrics are exact
+    # None when not distributed (use shuffle in the DataLoader)
+    if not is_dist_avail_and_initialized():
+        return None
+    if shuffle:
+        return torch.utils.data.distributed.DistributedSampler(data_set, shuffle=True)
+    else:
+        return EvaluationSampler(data_set)
+
+
+def set_epoch(loader, epoch):
+    # Reshuffle differently for each epoch with DistributedSampler
+    sampler = getattr(loader, 'sampler', None)
+    if isinstance(sampler, torch.utils.data.distributed.DistributedSampler):
+        sampler.set_epoch(epoch)
+
+
+class EvaluationSampler(torch.utils.data.Sampler):
+    # Each sample is evaluated exactly once over all processes (rank, rank + world size, ...)
+    def __init__(self, data_set):
+        self.num_samples = len(data_set)
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_samples, self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, self.num_samples, self.world_size))
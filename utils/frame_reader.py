@@ -0,0 +1,112 @@
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+import torch
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+# Frames from an image folder (recursive, sorted) or a video file,
+# decoded by a background thread into a bounded queue of batches (blocks when full, i.e. backpressure on decoding)
+# Each batch is (uint8 tensor B x H x W x 3 in RGB, names), a batch only holds frames of the same size
+# Names are relative image paths for folders and '<video name>/<frame index>.jpg' for videos
+class FrameReader(object):
+    def __init__(self, source, batch_size=8, max_queue_size=4, pin_memory=False):
+        if not os.path.exists(source):
+            raise ValueError('Input does not exist: ' + source)
+        self.source = source
+        self.batch_size = batch_size
+        self.max_queue_size = max_queue_size
+        self.pin_memory = pin_memory
+        self.is_video = not os.path.isdir(source)
+        if self.is_video:
+            capture = cv2.VideoCapture(source)
+            if not capture.isOpened():
+                raise ValueError('Can not open video: ' + source)
+            self.num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))  # Estimated by some codecs
+            self.fps = capture.get(cv2.CAP_PROP_FPS)
+            capture.release()
+            self.filenames = None
+        else:
+            self.filenames = sorted([os.path.relpath(os.path.join(root, x), source)
+                                     for root, _, files in os.walk(source)
+                                     for x in files if x.lower().endswith(IMAGE_EXTENSIONS)])
+            self.num_frames = len(self.filenames)
+            self.fps = None
+        self.count = 0  # Decoded frames
+
+    def __len__(self):
+        # Number of batches (exact if all frames share 1 size)
+        return -(-self.num_frames // self.batch_size)
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.max_queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._work, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Unblock the decode thread if iteration ended early
+            stop.set()
+            while thread.is_alive():
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.1)
+
+    def _frames(self):
+        if self.is_video:
+            capture = cv2.VideoCapture(self.source)
+            prefix = os.path.splitext(os.path.basename(self.source))[0]
+            index = 0
+            try:
+                while True:
+                    ret, frame = capture.read()
+                    if not ret:
+                        break
+                    yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), os.path.join(prefix, '{:06d}.jpg'.format(index))
+                    index += 1
+            finally:
+                capture.release()
+        else:
+            for filename in self.filenames:
+                frame = cv2.imread(os.path.join(self.source, filename), cv2.IMREAD_COLOR)
+                if frame is None:
+                    raise ValueError('Can not read image: ' + filename)
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), filename
+
+    def _batch(self, frames, names):
+        images = torch.from_numpy(np.stack(frames))
+        if self.pin_memory:
+            images = images.pin_memory()
+        self.count += len(names)
+
+        return images, names
+
+    def _work(self, q, stop):
+        try:
+            frames = []
+            names = []
+            for frame, name in self._frames():
+                if stop.is_set():
+                    return
+                if len(frames) > 0 and (len(frames) == self.batch_size or frame.shape != frames[0].shape):
+                    q.put(self._batch(frames, names))
+                    frames = []
+                    names = []
+                frames.append(frame)
+                names.append(name)
+            if len(frames) > 0:
+                q.put(self._batch(frames, names))
+        except Exception as e:
+            q.put(e)
+        q.put(None)
@@ -0,0 +1,69 @@
+# Inference-mode model compiler (eval only, outputs are unchanged up to floating point error):
+# fold BatchNorm into the preceding convolution -> strip dropout -> (optional) channels_last -> freeze parameters
+# Conv-BN pairs are the ones declared by each module's fuse_model() (same hooks as int8 quantization),
+# plus adjacent Conv2d-BatchNorm2d pairs in nn.Sequential containers (e.g. DeepLabV3Head, ASPP, VGG fc67)
+# BN after a concatenation (ERFNet/ENet downsampling) or a transposed convolution is kept
+import copy
+import torch
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from utils.quantization import fuse_model
+from utils.memory_format import to_channels_last
+
+DROPOUT_TYPES = (torch.nn.Dropout, torch.nn.Dropout2d, torch.nn.Dropout3d, torch.nn.AlphaDropout)
+
+
+def _fold_sequential(sequential):
+    count = 0
+    for i in range(len(sequential) - 1):
+        conv = sequential[i]
+        bn = sequential[i + 1]
+        if type(conv) == torch.nn.Conv2d and isinstance(bn, torch.nn.BatchNorm2d) and bn.track_running_stats \
+                and conv.out_channels == bn.num_features:
+            sequential[i] = fuse_conv_bn_eval(conv, bn)
+            sequential[i + 1] = torch.nn.Identity()
+            count += 1
+
+    return count
+
+
+def fold_conv_bn(net):
+    # In place, eval mode only
+    # Return: number of remaining BatchNorm layers (not foldable)
+    net.eval()
+    fuse_model(net)
+    for module in list(net.modules()):
+        if isinstance(module, torch.nn.Sequential):
+            _fold_sequential(module)
+
+    return len([m for m in net.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)])
+
+
+def strip_dropout(net):
+    # Replace dropout layers (identity functions at eval) by nn.Identity, in place
+    for module in list(net.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, DROPOUT_TYPES):
+                setattr(module, name, torch.nn.Identity())
+
+    return net
+
+
+def optimize_for_inference(net, channels_last=False, inplace=False):
+    # Return: the optimized model (a copy unless inplace), in eval mode without gradients
+    # It can not be trained, quantized or optimized again
+    if not inplace:
+        net = copy.deepcopy(net)
+    num_bn = fold_conv_bn(net)
+    strip_dropout(net)
+    if channels_last:
+        to_channels_last(net)
+    net.requires_grad_(False)
+    print('Optimized for inference, {} BatchNorm layers are not folded.'.format(num_bn))
+
+    return net
+
+
+def max_output_diff(outputs, reference):
+    # Max abs difference between 2 output dicts (all tensors)
+    return max([(outputs[k].float() - v.float()).abs().max().item()
+                for k, v in reference.items() if isinstance(v, torch.Tensor)])
@@ -0,0 +1,178 @@
+import time
+import threading
+import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from utils.memory_format import to_memory_format
+
+
+def _apply(fn, x):
+    # Apply fn to every tensor in a (nested) list/tuple/dict, other objects are passed through
+    if isinstance(x, torch.Tensor):
+        return fn(x)
+    elif isinstance(x, (list, tuple)):
+        return type(x)([_apply(fn, v) for v in x])
+    elif isinstance(x, dict):
+        return {k: _apply(fn, v) for k, v in x.items()}
+    else:
+        return x
+
+
+class StageTimer(object):
+    # Busy time of each pipeline stage, GPU stages are measured by CUDA events (resolved lazily)
+    def __init__(self):
+        self.busy = {}
+        self.events = {}
+        self.lock = threading.Lock()  # Post-processing workers add from other threads
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.busy[stage] = self.busy.get(stage, 0.0) + seconds
+
+    def add_events(self, stage, start, end):
+        self.events.setdefault(stage, []).append((start, end))
+
+    def resolve(self):
+        for stage, pairs in self.events.items():
+            for start, end in pairs:
+                end.synchronize()
+                self.add(stage, start.elapsed_time(end) / 1000)
+        self.events = {}
+
+    def report(self, wall, num_workers=1):
+        # Occupancy = busy time / wall time (post-processing is normalized by the number of workers)
+        self.resolve()
+        occupancy = {k: v / wall / (num_workers if k == 'post' else 1) for k, v in self.busy.items()}
+        print('Pipeline wall time: {:.2f}s, stage occupancy: {}'.format(
+            wall, ', '.join(['{}: {:.2f}%'.format(k, v * 100) for k, v in occupancy.items()])))
+
+        return occupancy
+
+
+class Prefetcher(object):
+    # Copy the next batch to device on a side stream while the current batch is being processed
+    # Use pin_memory=True in the DataLoader, otherwise batches are pinned here on the main thread
+    # memory_format: converts images (4D floating point tensors) on device, e.g. torch.channels_last
+    def __init__(self, loader, device, timer=None, memory_format=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.memory_format = memory_format
+        self.cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(device=self.device) if self.cuda else None
+        self.timer = timer if timer is not None else StageTimer()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        next_batch = self._preload(it)
+        while next_batch is not None:
+            if self.cuda:
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                _apply(lambda x: x.record_stream(torch.cuda.current_stream(self.device)) if x.is_cuda else None,
+                       next_batch)
+            batch = next_batch
+            next_batch = self._preload(it)
+            yield batch
+
+    def _preload(self, it):
+        time_now = time.perf_counter()
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        self.timer.add('load', time.perf_counter() - time_now)
+
+        if self.cuda:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            with torch.cuda.stream(self.stream):
+                start.record(self.stream)
+                batch = _apply(lambda x: (x if x.is_pinned() else x.pin_memory()).to(self.device, non_blocking=True),
+                               batch)
+                if self.memory_format is not None:
+                    batch = _apply(lambda x: to_memory_format(x, self.memory_format), batch)
+                end.record(self.stream)
+            self.timer.add_events('copy', start, end)
+        else:
+            time_now = time.perf_counter()
+            batch = _apply(lambda x: x.to(self.device), batch)
+            if self.memory_format is not None:
+                batch = _apply(lambda x: to_memory_format(x, self.memory_format), batch)
+            self.timer.add('copy', time.perf_counter() - time_now)
+
+        return batch
+
+
+# A 3-stage inference pipeline:
+# 1. prefetch: pinned memory -> device copies on a side stream (Prefetcher)
+# 2. compute: compute_fn(*batch) on the default stream, returns a tuple which is copied back to CPU asynchronously
+# 3. post-processing: post_fn(*outputs) on a thread pool, waits only for its own D2H copy
+# So the post-processing of batch N overlaps the forward pass of batch N+1,
+# at most max_in_flight batches are waiting for post-processing (blocks the compute stage when full)
+class InferencePipeline(object):
+    def __init__(self, device, compute_fn, post_fn=None, num_workers=2, max_in_flight=4, memory_format=None):
+        self.device = torch.device(device)
+        self.memory_format = memory_format
+        self.cuda = self.device.type == 'cuda'
+        self.compute_fn = compute_fn
+        self.post_fn = post_fn
+        self.num_workers = num_workers
+        self.max_in_flight = max_in_flight
+        self.occupancy = None
+
+    def run(self, loader):
+        timer = StageTimer()
+        prefetcher = Prefetcher(loader=loader, device=self.device, timer=timer, memory_format=self.memory_format)
+        executor = ThreadPoolExecutor(max_workers=self.num_workers) if self.post_fn is not None else None
+        in_flight = deque()
+        time_now = time.perf_counter()
+        try:
+            for batch in tqdm(prefetcher):
+                outputs = self._compute(batch, timer)
+                if executor is not None:
+                    in_flight.append(executor.submit(self._post, outputs, timer))
+                    while len(in_flight) > self.max_in_flight:
+                        in_flight.popleft().result()
+            while len(in_flight) > 0:
+                in_flight.popleft().result()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        self.occupancy = timer.report(wall=time.perf_counter() - time_now, num_workers=self.num_workers)
+
+        return self.occupancy
+
+    def _compute(self, batch, timer):
+        if self.cuda:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            outputs = self.compute_fn(*batch)
+            end.record()
+            timer.add_events('compute', start, end)
+            if self.post_fn is not None:  # Outputs to CPU (non_blocking copies go to pinned memory)
+                outputs = _apply(lambda x: x.to('cpu', non_blocking=True) if x.is_cuda else x, outputs)
+                done = torch.cuda.Event()
+                done.record()
+            else:
+                done = None
+        else:
+            time_now = time.perf_counter()
+            outputs = self.compute_fn(*batch)
+            timer.add('compute', time.perf_counter() - time_now)
+            done = None
+
+        return outputs, done
+
+    def _post(self, outputs, timer):
+        outputs, done = outputs
+        if done is not None:
+            done.synchronize()
+        time_now = time.perf_counter()
+        self.post_fn(*outputs)
+        timer.add('post', time.perf_counter() - time_now)
@@ -0,0 +1,124 @@
+import os
+import torch
+
+
+# Temporal feature reuse for sequential video frames (e.g. CULane driver_*_30frame/*.MP4/*.jpg, or a FrameReader
+# video), frames are grouped into sequences by their directory
+# Lane models are split in 3 stages (forward_shallow, forward_deep, forward_heads): the cheap shallow stage runs on
+# every frame, the deep stage (most of the encoder, SCNN included) only on key frames and its features are cached,
+# the decoder & heads run on every frame with the key frame's deep features propagated to that frame
+# Propagation is gated by the shallow features (pooled to the deep feature grid, stride 8 for all segmentation
+# lane models): the key frame's deep features are translated by the shift (within max_shift cells) that best aligns
+# the key frame's shallow features to the current frame's
+# A frame becomes a key frame when it starts a sequence, every max_interval frames, or when the aligned shallow
+# difference (mean absolute difference, relative to the key frame's mean magnitude) is larger than threshold,
+# i.e. the scene changed more than a translation
+# Frames must come in temporal order, 1 instance per pass over the data (states are kept across batches)
+class KeyFrameReuse(object):
+    def __init__(self, net, max_interval=5, threshold=0.2, max_shift=2, stride=8):
+        if max_interval < 1 or max_shift < 0:
+            raise ValueError
+        if not all(hasattr(net, x) for x in ['forward_shallow', 'forward_deep', 'forward_heads']):  # e.g. LSTR
+            raise ValueError('Temporal feature reuse is not supported for {}!'.format(type(net).__name__))
+        self.net = net
+        self.max_interval = max_interval
+        self.threshold = threshold
+        self.max_shift = max_shift
+        self.stride = stride
+        self.shifts = [(y, x) for y in range(-max_shift, max_shift + 1) for x in range(-max_shift, max_shift + 1)]
+        self.num_frames = 0
+        self.num_key_frames = 0
+        # Last key frame: pooled shallow features (C x h x w), deep features (1 x C x h x w),
+        # sequence, number of frames assigned to it
+        self.key_shallow = None
+        self.key_deep = None
+        self.sequence = None
+        self.count = 0
+
+    def pool(self, shallow, input_size):
+        # Shallow features on the deep feature grid, in floating point
+        if shallow.is_quantized:
+            shallow = shallow.dequantize()
+        size = [(x + self.stride - 1) // self.stride for x in input_size]
+
+        return torch.nn.functional.adaptive_avg_pool2d(shallow.float(), size)
+
+    def align(self, key, x):
+        # key, x: C x h x w pooled shallow features
+        # Return: shift of the key frame that best matches x, its relative difference (1 copy to CPU)
+        # Compared on the inner region, so every shift only compares real features
+        m = self.max_shift
+        h, w = x.shape[-2:]
+        inner = x[:, m:h - m, m:w - m]
+        diffs = torch.stack([(inner - key[:, m - dy:h - m - dy, m - dx:w - m - dx]).abs().mean()
+                             for dy, dx in self.shifts])
+        diffs = (diffs / key[:, m:h - m, m:w - m].abs().mean().clamp(min=1e-6)).cpu()
+        i = int(diffs.argmin())
+
+        return self.shifts[i], diffs[i].item()
+
+    @staticmethod
+    def translate(x, shift):
+        # Return: y[..., i, j] = x[..., i - dy, j - dx], borders are replicated
+        dy, dx = shift
+        if dy == 0 and dx == 0:
+            return x
+        h, w = x.shape[-2:]
+        rows = (torch.arange(h, device=x.device) - dy).clamp(0, h - 1)
+        cols = (torch.arange(w, device=x.device) - dx).clamp(0, w - 1)
+
+        return x.index_select(-2, rows).index_select(-1, cols)
+
+    def __call__(self, images, filenames):
+        # Return: network outputs of each frame, same as net(images) on key frames
+        shallow, *args = self.net.forward_shallow(images)
+        pooled = self.pool(shallow, images.shape[-2:])
+
+        # Schedule key frames in order, key frame of each frame (-1: the cached one) & the shift from it
+        key = None if self.key_shallow is None else -1
+        key_shallow = self.key_shallow
+        sequence = self.sequence
+        count = self.count
+        key_indices = []
+        sources = []
+        shifts = []
+        for i, filename in enumerate(filenames):
+            shift = (0, 0)
+            new = key is None or os.path.dirname(filename) != sequence or count >= self.max_interval
+            if not new:
+                shift, diff = self.align(key_shallow, pooled[i])
+                new = diff > self.threshold
+            if new:
+                key = i
+                key_shallow = pooled[i]
+                shift = (0, 0)
+                sequence = os.path.dirname(filename)
+                count = 0
+                key_indices.append(i)
+            count += 1
+            sources.append(key)
+            shifts.append(shift)
+
+        # Deep stage on new key frames only, then heads on the propagated deep features of every frame
+        deep = None
+        if len(key_indices) > 0:
+            deep = self.net.forward_deep(shallow.index_select(0, torch.tensor(key_indices, device=shallow.device)))
+        positions = {x: j for j, x in enumerate(key_indices)}
+        key_deep = [self.key_deep if x == -1 else deep[positions[x]:positions[x] + 1] for x in sources]
+        outputs = self.net.forward_heads(torch.cat([self.translate(x, s) for x, s in zip(key_deep, shifts)]), *args)
+
+        # Keep the last key frame for the next batch
+        self.key_shallow = key_shallow
+        self.key_deep = key_deep[-1]
+        self.sequence = sequence
+        self.count = count
+        self.num_frames += len(filenames)
+        self.num_key_frames += len(key_indices)
+
+        return outputs
+
+    def report(self):
+        ratio = self.num_key_frames / max(self.num_frames, 1)
+        print('Key frames: {}/{} ({:.2f}%)'.format(self.num_key_frames, self.num_frames, ratio * 100))
+
+        return ratio
@@ -0,0 +1,141 @@
+import os
+import queue
+import threading
+import ujson as json
+
+
+def format_culane_lanes(lanes):
+    # Same file content as the official format: "x1 y1 x2 y2 ... \n" for each non-empty lane
+    return ''.join([''.join(['{} {} '.format(x, y) for (x, y) in lane]) + '\n' for lane in lanes if lane])
+
+
+def format_tusimple_lanes(lanes, filename, ppl, gap=10, start=160):
+    formatted = {
+        "h_samples": [start + y * gap for y in range(ppl)],
+        "lanes": lanes,
+        "run_time": 0,
+        "raw_file": filename
+    }
+
+    return json.dumps(formatted)
+
+
+def format_json_lanes(lanes, filename):
+    # 1 json line per image with lanes in the same [x, y] format as CULane
+    return json.dumps({"raw_file": filename, "lanes": lanes})
+
+
+# Asynchronous lane prediction writer:
+# decoded lanes are put into a bounded queue (blocks when full, i.e. backpressure on the inference loop)
+# and written to disk by a pool of background threads,
+# close() is the barrier that must be passed before running the evaluation scripts
+class LaneWriter(object):
+    def __init__(self, dataset, filenames=None, ppl=None, output_file='./output/tusimple_pred.json',
+                 num_workers=4, max_queue_size=32):
+        # dataset: culane (1 .lines.txt per image) / tusimple (1 json line per image in output_file) /
+        # json ([x, y] lanes of any image size, 1 json line per image in output_file)
+        # filenames: all output filenames of this test set (to create the directory tree at once), optional
+        if dataset not in ['culane', 'tusimple', 'json']:
+            raise ValueError
+        self.dataset = dataset
+        self.ppl = ppl
+        self.output_file = output_file
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._results = {}  # Ordered json lines for TuSimple
+        self._count = 0
+        self._lock = threading.Lock()
+        self._exception = None
+        self._closed = False
+        self._aborted = False
+        self._known_dirs = set()
+
+        # Pre-create the whole directory tree once
+        if filenames is not None and dataset == 'culane':
+            self._make_dirs(filenames)
+
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for t in self._workers:
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # On exceptions, stop without writing results (and without raising worker exceptions over the original one)
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def put(self, filenames, batch_coordinates, index=None):
+        # Submit a batch of lanes (same format as prob_to_lines()) with their filenames
+        # Written as a batch by 1 worker, json lines are sorted by index (default: submission order)
+        if self._closed:
+            raise RuntimeError('Writer is already closed!')
+        self._check()
+        with self._lock:
+            if index is None:
+                index = self._count
+            self._count += 1
+        self._queue.put((index, list(filenames), batch_coordinates))
+
+    def close(self):
+        # Flush everything to disk and stop workers
+        if self._closed:
+            return
+        self._stop()
+        self._check()
+
+        if self.dataset in ['tusimple', 'json']:
+            with open(self.output_file, 'w') as f:
+                f.write(''.join([self._results[i] for i in sorted(self._results.keys())]))
+
+    def abort(self):
+        # Stop workers, pending lanes and results are discarded
+        if self._closed:
+            return
+        self._aborted = True
+        self._stop()
+
+    def _stop(self):
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+
+    def _make_dirs(self, filenames):
+        dir_names = set(os.path.dirname(x) for x in filenames) - self._known_dirs
+        for dir_name in dir_names:
+            if dir_name != '':
+                os.makedirs(dir_name, exist_ok=True)
+        self._known_dirs |= dir_names
+
+    def _check(self):
+        if self._exception is not None:
+            raise self._exception
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._exception is not None or self._aborted:  # Drain the queue after failure
+                continue
+            try:
+                index, filenames, batch_coordinates = item
+                if self.dataset == 'culane':
+                    for filename, lanes in zip(filenames, batch_coordinates):
+                        dir_name = os.path.dirname(filename)
+                        if dir_name not in self._known_dirs:
+                            os.makedirs(dir_name, exist_ok=True)
+                        with open(filename, 'w') as f:
+                            f.write(format_culane_lanes(lanes))
+                elif self.dataset == 'tusimple':
+                    self._results[index] = ''.join([format_tusimple_lanes(lanes, filename, self.ppl) + '\n'
+                                                    for filename, lanes in zip(filenames, batch_coordinates)])
+                else:
+                    self._results[index] = ''.join([format_json_lanes(lanes, filename) + '\n'
+                                                    for filename, lanes in zip(filenames, batch_coordinates)])
+            except Exception as e:
+                self._exception = e
@@ -1,20 +1,137 @@
+import math
+import itertools
 import torch
 from torch import Tensor
 from typing import Optional
 from torch.nn import functional as F
 from ._utils import WeightedLoss
+from torchvision_models.lane_detection.lstr import evaluate_curves
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
 
 
-# The Hungarian loss for LSTR
+# The Hungarian loss for LSTR (https://arxiv.org/abs/2011.04233)
+# Each GT lane is matched to 1 query by a minimum cost bipartite matching (cost: lane probability, L1 of curve points,
+# lowest & highest y), matched queries learn the lanes, the others learn the background class (0)
+# The cost matrix (B x queries x lanes) is computed for the whole batch on device,
+# with at most max_permutations ordered assignments per image it is solved on device by an exhaustive search
+# (e.g. 2520 for 7 queries & 5 lanes), otherwise by the Hungarian algorithm on CPU (scipy, 1 copy per batch)
+# Targets: keypoints in input pixels (B x L x N x 2, invalid x is -2, padded lanes are marked in lane_existence)
 class HungarianLoss(WeightedLoss):
     __constants__ = ['ignore_index', 'reduction']
     ignore_index: int
 
-    def __init__(self, weight: Optional[Tensor] = None, size_average=None,
-                 ignore_index: int = -100, reduce=None, reduction: str = 'mean') -> None:
+    def __init__(self, class_weight: float = 3, curve_weight: float = 5, lower_weight: float = 2,
+                 upper_weight: float = 2, max_permutations: int = 10000, weight: Optional[Tensor] = None,
+                 size_average=None, ignore_index: int = -100, reduce=None, reduction: str = 'mean') -> None:
         super(HungarianLoss, self).__init__(weight, size_average, reduce, reduction)
         self.ignore_index = ignore_index
+        self.class_weight = class_weight
+        self.curve_weight = curve_weight
+        self.lower_weight = lower_weight
+        self.upper_weight = upper_weight
+        self.max_permutations = max_permutations
+        self._permutations = {}
 
-    def forward(self, inputs: Tensor, targets: Tensor, net) -> Tensor:
+    def forward(self, inputs: Tensor, targets: Tensor, lane_existence: Tensor, net, interp_size) -> Tensor:
         outputs = net(inputs)
-        pass
+        lanes = self.prepare_targets(targets, lane_existence, interp_size)
+        loss = self.set_loss(outputs['logits'], outputs['curves'], *lanes)
+        for aux in outputs.get('lane', []):  # Intermediate decoder layers
+            loss = loss + self.set_loss(aux['logits'], aux['curves'], *lanes)
+
+        return loss
+
+    @staticmethod
+    def prepare_targets(targets, lane_existence, interp_size):
+        # Return: normalized xs & ys (B x L x N), valid points (B x L x N), valid lanes (B x L),
+        # lowest & highest y (B x L), per lane weights of the curve loss (B x L)
+        targets = targets.float()
+        xs = targets[..., 0] / interp_size[1]
+        ys = targets[..., 1] / interp_size[0]
+        valid = (targets[..., 0] >= 0) & (lane_existence[..., None] > 0)
+        lane_valid = valid.sum(dim=-1) >= 2  # Lanes could lose points in augmentations
+        valid = valid & lane_valid[..., None]
+        ys = torch.where(valid, ys, torch.ones_like(ys))  # Invalid points are not used, but must be finite
+        lowers = torch.where(valid, ys, torch.full_like(ys, math.inf)).min(dim=-1).values
+        uppers = torch.where(valid, ys, torch.full_like(ys, -math.inf)).max(dim=-1).values
+        lowers = torch.where(lane_valid, lowers, torch.zeros_like(lowers))
+        uppers = torch.where(lane_valid, uppers, torch.zeros_like(uppers))
+
+        # Lanes with fewer points are weighted up (over the whole batch, same as the original implementation)
+        counts = valid.sum(dim=-1).float()
+        weights = (counts.sum() / counts.clamp(min=1)).sqrt() * lane_valid
+        weights = weights / weights.max().clamp(min=1e-6)
+
+        return xs, ys, valid, lane_valid, lowers, uppers, weights
+
+    def set_loss(self, logits, curves, xs, ys, valid, lane_valid, lowers, uppers, weights):
+        logits = logits.float()
+        curves = curves.float()
+        with torch.no_grad():
+            indices = self.match(logits, curves, xs, ys, valid, lane_valid, lowers, uppers, weights)
+        num_lanes = lane_valid.sum().clamp(min=1)
+
+        # Classification on all queries
+        target_classes = torch.zeros(logits.shape[:2], dtype=torch.int64, device=logits.device)
+        target_classes.scatter_(1, indices, lane_valid.to(torch.int64))
+        loss_class = F.cross_entropy(logits.permute(0, 2, 1), target_classes, weight=self.weight)
+
+        # Curves of matched queries
+        matched = curves.gather(1, indices[..., None].expand(-1, -1, curves.shape[-1]))
+        loss_lower = ((matched[..., 0] - lowers).abs() * lane_valid).sum() / num_lanes
+        loss_upper = ((matched[..., 1] - uppers).abs() * lane_valid).sum() / num_lanes
+        distances = torch.where(valid, (evaluate_curves(matched, ys) - xs).abs(), torch.zeros_like(xs))
+        loss_curve = (distances.sum(dim=-1) * weights).sum() / num_lanes
+
+        return self.class_weight * loss_class + self.curve_weight * loss_curve + \
+            self.lower_weight * loss_lower + self.upper_weight * loss_upper
+
+    def match(self, logits, curves, xs, ys, valid, lane_valid, lowers, uppers, weights):
+        # Return: matched query index of each lane (B x L), padded lanes take any unmatched query
+        B, Q, _ = logits.shape
+        L = xs.shape[1]
+        if L > Q:
+            raise ValueError('More lanes ({}) than queries ({})!'.format(L, Q))
+        if L == 0:
+            return torch.zeros((B, 0), dtype=torch.int64, device=logits.device)
+
+        # B x Q x L cost matrix, all pairs at once
+        cost_class = -logits.softmax(dim=-1)[..., 1:2]
+        cost_lower = (curves[:, :, None, 0] - lowers[:, None, :]).abs()
+        cost_upper = (curves[:, :, None, 1] - uppers[:, None, :]).abs()
+        distances = (evaluate_curves(curves[:, :, None, :], ys[:, None, :, :]) - xs[:, None, :, :]).abs()
+        cost_curve = torch.where(valid[:, None, :, :], distances, torch.zeros_like(distances)).sum(dim=-1) * \
+            weights[:, None, :]
+        cost = self.class_weight * cost_class + self.curve_weight * cost_curve + \
+            self.lower_weight * cost_lower + self.upper_weight * cost_upper
+        cost = torch.where(lane_valid[:, None, :], cost, torch.zeros_like(cost))  # Padded lanes cost nothing
+
+        permutations = self.get_permutations(Q, L, logits.device)
+        if permutations is not None:  # P x L, total costs: B x P
+            totals = cost[:, permutations, torch.arange(L, device=cost.device)].sum(dim=-1)
+
+            return permutations[totals.argmin(dim=1)]
+        else:
+            if linear_sum_assignment is None:
+                raise RuntimeError('scipy is required to match {} queries with {} lanes!'.format(Q, L))
+            cost = cost.cpu()
+            indices = torch.zeros((B, L), dtype=torch.int64)
+            for i in range(B):
+                rows, cols = linear_sum_assignment(cost[i].t().numpy())
+                indices[i, torch.as_tensor(rows)] = torch.as_tensor(cols, dtype=torch.int64)
+
+            return indices.to(logits.device)
+
+    def get_permutations(self, num_queries, num_lanes, device):
+        # All ordered selections of num_lanes queries (P x num_lanes), None if there are more than max_permutations
+        if math.factorial(num_queries) // math.factorial(num_queries - num_lanes) > self.max_permutations:
+            return None
+        key = (num_queries, num_lanes, str(device))
+        if key not in self._permutations.keys():
+            self._permutations[key] = torch.tensor(list(itertools.permutations(range(num_queries), num_lanes)),
+                                                   dtype=torch.int64, device=device)
+
+        return self._permutations[key]
@@ -3,6 +3,7 @@ from torch import Tensor
 from typing import Optional
 from torch.nn import functional as F
 from ._utils import WeightedLoss
+from torchvision_models.segmentation.enet import SpatialSoftmax
 
 
 # Typical lane detection loss by binary segmentation (e.g. SCNN)
@@ -18,6 +19,10 @@ class LaneLoss(WeightedLoss):
 
     def forward(self, inputs: Tensor, targets: Tensor, lane_existence: Tensor, net, interp_size) -> Tensor:
         outputs = net(inputs)
+
+        return self.lane_loss(outputs, targets, lane_existence, interp_size)
+
+    def lane_loss(self, outputs, targets: Tensor, lane_existence: Tensor, interp_size) -> Tensor:
         prob_maps = torch.nn.functional.interpolate(outputs['out'], size=interp_size, mode='bilinear',
                                                     align_corners=True)
         targets[targets > lane_existence.shape[-1]] = 255  # Ignore extra lanes
@@ -30,16 +35,77 @@ class LaneLoss(WeightedLoss):
         return total_loss
 
 
-# Loss function for SAD
-class SADLoss(WeightedLoss):
+# Loss function for SAD (Self Attention Distillation, https://arxiv.org/abs/1908.00821) on top of LaneLoss
+# Outputs of encoder stages (declared by models in _attention_modules, i.e. ENet & ERFNet) are captured by forward
+# hooks, each stage mimics the attention map of the next stage (detached, resized to the earlier stage),
+# attention map: spatial softmax of the channel-wise sum of squares, distance: squared L2 per image
+# Distillation starts after start_step training steps (calls), e.g. 2/3 of the training in the paper
+class SADLoss(LaneLoss):
     __constants__ = ['ignore_index', 'reduction']
     ignore_index: int
 
-    def __init__(self, existence_weight: float = 0.1, weight: Optional[Tensor] = None, size_average=None,
-                 ignore_index: int = -100, reduce=None, reduction: str = 'mean') -> None:
-        super(SADLoss, self).__init__(weight, size_average, reduce, reduction)
-        self.ignore_index = ignore_index
-        self.existence_weight = existence_weight
+    def __init__(self, existence_weight: float = 0.1, sad_weight: float = 0.1, start_step: int = 0,
+                 weight: Optional[Tensor] = None, size_average=None, ignore_index: int = -100, reduce=None,
+                 reduction: str = 'mean') -> None:
+        super(SADLoss, self).__init__(existence_weight, weight, size_average, ignore_index, reduce, reduction)
+        self.sad_weight = sad_weight
+        self.start_step = start_step
+        self.num_steps = 0
+        self.spatial_softmax = SpatialSoftmax(temperature=None)
+        self._net = None
+        self._handles = []
+        self._features = []
+        self._recording = False
+
+    def attach(self, net):
+        # Hook every module in _attention_modules of net's modules (names could be dotted, e.g. 'layers.5')
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        for module in net.modules():
+            for name in getattr(module, '_attention_modules', []):
+                child = module
+                for x in name.split('.'):
+                    child = getattr(child, x)
+                self._handles.append(child.register_forward_hook(self._hook))
+        if len(self._handles) < 2:
+            raise ValueError('SAD needs at least 2 attention modules (ENet & ERFNet)')
+        self._net = net
+
+    def _hook(self, module, inputs, output):
+        if self._recording:
+            self._features.append(output)
 
-    def forward(self, inputs: Tensor, targets: Tensor) -> Tensor:
-        pass
+    def attention_map(self, feature, size):
+        attention = feature.float().pow(2).sum(dim=1, keepdim=True)
+        if attention.shape[-2:] != size:
+            attention = F.interpolate(attention, size=size, mode='bilinear', align_corners=True)
+
+        return self.spatial_softmax(attention.squeeze(1).contiguous()).squeeze(1)
+
+    def distillation_loss(self, features) -> Tensor:
+        loss = 0
+        for student, teacher in zip(features[:-1], features[1:]):
+            size = student.shape[-2:]
+            target = self.attention_map(teacher.detach(), size)
+            loss = loss + (self.attention_map(student, size) - target).pow(2).sum(dim=-1).mean()
+
+        return loss
+
+    def forward(self, inputs: Tensor, targets: Tensor, lane_existence: Tensor, net, interp_size) -> Tensor:
+        if net is not self._net:
+            self.attach(net)
+        self.num_steps += 1
+        distill = self.num_steps > self.start_step
+        self._features = []
+        self._recording = distill
+        try:
+            outputs = net(inputs)
+        finally:
+            self._recording = False
+        total_loss = self.lane_loss(outputs, targets, lane_existence, interp_size)
+        if distill:
+            total_loss = total_loss + self.sad_weight * self.distillation_loss(self._features)
+        self._features = []
+
+        return total_loss
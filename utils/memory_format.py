@@ -0,0 +1,33 @@
+# channels_last (NHWC in memory) for models & image batches, logical shapes are still N x C x H x W
+# Convolutions (and their gradients) then run in NHWC kernels, e.g. for ERFNet's 3x1/1x3 convolutions
+# and tensor cores with mixed precision, interpolate/softmax/BatchNorm keep the memory format of their inputs
+import torch
+
+
+def get_memory_format(channels_last=False):
+    return torch.channels_last if channels_last else torch.contiguous_format
+
+
+def to_memory_format(x, memory_format):
+    # Only 4D floating point tensors (images) are converted, labels & others are returned as is
+    if isinstance(x, torch.Tensor) and x.dim() == 4 and x.is_floating_point():
+        return x.contiguous(memory_format=memory_format)
+
+    return x
+
+
+def _inputs_to_channels_last(module, inputs):
+    return tuple(to_memory_format(x, torch.channels_last) for x in inputs)
+
+
+def to_channels_last(net):
+    # In place, 4D weights (convolutions) & 4D inputs of the model, other parameters are unchanged
+    # Do this before creating the optimizer, checkpoints are loaded into the same memory format
+    net.to(memory_format=torch.channels_last)
+    net.register_forward_pre_hook(_inputs_to_channels_last)
+
+    return net
+
+
+def is_channels_last(x):
+    return x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last)
@@ -0,0 +1,68 @@
+# Post-training static int8 quantization (eager mode, CPU only):
+# fuse Conv-BN(-ReLU) -> insert observers -> calibrate on a few hundred images -> convert
+# Models mark their quantization boundaries with QuantStub/DeQuantStub, fuse themselves by fuse_model(),
+# and list children that must stay in floating point (e.g. SCNN, ENet unpooling) in _float_modules
+import torch
+from tqdm import tqdm
+
+
+def fuse_model(net):
+    # Call fuse_model() of every module (each one fuses its own children), eval mode only
+    for module in list(net.modules()):
+        if hasattr(module, 'fuse_model'):
+            module.fuse_model()
+
+    return net
+
+
+def _set_float_modules(net):
+    for module in list(net.modules()):
+        for name in getattr(module, '_float_modules', []):
+            child = getattr(module, name, None)
+            if child is not None:
+                child.qconfig = None
+
+
+def prepare_quantization(net, backend='fbgemm'):
+    # fbgemm for x86, qnnpack for ARM
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError('Quantized engine {} is not supported by this PyTorch build'.format(backend))
+    if any(isinstance(m, torch.nn.PReLU) for m in net.modules()) and not hasattr(torch.nn.quantized, 'PReLU'):
+        raise ValueError('Quantizing ENet (PReLU) needs a newer PyTorch')
+    torch.backends.quantized.engine = backend
+    net.cpu().eval()
+    fuse_model(net)
+    net.qconfig = torch.quantization.get_default_qconfig(backend)
+    _set_float_modules(net)
+    torch.quantization.propagate_qconfig_(net)  # Children get their qconfig here (prepare() keeps them)
+    for module in net.modules():  # No per-channel weights for transposed convolutions
+        if isinstance(module, torch.nn.ConvTranspose2d) and getattr(module, 'qconfig', None) is not None:
+            module.qconfig = torch.quantization.QConfig(activation=module.qconfig.activation,
+                                                        weight=torch.quantization.default_weight_observer)
+    torch.quantization.prepare(net, inplace=True)
+
+    return net
+
+
+def calibrate(net, loader, num_images=300):
+    # Run (image, target) batches (from any iterable) through the observers
+    net.eval()
+    count = 0
+    with torch.no_grad():
+        for images, _ in tqdm(loader):
+            net(images.cpu())
+            count += images.shape[0]
+            if count >= num_images:
+                break
+
+    return count
+
+
+def quantize_model(net, loader, num_images=300, backend='fbgemm'):
+    # In place, the quantized model only runs on CPU
+    prepare_quantization(net, backend=backend)
+    count = calibrate(net, loader, num_images=num_images)
+    print('Calibrated on {} images.'.format(count))
+    torch.quantization.convert(net, inplace=True)
+
+    return net
@@ -35,6 +35,8 @@ if __name__ == '__main__':
                         help='Enable label_id_map, usually for ground truth mask in Cityscapes (default: False)')
     parser.add_argument('--mixed-precision', action='store_true', default=False,
                         help='Enable mixed precision training (default: False)')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='Use channels_last (NHWC) memory format for weights & inputs (default: False)')
     parser.add_argument('--continue-from', type=str, default=None,
                         help='Continue training from a previous checkpoint')
     args = parser.parse_args()